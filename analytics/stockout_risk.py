@@ -69,7 +69,7 @@ Usage
 """
 
 import os
-import time
+import sys
 import textwrap
 import boto3
 import pandas as pd
@@ -77,6 +77,10 @@ import numpy as np
 from dotenv import load_dotenv
 from pathlib import Path
 
+# Share the Athena helper (bulk S3 result fetch) with the ml/ pipeline.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "ml"))
+import athena_client  # noqa: E402
+
 # ---------------------------------------------------------------------------
 # Config
 # ---------------------------------------------------------------------------
@@ -90,7 +94,6 @@ ATHENA_SCHEMA   = os.getenv("ATHENA_SCHEMA", os.getenv("ATHENA_DATABASE", "retai
 DATABASE        = os.getenv("ATHENA_EXECUTION_DATABASE", ATHENA_SCHEMA)
 DEMAND_DAYS     = 30
 OUTPUT_DIR      = Path(__file__).parent
-POLL_INTERVAL   = 2   # seconds between Athena status checks
 
 DEMAND_TABLE            = os.getenv("ATHENA_DEMAND_TABLE", "fct_daily_sales")
 INVENTORY_TABLE         = os.getenv("ATHENA_INVENTORY_TABLE", "fct_inventory_snapshots")
@@ -108,43 +111,13 @@ def table_ref(name: str) -> str:
 # Athena helper
 # ---------------------------------------------------------------------------
 
-def run_query(client: boto3.client, sql: str, label: str) -> pd.DataFrame:
-    """Submit a query to Athena, wait for completion, return a DataFrame."""
-    print(f"  → Running: {label}")
-    query_context = {"Database": DATABASE}
-    if ATHENA_CATALOG:
-        query_context["Catalog"] = ATHENA_CATALOG
-
-    resp = client.start_query_execution(
-        QueryString=sql,
-        QueryExecutionContext=query_context,
-        WorkGroup=WORKGROUP,
+def run_queries(client: boto3.client, queries: dict[str, str]) -> dict[str, pd.DataFrame]:
+    """Submit labelled queries together, wait for all of them, return {label: DataFrame}."""
+    print(f"  → Running: {', '.join(queries)}")
+    return athena_client.run_queries(
+        queries, client,
+        database=DATABASE, workgroup=WORKGROUP, catalog=ATHENA_CATALOG,
     )
-    qid = resp["QueryExecutionId"]
-
-    while True:
-        status = client.get_query_execution(QueryExecutionId=qid)
-        state = status["QueryExecution"]["Status"]["State"]
-        if state == "SUCCEEDED":
-            break
-        if state in ("FAILED", "CANCELLED"):
-            reason = status["QueryExecution"]["Status"].get("StateChangeReason", "")
-            raise RuntimeError(f"Athena query {label!r} {state}: {reason}")
-        time.sleep(POLL_INTERVAL)
-
-    paginator = client.get_paginator("get_query_results")
-    rows, header = [], None
-    for page in paginator.paginate(QueryExecutionId=qid):
-        result_rows = page["ResultSet"]["Rows"]
-        if header is None:
-            header = [c["VarCharValue"] for c in result_rows[0]["Data"]]
-            result_rows = result_rows[1:]
-        for row in result_rows:
-            rows.append([c.get("VarCharValue", None) for c in row["Data"]])
-
-    df = pd.DataFrame(rows, columns=header)
-    print(f"     {len(df):,} rows returned")
-    return df
 
 
 # ---------------------------------------------------------------------------
@@ -200,24 +173,26 @@ SQL_PRODUCT_SUPPLIER = textwrap.dedent("""
 # ---------------------------------------------------------------------------
 
 def main():
-    client = boto3.client("athena", region_name=REGION)
-
-    print("\n[1/4] Fetching avg daily demand (last 30 days) from fct_daily_sales …")
-    demand = run_query(client, SQL_DEMAND, "demand")
-    demand["avg_daily_demand"] = pd.to_numeric(demand["avg_daily_demand"], errors="coerce").fillna(0)
-
-    print("\n[2/4] Fetching latest inventory snapshot from fct_inventory_snapshots …")
-    inv = run_query(client, SQL_INVENTORY, "inventory")
-    for col in ["quantity_on_hand", "quantity_on_order", "reorder_point"]:
-        inv[col] = pd.to_numeric(inv[col], errors="coerce").fillna(0)
-
-    print("\n[3/4] Fetching supplier performance from mart_supplier_performance …")
-    sup = run_query(client, SQL_SUPPLIER, "supplier_performance")
-    for col in ["avg_actual_lead_time_days", "calculated_on_time_rate", "avg_fill_rate"]:
-        sup[col] = pd.to_numeric(sup[col], errors="coerce")
-
-    print("\n[4/4] Fetching product → supplier mapping from dim_products …")
-    prod_sup = run_query(client, SQL_PRODUCT_SUPPLIER, "product_supplier")
+    client = athena_client.get_athena_client()
+
+    # All four inputs are independent, so they run as one concurrent batch:
+    #   demand               — avg daily demand (last 30 days) from fct_daily_sales
+    #   inventory            — latest snapshot from fct_inventory_snapshots
+    #   supplier_performance — lead time / on-time rate from mart_supplier_performance
+    #   product_supplier     — product → supplier mapping from dim_products
+    print("\nFetching demand, inventory, supplier performance and product mapping …")
+    results = run_queries(client, {
+        "demand":               SQL_DEMAND,
+        "inventory":            SQL_INVENTORY,
+        "supplier_performance": SQL_SUPPLIER,
+        "product_supplier":     SQL_PRODUCT_SUPPLIER,
+    })
+    demand   = results["demand"].fillna({"avg_daily_demand": 0})
+    inv      = results["inventory"].fillna(
+        {"quantity_on_hand": 0, "quantity_on_order": 0, "reorder_point": 0}
+    )
+    sup      = results["supplier_performance"]
+    prod_sup = results["product_supplier"]
 
     # -----------------------------------------------------------------------
     # Build scoring table
@@ -1,13 +1,116 @@
 """
 Shared Athena query helper used by all ml/ scripts.
 Reads config from environment / .env — no hardcoded values.
+
+Result fetching
+---------------
+Athena writes every SELECT result as a CSV object under the workgroup output
+location. For anything beyond a few pages it is much faster to stream that
+object from S3 in one read and parse it with the vectorized pandas CSV reader
+than to page through GetQueryResults 1,000 rows at a time. Small results, and
+results that have no CSV object (DDL, UNLOAD), still use the paginator.
+
+ATHENA_FETCH_MODE selects the behaviour:
+    auto     — S3 bulk read for results >= BULK_FETCH_MIN_BYTES, else paginate
+    s3       — always read the result object from S3
+    paginate — always page through GetQueryResults
+
+Typed results
+-------------
+Both fetch paths decode each column once, using the Athena column types in
+ResultSetMetadata.ColumnInfo, so callers get analysis-ready dtypes:
+    double / float / real / decimal  -> float64
+    tinyint / smallint / integer / bigint -> int8 / int16 / int32 / int64
+                                        (nullable Int* when NULLs are present)
+    boolean                           -> bool (nullable boolean with NULLs)
+    date / timestamp                  -> datetime64[ns]
+    varchar / char                    -> category when at most
+                                         CATEGORY_MAX_RATIO of values are
+                                         distinct, otherwise object
+
+Clients
+-------
+get_athena_client() / get_s3_client() / get_glue_client() return clients
+cached for the whole process and built from one shared boto3 session with
+BOTO_CONFIG (connection pool sized for the parallel fetches, adaptive
+retries). Every ml/ stage run by run_pipeline.py therefore reuses the same
+credentials, endpoints and pooled TLS connections.
+
+Offline DuckDB backend
+----------------------
+ATHENA_BACKEND=duckdb runs the same SQL on an in-process DuckDB database
+instead of Athena, for local development and repeatable benchmarks. Each
+directory under ML_DUCKDB_DATA_DIR (default data/marts/, populated by
+scripts/05_export_marts_to_parquet.py) is exposed as a view
+retailops_marts.<directory name> over its Parquet files. Presto-only syntax
+the mart queries use (DATE_ADD('day', n, d), AwsDataCatalog. prefixes) is
+rewritten or shimmed with DuckDB macros, as are the hash functions of the
+sampling predicate (sampling.py). UNLOAD labels and the result cache
+are ignored on this backend; query stats are still recorded.
+
+Streaming results
+-----------------
+iter_query() yields a result as typed DataFrame (or Arrow RecordBatch)
+chunks, parsing the S3 CSV object incrementally or accumulating
+GetQueryResults pages. Memory stays bounded by the chunk size, so a
+consumer such as a Parquet writer can work through full sales history
+without holding it all.
+
+Polling and query statistics
+----------------------------
+Status polling backs off exponentially from POLL_MIN_SEC to POLL_MAX_SEC, so
+short queries return within tens of milliseconds of finishing while long ones
+are not polled every few hundred milliseconds for minutes.
+
+Every finished query appends a record to the in-process QUERY_STATS registry
+(Athena's Statistics block plus result row count and wall time).
+dump_query_stats() serialises it to JSON so a stage or run_pipeline.py can
+persist it and show which mart queries dominate latency and scan cost.
+
+UNLOAD extracts
+---------------
+unload_query(), or run_queries(..., unload=[labels]), wraps a SELECT in
+UNLOAD ... WITH (format = 'PARQUET') to a scratch prefix in the data lake
+bucket. Athena writes the Parquet files in parallel; they are downloaded
+concurrently, decoded column-wise with pyarrow, mapped to the same dtypes as
+above, and deleted, also when the query or the read fails. Files can still
+be orphaned if the process dies mid-extract, so the UNLOAD_PREFIX prefix
+of the data lake bucket needs an S3 lifecycle rule that expires objects
+after a day as a backstop. UNLOAD output is unordered, so a final ORDER BY over
+plain columns is applied in pandas instead; one UNLOAD cannot reproduce
+(expressions, or a LIMIT / OFFSET / FETCH after it) is refused with
+ValueError before anything is submitted. An extract with no rows comes back
+as an empty frame with the query's columns.
+
+Result cache
+------------
+With ML_QUERY_CACHE=1 and ML_LOCAL_ARTIFACT_DIR set, typed results are kept as
+Parquet files under <ML_LOCAL_ARTIFACT_DIR>/athena_cache. The cache key is a
+sha256 of the whitespace-normalised SQL, the database, and a version token per
+retailops_marts table the SQL references (the newest LastModified and object
+count under the table's Glue location), so a mart rebuild invalidates every
+query that reads it. A hit skips Athena entirely. Entries expire after
+ML_QUERY_CACHE_TTL_SEC, and the least recently used are evicted once the
+cache exceeds ML_QUERY_CACHE_MAX_MB. Queries whose tables cannot be versioned
+are never cached.
 """
 
+import hashlib
+import json
 import os
+import re
+import threading
 import time
+import uuid
 import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections.abc import Collection, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
 load_dotenv(Path(__file__).parent.parent / ".env")
@@ -16,52 +119,801 @@ REGION     = os.getenv("AWS_DEFAULT_REGION", "eu-west-2")
 WORKGROUP  = "retailops-primary"
 DATABASE   = "retailops_marts"
 BUCKET     = f"retailops-data-lake-{REGION}"
-POLL_SEC   = 2
+POLL_MIN_SEC   = 0.05
+POLL_MAX_SEC   = 5.0
+POLL_BACKOFF   = 1.5
+
+BACKEND              = os.getenv("ATHENA_BACKEND", "athena").strip().lower()
+DUCKDB_DATA_DIR      = Path(os.getenv("ML_DUCKDB_DATA_DIR",
+                                      str(Path(__file__).parent.parent / "data" / "marts")))
+FETCH_MODE           = os.getenv("ATHENA_FETCH_MODE", "auto").strip().lower()
+BULK_FETCH_MIN_BYTES = 256 * 1024
+CATEGORY_MAX_RATIO   = 0.5
+ITER_CHUNK_ROWS      = 100_000
+UNLOAD_PREFIX        = "ml/athena_unload"
+UNLOAD_FETCH_WORKERS = 16
+_ORDER_BY_RE         = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+_ROW_LIMIT_RE        = re.compile(r"\b(LIMIT|OFFSET|FETCH)\b", re.IGNORECASE)
+_SORT_KEY_RE         = re.compile(r'^(?:"?\w+"?\.)*"?([A-Za-z_]\w*)"?(?:\s+(ASC|DESC))?'
+                                  r'(?:\s+NULLS\s+(FIRST|LAST))?$', re.IGNORECASE)
+
+_INT_DTYPES   = {"tinyint": "int8", "smallint": "int16", "integer": "int32",
+                 "int": "int32", "bigint": "int64"}
+_FLOAT_TYPES  = {"double", "float", "real", "decimal"}
+_STRING_TYPES = {"varchar", "char", "string"}
+
+CACHE_DIR_NAME       = "athena_cache"
+CACHE_TTL_SEC        = int(os.getenv("ML_QUERY_CACHE_TTL_SEC", str(7 * 24 * 3600)))
+CACHE_MAX_BYTES      = int(os.getenv("ML_QUERY_CACHE_MAX_MB", "2048")) * 1024 ** 2
+_MART_TABLE_RE       = re.compile(r"\bretailops_marts\.(\w+)", re.IGNORECASE)
+
+BOTO_MAX_POOL_CONNECTIONS = int(os.getenv("ML_BOTO_MAX_POOL_CONNECTIONS", "32"))
+BOTO_MAX_ATTEMPTS         = int(os.getenv("ML_BOTO_MAX_ATTEMPTS", "10"))
+BOTO_CONFIG = Config(
+    max_pool_connections=BOTO_MAX_POOL_CONNECTIONS,
+    retries={"max_attempts": BOTO_MAX_ATTEMPTS, "mode": "adaptive"},
+)
+
+# boto3 clients are thread-safe once built, but building them is not, so the
+# shared session and clients are created under a lock. See get_session().
+_SESSION: boto3.session.Session | None = None
+_CLIENTS: dict[str, boto3.client] = {}
+_CLIENT_LOCK = threading.RLock()
+
+# Presto/Trino -> DuckDB rewrites applied to every query on the duckdb backend.
+_DUCKDB_REWRITES = [
+    (re.compile(r"\bAwsDataCatalog\.", re.IGNORECASE), ""),
+    (re.compile(r"\bDATE_ADD\s*\(", re.IGNORECASE), "presto_date_add("),
+]
+_DUCKDB_MACROS = [
+    """CREATE MACRO presto_date_add(unit, n, d) AS CASE lower(unit)
+           WHEN 'day'   THEN d + to_days(CAST(n AS INTEGER))
+           WHEN 'week'  THEN d + to_weeks(CAST(n AS INTEGER))
+           WHEN 'month' THEN d + to_months(CAST(n AS INTEGER))
+           WHEN 'year'  THEN d + to_years(CAST(n AS INTEGER))
+           WHEN 'hour'  THEN d + to_hours(CAST(n AS BIGINT))
+       END""",
+    # Sampling hash (sampling.py). DuckDB has no xxhash64, so its own hash
+    # stands in: stable, but not the values Athena computes.
+    "CREATE MACRO to_utf8(s) AS encode(s)",
+    "CREATE MACRO xxhash64(b) AS hash(b)",
+    "CREATE MACRO from_big_endian_64(h) AS CAST(h >> 1 AS BIGINT)",
+]
+_DUCKDB_CONNECTION = None
+
+# Mart version tokens are looked up once per table per process.
+_MART_VERSIONS: dict[str, str | None] = {}
+
+# One record per finished query, in completion order. See record_query_stats().
+QUERY_STATS: list[dict] = []
+
+
+def get_session() -> boto3.session.Session:
+    """Process-wide boto3 session; credentials are resolved once per process."""
+    global _SESSION
+    with _CLIENT_LOCK:
+        if _SESSION is None:
+            _SESSION = boto3.session.Session(region_name=REGION)
+        return _SESSION
+
+
+def _get_client(service: str) -> boto3.client:
+    """Return the cached client for `service`, creating it on first use."""
+    session = get_session()
+    with _CLIENT_LOCK:
+        if service not in _CLIENTS:
+            _CLIENTS[service] = session.client(service, region_name=REGION, config=BOTO_CONFIG)
+        return _CLIENTS[service]
 
 
 def get_athena_client() -> boto3.client:
-    return boto3.client("athena", region_name=REGION)
+    return _get_client("athena")
 
 
 def get_s3_client() -> boto3.client:
-    return boto3.client("s3", region_name=REGION)
+    return _get_client("s3")
 
 
-def run_query(sql: str, label: str = "", client: boto3.client = None) -> pd.DataFrame:
-    """Execute SQL on Athena, block until done, return DataFrame."""
-    if client is None:
-        client = get_athena_client()
-    if label:
-        print(f"  [athena] {label}")
+def get_glue_client() -> boto3.client:
+    return _get_client("glue")
 
-    resp = client.start_query_execution(
-        QueryString=sql,
-        QueryExecutionContext={"Database": DATABASE},
-        WorkGroup=WORKGROUP,
-    )
-    qid = resp["QueryExecutionId"]
 
-    while True:
-        status = client.get_query_execution(QueryExecutionId=qid)
-        state  = status["QueryExecution"]["Status"]["State"]
-        if state == "SUCCEEDED":
-            break
-        if state in ("FAILED", "CANCELLED"):
-            reason = status["QueryExecution"]["Status"].get("StateChangeReason", "")
-            raise RuntimeError(f"Athena {label!r} {state}: {reason}")
-        time.sleep(POLL_SEC)
+def _split_s3_uri(uri: str) -> tuple[str, str]:
+    """s3://bucket/some/key -> ("bucket", "some/key")"""
+    bucket, _, key = uri.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+def _athena_type(column: dict) -> str:
+    """ColumnInfo type name without parameters: 'decimal(10,2)' -> 'decimal'."""
+    return column["Type"].split("(")[0].strip().lower()
+
+
+def _decode_column(values: pd.Series, athena_type: str,
+                   streaming: bool = False) -> pd.Series:
+    """
+    Convert one result column from Athena's string form to its pandas dtype.
+    With streaming=True the dtype depends only on the Athena type, never on
+    the values (always-nullable ints and booleans, no category), so every
+    chunk of an iter_query result has the same schema.
+    """
+    if athena_type == "boolean":
+        missing = values.isna()
+        decoded = values.eq("true")
+        if streaming or missing.any():
+            decoded = decoded.astype("boolean")
+            decoded[missing] = pd.NA
+        return decoded
+    if athena_type in _INT_DTYPES:
+        decoded = pd.to_numeric(values)
+        dtype = _INT_DTYPES[athena_type]
+        nullable = streaming or decoded.isna().any()
+        return decoded.astype(dtype.capitalize() if nullable else dtype)
+    if athena_type in _FLOAT_TYPES:
+        return pd.to_numeric(values).astype("float64")
+    if athena_type == "date":
+        return pd.to_datetime(values, format="%Y-%m-%d")
+    if athena_type.startswith("timestamp"):
+        return pd.to_datetime(values, format="ISO8601")
+    if athena_type in _STRING_TYPES and not streaming:
+        return _maybe_category(values)
+    return values
+
 
+def _maybe_category(values: pd.Series) -> pd.Series:
+    """Low-cardinality string column -> category, otherwise unchanged."""
+    if len(values) > 0 and values.nunique() <= CATEGORY_MAX_RATIO * len(values):
+        return values.astype("category")
+    return values
+
+
+def _decode_columns(df: pd.DataFrame, column_info: list[dict],
+                    streaming: bool = False) -> pd.DataFrame:
+    """Decode every column of a result frame in place using its ColumnInfo type."""
+    for column in column_info:
+        df[column["Name"]] = _decode_column(df[column["Name"]], _athena_type(column), streaming)
+    return df
+
+
+def _iter_pages(client: boto3.client, qid: str):
+    """Yield (header, ColumnInfo, rows of strings) for each GetQueryResults page."""
     paginator = client.get_paginator("get_query_results")
-    rows, header = [], None
+    header, column_info = None, []
     for page in paginator.paginate(QueryExecutionId=qid):
         result_rows = page["ResultSet"]["Rows"]
         if header is None:
+            column_info = page["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
             header = [c["VarCharValue"] for c in result_rows[0]["Data"]]
             result_rows = result_rows[1:]
-        for row in result_rows:
-            rows.append([c.get("VarCharValue") for c in row["Data"]])
+        yield header, column_info, [[c.get("VarCharValue") for c in row["Data"]]
+                                    for row in result_rows]
+
+
+def _fetch_paginated(client: boto3.client, qid: str) -> tuple[pd.DataFrame, list[dict]]:
+    """Page through GetQueryResults; return a frame of strings and its ColumnInfo."""
+    rows, header, column_info = [], None, []
+    for header, column_info, page_rows in _iter_pages(client, qid):
+        rows.extend(page_rows)
+    return pd.DataFrame(rows, columns=header), column_info
+
+
+def _column_info(client: boto3.client, qid: str) -> list[dict]:
+    """Fetch only the result metadata (first page, header row)."""
+    resp = client.get_query_results(QueryExecutionId=qid, MaxResults=1)
+    return resp["ResultSet"]["ResultSetMetadata"]["ColumnInfo"]
+
+
+def _fetch_s3_csv(client: boto3.client, s3: boto3.client, qid: str,
+                  output_location: str, min_bytes: int = 0) -> pd.DataFrame | None:
+    """
+    Stream the query's CSV result object from S3 and parse it in one pass.
+    Returns None when the object is smaller than min_bytes so the caller can
+    use the paginator instead.
+
+    Numeric columns are parsed straight to numbers by the CSV reader; the
+    rest are read as strings and decoded afterwards. Athena writes NULL as an
+    empty unquoted field, which becomes NaN.
+    """
+    bucket, key = _split_s3_uri(output_location)
+    obj = s3.get_object(Bucket=bucket, Key=key)
+    if obj["ContentLength"] < min_bytes:
+        obj["Body"].close()
+        return None
+
+    column_info = _column_info(client, qid)
+    df = pd.read_csv(obj["Body"], dtype=_csv_dtypes(column_info),
+                     keep_default_na=False, na_values=[""])
+    return _decode_columns(df, column_info)
+
+
+def _csv_dtypes(column_info: list[dict]) -> dict:
+    """read_csv dtype map: numbers parsed directly, everything else as strings."""
+    dtypes = {}
+    for column in column_info:
+        athena_type = _athena_type(column)
+        if athena_type in _FLOAT_TYPES:
+            dtypes[column["Name"]] = "float64"
+        elif athena_type in _INT_DTYPES:
+            dtypes[column["Name"]] = "Int64"
+        else:
+            dtypes[column["Name"]] = str
+    return dtypes
+
+
+def _fetch_results(client: boto3.client, qid: str, execution: dict,
+                   fetch: str = FETCH_MODE) -> pd.DataFrame:
+    """Fetch a finished query's result set using the requested fetch mode."""
+    output_location = execution.get("ResultConfiguration", {}).get("OutputLocation", "")
+    if fetch != "paginate" and output_location.endswith(".csv"):
+        min_bytes = BULK_FETCH_MIN_BYTES if fetch == "auto" else 0
+        try:
+            df = _fetch_s3_csv(client, get_s3_client(), qid, output_location, min_bytes)
+            if df is not None:
+                return df
+        except ClientError as exc:
+            print(f"         S3 bulk fetch failed ({exc}), falling back to paginator")
+    df, column_info = _fetch_paginated(client, qid)
+    return _decode_columns(df, column_info)
+
+
+def _iter_results(client: boto3.client, qid: str, execution: dict,
+                  fetch: str, chunk_rows: int) -> Iterator[pd.DataFrame]:
+    """
+    Yield a finished query's result in typed chunks of about chunk_rows rows:
+    streamed from the S3 CSV object when one exists, otherwise accumulated
+    from GetQueryResults pages.
+    """
+    output_location = execution.get("ResultConfiguration", {}).get("OutputLocation", "")
+    if fetch != "paginate" and output_location.endswith(".csv"):
+        bucket, key = _split_s3_uri(output_location)
+        try:
+            obj = get_s3_client().get_object(Bucket=bucket, Key=key)
+        except ClientError as exc:
+            print(f"         S3 stream failed ({exc}), falling back to paginator")
+        else:
+            column_info = _column_info(client, qid)
+            with pd.read_csv(obj["Body"], dtype=_csv_dtypes(column_info),
+                             keep_default_na=False, na_values=[""],
+                             chunksize=chunk_rows) as reader:
+                for chunk in reader:
+                    yield _decode_columns(chunk, column_info, streaming=True)
+            return
+
+    rows = []
+    for header, column_info, page_rows in _iter_pages(client, qid):
+        rows.extend(page_rows)
+        if len(rows) >= chunk_rows:
+            yield _decode_columns(pd.DataFrame(rows, columns=header), column_info, streaming=True)
+            rows = []
+    if rows:
+        yield _decode_columns(pd.DataFrame(rows, columns=header), column_info, streaming=True)
+
+
+def _top_level(sql: str) -> str:
+    """
+    `sql` with everything inside parentheses or string literals blanked out
+    (same length), so clause keywords of the outer query can be searched.
+    """
+    chars, depth, quoted = [], 0, False
+    for char in sql:
+        if char == "'":
+            quoted = not quoted
+            chars.append(" ")
+        elif quoted:
+            chars.append(" ")
+        elif char == "(":
+            depth += 1
+            chars.append(" ")
+        elif char == ")":
+            depth -= 1
+            chars.append(" ")
+        else:
+            chars.append(char if depth == 0 else " ")
+    return "".join(chars)
+
+
+def _unload_sql(sql: str, location: str) -> tuple[str, dict | None]:
+    """
+    Wrap a SELECT in UNLOAD ... TO location as Snappy Parquet. UNLOAD writes
+    files in parallel and does not keep row order, so a final ORDER BY of the
+    outer query is dropped and returned as sort_values arguments for the
+    caller to re-sort with (None when there is none).
+
+    Only plain column keys with ASC / DESC and one shared NULLS FIRST / LAST
+    can be re-applied in pandas. Any other final ORDER BY (expressions,
+    positions, mixed NULLS, or a LIMIT / OFFSET / FETCH depending on it)
+    raises ValueError rather than changing what the query returns.
+    """
+    sql = sql.strip().rstrip(";").rstrip()
+    outer = _top_level(sql)
+    sort = None
+    matches = list(_ORDER_BY_RE.finditer(outer))
+    if matches:
+        clause = matches[-1]
+        if _ROW_LIMIT_RE.search(outer, clause.end()):
+            raise ValueError("UNLOAD cannot keep ORDER BY ... LIMIT / OFFSET / FETCH; "
+                             "run this query without unload")
+        by, ascending, nulls = [], [], set()
+        for key in sql[clause.end():].split(","):
+            key_match = _SORT_KEY_RE.match(key.strip())
+            if key_match is None:
+                raise ValueError(f"UNLOAD cannot re-apply ORDER BY key {key.strip()!r}; "
+                                 f"sort by plain column names or run without unload")
+            column, direction, null_order = key_match.groups()
+            by.append(column)
+            ascending.append((direction or "ASC").upper() == "ASC")
+            nulls.add((null_order or "LAST").lower())   # Athena sorts NULLs last by default
+        if len(nulls) > 1:
+            raise ValueError("UNLOAD cannot re-apply an ORDER BY with mixed NULLS FIRST / LAST")
+        sort = {"by": by, "ascending": ascending, "na_position": nulls.pop()}
+        sql = sql[:clause.start()].rstrip()
+    return (f"UNLOAD ({sql}\n) TO '{location}'\n"
+            f"WITH (format = 'PARQUET', compression = 'SNAPPY')"), sort
+
+
+def _arrow_to_pandas(table: pa.Table, streaming: bool = False) -> pd.DataFrame:
+    """
+    Arrow result -> pandas with the same dtypes the CSV fetch path produces
+    (see _decode_column for what streaming=True changes).
+    """
+    df = table.to_pandas(date_as_object=False, coerce_temporal_nanoseconds=True)
+    for field in table.schema:
+        column = table.column(field.name)
+        if pa.types.is_date(field.type):
+            df[field.name] = df[field.name].astype("datetime64[ns]")
+        elif pa.types.is_integer(field.type) and (streaming or column.null_count):
+            df[field.name] = df[field.name].astype(str(field.type).capitalize())
+        elif pa.types.is_boolean(field.type) and (streaming or column.null_count):
+            df[field.name] = df[field.name].astype("boolean")
+        elif ((pa.types.is_string(field.type) or pa.types.is_large_string(field.type))
+              and not streaming):
+            df[field.name] = _maybe_category(df[field.name])
+    return df
+
+
+def _unloaded_keys(s3: boto3.client, location: str) -> list[str]:
+    bucket, prefix = _split_s3_uri(location)
+    return [
+        obj["Key"]
+        for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get("Contents", [])
+    ]
+
+
+def _delete_unloaded(location: str) -> None:
+    """Delete every object under an UNLOAD location."""
+    s3 = get_s3_client()
+    bucket, _ = _split_s3_uri(location)
+    keys = _unloaded_keys(s3, location)
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={
+            "Objects": [{"Key": key} for key in keys[start:start + 1000]],
+            "Quiet": True,
+        })
+
+
+def _fetch_unloaded(client: boto3.client, qid: str, location: str,
+                    sort: dict | None) -> pd.DataFrame:
+    """
+    Download every Parquet file UNLOAD wrote under `location` in parallel,
+    decode them with pyarrow into one frame, then delete the files, also
+    when reading fails. An extract with no rows writes no files; it is
+    returned as an empty frame with the query's columns and dtypes from
+    ResultSetMetadata.
+    """
+    s3 = get_s3_client()
+    bucket, _ = _split_s3_uri(location)
+
+    def read(key: str) -> pa.Table:
+        return pq.read_table(pa.BufferReader(s3.get_object(Bucket=bucket, Key=key)["Body"].read()))
+
+    try:
+        keys = _unloaded_keys(s3, location)
+        if keys:
+            with ThreadPoolExecutor(max_workers=min(UNLOAD_FETCH_WORKERS, len(keys))) as pool:
+                table = pa.concat_tables(list(pool.map(read, keys)))
+    finally:
+        _delete_unloaded(location)
+
+    if keys:
+        df = _arrow_to_pandas(table)
+    else:
+        column_info = _column_info(client, qid)
+        empty = pd.DataFrame({column["Name"]: pd.Series([], dtype=object) for column in column_info})
+        df = _decode_columns(empty, column_info)
+
+    if sort and not df.empty:
+        df = df.sort_values(**sort, kind="stable", ignore_index=True)
+    return df
+
+
+def _duckdb_connection():
+    """In-memory DuckDB database with a view per local mart table, built once."""
+    global _DUCKDB_CONNECTION
+    with _CLIENT_LOCK:
+        if _DUCKDB_CONNECTION is None:
+            import duckdb  # requirements-dev.txt only
+
+            if not DUCKDB_DATA_DIR.is_dir():
+                raise FileNotFoundError(
+                    f"ML_DUCKDB_DATA_DIR {DUCKDB_DATA_DIR} does not exist; "
+                    "run scripts/05_export_marts_to_parquet.py first"
+                )
+            con = duckdb.connect()
+            con.execute(f"CREATE SCHEMA IF NOT EXISTS {DATABASE}")
+            for table_dir in sorted(p for p in DUCKDB_DATA_DIR.iterdir() if p.is_dir()):
+                files = (table_dir / "**" / "*.parquet").as_posix()
+                con.execute(
+                    f"CREATE VIEW {DATABASE}.{table_dir.name} AS "
+                    f"SELECT * FROM read_parquet('{files}', hive_partitioning = true, "
+                    f"union_by_name = true)"
+                )
+            for macro in _DUCKDB_MACROS:
+                con.execute(macro)
+            _DUCKDB_CONNECTION = con
+        return _DUCKDB_CONNECTION
+
+
+def _to_duckdb_sql(sql: str) -> str:
+    for pattern, replacement in _DUCKDB_REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+def _run_duckdb(queries: dict[str, str]) -> dict[str, pd.DataFrame]:
+    """Run labelled queries one after another on the local DuckDB backend."""
+    con = _duckdb_connection()
+    results = {}
+    for label, sql in queries.items():
+        started = time.monotonic()
+        cursor = con.cursor()
+        df = _arrow_to_pandas(cursor.execute(_to_duckdb_sql(sql)).fetch_arrow_table())
+        cursor.close()
+        wall_sec = time.monotonic() - started
+        execution = {"Statistics": {"EngineExecutionTimeInMillis": int(wall_sec * 1000)}}
+        record = record_query_stats(label, execution, len(df), wall_sec)
+        print(f"         {label}: {_format_stats(record)}  [duckdb]")
+        results[label] = df
+    return results
+
+
+def _start_query(client: boto3.client, sql: str, database: str,
+                 workgroup: str, catalog: str | None) -> str:
+    """Submit SQL to Athena and return the QueryExecutionId without waiting."""
+    query_context = {"Database": database}
+    if catalog:
+        query_context["Catalog"] = catalog
+
+    resp = client.start_query_execution(
+        QueryString=sql,
+        QueryExecutionContext=query_context,
+        WorkGroup=workgroup,
+    )
+    return resp["QueryExecutionId"]
+
+
+def _wait_for_queries(client: boto3.client, qids: dict[str, str]) -> dict[str, dict]:
+    """
+    Poll every submitted query from one loop until all have finished.
+    Returns {label: QueryExecution}. If any query fails, the ones still
+    running are cancelled and a RuntimeError is raised.
+    """
+    pending, finished = dict(qids), {}
+    delay = POLL_MIN_SEC
+    while pending:
+        for label, qid in list(pending.items()):
+            status = client.get_query_execution(QueryExecutionId=qid)
+            state  = status["QueryExecution"]["Status"]["State"]
+            if state == "SUCCEEDED":
+                finished[label] = status["QueryExecution"]
+                del pending[label]
+            elif state in ("FAILED", "CANCELLED"):
+                del pending[label]
+                for other_qid in pending.values():
+                    client.stop_query_execution(QueryExecutionId=other_qid)
+                reason = status["QueryExecution"]["Status"].get("StateChangeReason", "")
+                raise RuntimeError(f"Athena {label!r} {state}: {reason}")
+        if pending:
+            time.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, POLL_MAX_SEC)
+    return finished
+
+
+def _cache_dir() -> Path | None:
+    """Cache directory, or None when the cache is disabled for this process."""
+    enabled   = os.getenv("ML_QUERY_CACHE", "").strip().lower() in ("1", "true", "yes")
+    local_dir = os.getenv("ML_LOCAL_ARTIFACT_DIR", "").strip()
+    if not (enabled and local_dir):
+        return None
+    return Path(local_dir) / CACHE_DIR_NAME
+
+
+def _mart_version(table: str) -> str | None:
+    """
+    Version token for one mart table: newest LastModified and object count
+    under its Glue storage location. None if the table cannot be versioned.
+    """
+    if table not in _MART_VERSIONS:
+        try:
+            location = get_glue_client().get_table(
+                DatabaseName=DATABASE, Name=table,
+            )["Table"]["StorageDescriptor"]["Location"]
+            bucket, prefix = _split_s3_uri(location)
+            newest, count = "", 0
+            for page in get_s3_client().get_paginator("list_objects_v2").paginate(
+                    Bucket=bucket, Prefix=prefix.rstrip("/") + "/"):
+                for obj in page.get("Contents", []):
+                    newest = max(newest, obj["LastModified"].isoformat())
+                    count += 1
+            _MART_VERSIONS[table] = f"{table}@{newest}#{count}" if count else None
+        except (ClientError, KeyError) as exc:
+            print(f"  [cache] cannot version {table}: {exc}")
+            _MART_VERSIONS[table] = None
+    return _MART_VERSIONS[table]
+
+
+def _cache_key(sql: str, database: str, catalog: str | None = None) -> str | None:
+    """sha256 of normalised SQL + database + mart versions, or None if uncacheable."""
+    tables = sorted({t.lower() for t in _MART_TABLE_RE.findall(sql)})
+    versions = [_mart_version(t) for t in tables]
+    if not tables or None in versions:
+        return None
+    normalised = " ".join(sql.split()).rstrip(";")
+    payload = "\n".join([normalised, database, catalog or "", *versions])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cache_get(cache_dir: Path, key: str) -> pd.DataFrame | None:
+    path = cache_dir / f"{key}.parquet"
+    if not path.exists():
+        return None
+    if time.time() - path.stat().st_mtime > CACHE_TTL_SEC:
+        path.unlink(missing_ok=True)
+        return None
+    df = pd.read_parquet(path)
+    os.utime(path)  # refresh for LRU eviction
+    return df
+
+
+def _cache_put(cache_dir: Path, key: str, df: pd.DataFrame) -> None:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp = cache_dir / f"{key}.parquet.tmp"
+    df.to_parquet(tmp, index=False)
+    tmp.replace(cache_dir / f"{key}.parquet")
+    _cache_evict(cache_dir)
+
+
+def _cache_evict(cache_dir: Path) -> None:
+    """Drop expired entries, then the least recently used until under CACHE_MAX_BYTES."""
+    now = time.time()
+    entries = []
+    for path in cache_dir.glob("*.parquet"):
+        stat = path.stat()
+        if now - stat.st_mtime > CACHE_TTL_SEC:
+            path.unlink(missing_ok=True)
+        else:
+            entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def record_query_stats(label: str, execution: dict, result_rows: int,
+                       wall_sec: float, cache_hit: bool = False) -> dict:
+    """Append one query's execution statistics to QUERY_STATS and return the record."""
+    stats = execution.get("Statistics", {})
+    record = {
+        "label":               label,
+        "query_execution_id":  execution.get("QueryExecutionId"),
+        "engine_execution_ms": stats.get("EngineExecutionTimeInMillis"),
+        "queue_ms":            stats.get("QueryQueueTimeInMillis"),
+        "total_execution_ms":  stats.get("TotalExecutionTimeInMillis"),
+        "data_scanned_bytes":  stats.get("DataScannedInBytes"),
+        "result_rows":         result_rows,
+        "wall_sec":            round(wall_sec, 3),
+        "cache_hit":           cache_hit,
+    }
+    QUERY_STATS.append(record)
+    return record
+
+
+def _format_stats(record: dict) -> str:
+    if record.get("cache_hit"):
+        return f"{record['result_rows']:,} rows  cache hit  wall={record['wall_sec']:.1f}s"
+    engine_sec = (record["engine_execution_ms"] or 0) / 1000
+    queue_sec  = (record["queue_ms"] or 0) / 1000
+    scanned_mb = (record["data_scanned_bytes"] or 0) / 1024 ** 2
+    return (f"{record['result_rows']:,} rows  engine={engine_sec:.1f}s  "
+            f"queue={queue_sec:.1f}s  scanned={scanned_mb:.1f} MB  "
+            f"wall={record['wall_sec']:.1f}s")
+
+
+def dump_query_stats(path: str | Path | None = None) -> str:
+    """
+    Serialise QUERY_STATS, with totals, to JSON. Writes the JSON to `path`
+    when given and always returns it.
+    """
+    totals = {
+        "queries":             len(QUERY_STATS),
+        "engine_execution_ms": sum(r["engine_execution_ms"] or 0 for r in QUERY_STATS),
+        "queue_ms":            sum(r["queue_ms"] or 0 for r in QUERY_STATS),
+        "data_scanned_bytes":  sum(r["data_scanned_bytes"] or 0 for r in QUERY_STATS),
+        "result_rows":         sum(r["result_rows"] for r in QUERY_STATS),
+        "cache_hits":          sum(bool(r.get("cache_hit")) for r in QUERY_STATS),
+    }
+    text = json.dumps({"totals": totals, "queries": QUERY_STATS}, indent=2, default=str)
+    if path is not None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(text, encoding="utf-8")
+    return text
+
+
+def run_queries(queries: dict[str, str], client: boto3.client = None,
+                fetch: str = FETCH_MODE, database: str = DATABASE,
+                workgroup: str = WORKGROUP, catalog: str | None = None,
+                unload: Collection[str] = (),
+                unload_prefix: str = UNLOAD_PREFIX) -> dict[str, pd.DataFrame]:
+    """
+    Execute a batch of labelled queries concurrently.
+
+    All queries are submitted up front, polled together, and their results
+    fetched in parallel, so a stage waits for its slowest query rather than
+    the sum of all of them. Queries answered by the result cache are not
+    sent to Athena. Labels listed in `unload` run as UNLOAD to Parquet under
+    s3://BUCKET/<unload_prefix>/ instead of a CSV result (see unload_query).
+    Returns {label: typed DataFrame}.
+    """
+    for label in queries:
+        print(f"  [athena] {label}")
+    if BACKEND == "duckdb":
+        return _run_duckdb(queries)
+
+    started = time.monotonic()
+    results, cache_keys = {}, {}
+    cache_dir = _cache_dir()
+    if cache_dir is not None:
+        for label, sql in queries.items():
+            cache_keys[label] = _cache_key(sql, database, catalog)
+            cached = _cache_get(cache_dir, cache_keys[label]) if cache_keys[label] else None
+            if cached is not None:
+                results[label] = cached
+                record = record_query_stats(label, {}, len(cached),
+                                            time.monotonic() - started, cache_hit=True)
+                print(f"         {label}: {_format_stats(record)}")
+
+    pending = {label: sql for label, sql in queries.items() if label not in results}
+    if not pending:
+        return {label: results[label] for label in queries}
+
+    unloads = {}
+    for label in pending.keys() & set(unload):
+        location = f"s3://{BUCKET}/{unload_prefix.strip('/')}/{uuid.uuid4().hex}/"
+        pending[label], sort = _unload_sql(pending[label], location)
+        unloads[label] = (location, sort)
+
+    if client is None:
+        client = get_athena_client()
+    qids = {
+        label: _start_query(client, sql, database, workgroup, catalog)
+        for label, sql in pending.items()
+    }
+    try:
+        executions = _wait_for_queries(client, qids)
+    except BaseException:
+        # A failed or cancelled UNLOAD can leave partial files behind.
+        for location, _ in unloads.values():
+            _delete_unloaded(location)
+        raise
+
+    with ThreadPoolExecutor(max_workers=len(qids)) as pool:
+        futures = {
+            label: (pool.submit(_fetch_unloaded, client, qid, *unloads[label]) if label in unloads else
+                    pool.submit(_fetch_results, client, qid, executions[label], fetch))
+            for label, qid in qids.items()
+        }
+        fetched = {label: future.result() for label, future in futures.items()}
+
+    wall_sec = time.monotonic() - started
+    for label, df in fetched.items():
+        record = record_query_stats(label, executions[label], len(df), wall_sec)
+        print(f"         {label}: {_format_stats(record)}")
+        if cache_keys.get(label):
+            _cache_put(cache_dir, cache_keys[label], df)
+    results.update(fetched)
+    return {label: results[label] for label in queries}
+
+
+def unload_query(sql: str, prefix: str = UNLOAD_PREFIX, label: str = "unload",
+                 client: boto3.client = None, database: str = DATABASE,
+                 workgroup: str = WORKGROUP, catalog: str | None = None) -> pd.DataFrame:
+    """
+    Run a large SELECT as UNLOAD to Parquet under s3://BUCKET/<prefix>/ and
+    read the files Athena wrote in parallel with pyarrow. This skips the CSV
+    result and its string decode entirely, which matters for multi-million
+    row extracts. The Parquet files are deleted after reading. Returns the
+    same typed DataFrame run_query would.
+    """
+    return run_queries({label: sql}, client, database=database, workgroup=workgroup,
+                       catalog=catalog, unload=[label], unload_prefix=prefix)[label]
+
+
+def iter_query(sql: str, chunk_rows: int = ITER_CHUNK_ROWS, label: str = "",
+               as_arrow: bool = False, client: boto3.client = None,
+               fetch: str = FETCH_MODE, database: str = DATABASE,
+               workgroup: str = WORKGROUP,
+               catalog: str | None = None) -> Iterator[pd.DataFrame | pa.RecordBatch]:
+    """
+    Execute SQL and yield the result in chunks of about chunk_rows rows, as
+    typed DataFrames or, with as_arrow=True, Arrow RecordBatches. Only one
+    chunk is held at a time, so peak memory is bounded by chunk_rows rather
+    than the result size. Every chunk has the same schema: ints and booleans
+    are always nullable and strings are never converted to category (see
+    _decode_column). Stats are recorded once the iterator is exhausted; the
+    result cache is not used.
+    """
+    if label:
+        print(f"  [athena] {label} (streaming)")
+
+    started = time.monotonic()
+    if BACKEND == "duckdb":
+        cursor = _duckdb_connection().cursor()
+        reader = cursor.execute(_to_duckdb_sql(sql)).fetch_record_batch(chunk_rows)
+        chunks = (_arrow_to_pandas(pa.Table.from_batches([batch]), streaming=True)
+                  for batch in reader)
+        execution = {}
+    else:
+        if client is None:
+            client = get_athena_client()
+        qid = _start_query(client, sql, database, workgroup, catalog)
+        execution = _wait_for_queries(client, {label: qid})[label]
+        chunks = _iter_results(client, qid, execution, fetch, chunk_rows)
+
+    n_rows = 0
+    for df in chunks:
+        n_rows += len(df)
+        yield pa.RecordBatch.from_pandas(df, preserve_index=False) if as_arrow else df
+
+    wall_sec = time.monotonic() - started
+    if BACKEND == "duckdb":
+        execution = {"Statistics": {"EngineExecutionTimeInMillis": int(wall_sec * 1000)}}
+    record = record_query_stats(label, execution, n_rows, wall_sec)
+    if label:
+        print(f"         {_format_stats(record)}")
+
+
+def run_query(sql: str, label: str = "", client: boto3.client = None,
+              fetch: str = FETCH_MODE, database: str = DATABASE,
+              workgroup: str = WORKGROUP, catalog: str | None = None) -> pd.DataFrame:
+    """Execute SQL on Athena, block until done, return a typed DataFrame."""
+    if label:
+        print(f"  [athena] {label}")
+    if BACKEND == "duckdb":
+        return _run_duckdb({label: sql})[label]
+
+    started = time.monotonic()
+    cache_dir = _cache_dir()
+    key = _cache_key(sql, database, catalog) if cache_dir is not None else None
+    if key:
+        cached = _cache_get(cache_dir, key)
+        if cached is not None:
+            record = record_query_stats(label, {}, len(cached),
+                                        time.monotonic() - started, cache_hit=True)
+            if label:
+                print(f"         {_format_stats(record)}")
+            return cached
+
+    if client is None:
+        client = get_athena_client()
+    qid = _start_query(client, sql, database, workgroup, catalog)
+    execution = _wait_for_queries(client, {label: qid})[label]
 
-    df = pd.DataFrame(rows, columns=header)
+    df = _fetch_results(client, qid, execution, fetch)
+    record = record_query_stats(label, execution, len(df), time.monotonic() - started)
     if label:
-        print(f"         {len(df):,} rows")
+        print(f"         {_format_stats(record)}")
+    if key:
+        _cache_put(cache_dir, key, df)
     return df
@@ -26,8 +26,8 @@ from pathlib import Path
 from athena_client import get_s3_client, BUCKET
 from train import (
     FEATURE_COLS, CATEGORICAL_COLS, N_HORIZONS, MODEL_VERSION,
-    MODEL_S3_PREFIX, FEATURES_S3_KEY, FOLDS,
-    wape, rmse, bias, fva, make_lgb_dataset,
+    MODEL_S3_PREFIX, FOLDS,
+    wape, rmse, bias, fva, make_lgb_dataset, load_features,
 )
 
 warnings.filterwarnings("ignore")
@@ -37,13 +37,11 @@ ML_LOCAL_ARTIFACT_DIR = os.getenv("ML_LOCAL_ARTIFACT_DIR", "").strip()
 if ML_LOCAL_ARTIFACT_DIR:
     LOCAL_MODEL_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / f"demand_forecast_lgbm_{MODEL_VERSION}.pkl"
     LOCAL_METADATA_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / f"demand_forecast_lgbm_{MODEL_VERSION}_metadata.json"
-    LOCAL_FEATURES_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_features.parquet"
     LOCAL_FORECASTS_DIR = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_forecasts"
     LOCAL_REPORTS_DIR = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_evaluation"
 else:
     LOCAL_MODEL_PATH = None
     LOCAL_METADATA_PATH = None
-    LOCAL_FEATURES_PATH = None
     LOCAL_FORECASTS_DIR = None
     LOCAL_REPORTS_DIR = None
 
@@ -89,21 +87,6 @@ def load_metadata() -> dict:
     return json.loads(obj["Body"].read())
 
 
-def load_features() -> pd.DataFrame:
-    if LOCAL_FEATURES_PATH is not None and LOCAL_FEATURES_PATH.exists():
-        print(f"  Loading features from local file: {LOCAL_FEATURES_PATH}")
-        df = pd.read_parquet(LOCAL_FEATURES_PATH)
-    else:
-        s3 = get_s3_client()
-        obj = s3.get_object(Bucket=BUCKET, Key=FEATURES_S3_KEY)
-        df = pd.read_parquet(io.BytesIO(obj["Body"].read()))
-    df["date"] = pd.to_datetime(df["date"])
-    for col in FEATURE_COLS:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
-    return df
-
-
 # ---------------------------------------------------------------------------
 # Walk-forward evaluation
 # ---------------------------------------------------------------------------
@@ -221,7 +204,7 @@ def segment_error_analysis(models: dict, df: pd.DataFrame,
         if seg_col not in val_df.columns:
             continue
         seg_results = {}
-        for seg_val, grp in val_df.groupby(seg_col):
+        for seg_val, grp in val_df.groupby(seg_col, observed=True):
             a, p = grp["target"].values, grp["pred"].values
             seg_results[str(seg_val)] = {
                 "wape": wape(a, p),
@@ -333,8 +316,6 @@ def generate_forecasts(models: dict, df: pd.DataFrame) -> pd.DataFrame:
     # For inference we only need the feature columns, not a valid target.
     # Drop rows missing any feature (lag_28 is the strictest requirement).
     infer_clean = infer_rows.dropna(subset=FEATURE_COLS).copy()
-    for col in CATEGORICAL_COLS:
-        infer_clean[col] = infer_clean[col].astype("category")
 
     records = []
     for h in range(1, N_HORIZONS + 1):
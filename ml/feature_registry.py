@@ -0,0 +1,136 @@
+"""
+ml/feature_registry.py
+======================
+Declarations of the model features.
+
+Each feature is declared once, as a Feature entry in FEATURES, in model
+column order. train.py's FEATURE_COLS is generated from it, so a feature
+added here reaches training, evaluation and recommendations without
+editing a second list.
+
+Per-series features (stage "demand") are computed by the planner in
+features.py (_compute_registered). Each declares a transform of a source
+column or of another declared feature:
+
+    lag / lead        grouped shift by `window` rows (lead shifts backwards)
+    roll_<stat>       grouped rolling mean / std / min / max over `window`
+                      rows with `min_periods`
+    ewm_mean          grouped adjusted EWM mean with span `window`
+    trend             OLS slope over `window` rows (_rolling_trend_slope)
+    expr              fn(*inputs), row-wise over columns or features
+
+The SQL engine (sql_features.py) compiles the same declarations into
+window functions. Only expr needs a second form: `sql`, the expression
+with each input written as a {name} placeholder. Every expr feature must
+declare it; the module raises at import otherwise.
+
+The planner builds each shared intermediate once: one shifted series per
+(source, shift), one grouped rolling window per (source, window,
+min_periods) feeding every statistic over it, one EWM per span. So lag_1,
+the 12 rolling statistics and the EWMs all read the same shifted series.
+INTERMEDIATES are declared the same way but are only computed when a
+feature depends on them, and are not written out.
+
+Features of the other stages (context, inventory, supplier, cross_store)
+are produced by their own builders in features.py and are declared here
+only for their place in FEATURE_COLS.
+"""
+
+from typing import Callable, NamedTuple
+
+import numpy as np
+
+# Look-back windows, shared by the pandas and SQL engines (sql_features.py).
+# Every rolling feature covers the rows before the current one.
+LAGS                  = [1, 7, 14, 28]
+ROLL_WINDOWS          = [7, 14, 28]     # min_periods = max(1, w // 2)
+ROLL_STATS            = ["mean", "std", "min", "max"]
+EWM_SPANS             = [7, 14]
+EWM_MIN_PERIODS       = 3
+TREND_WINDOW          = 14
+TREND_MIN_PERIODS     = 5
+PRICE_AVG_WINDOW      = 30
+PRICE_AVG_MIN_PERIODS = 7
+
+
+class Feature(NamedTuple):
+    name: str
+    transform: str = "input"           # "input": produced by another stage
+    source: str | None = None          # column or feature the transform reads
+    window: int | None = None          # shift rows / rolling rows / EWM span
+    min_periods: int | None = None
+    fill: float | None = None          # replaces NaN in the result
+    inputs: tuple[str, ...] = ()       # expr arguments
+    fn: Callable | None = None         # expr
+    sql: str | None = None             # expr, for sql_features.py
+    stage: str = "demand"              # demand, context, inventory, supplier, cross_store
+    model: bool = True                 # part of FEATURE_COLS
+
+
+INTERMEDIATES = [
+    Feature("prev_price", "lag", "unit_price", 1),
+    Feature("price_avg_30d", "roll_mean", "prev_price", PRICE_AVG_WINDOW, PRICE_AVG_MIN_PERIODS),
+]
+
+FEATURES = [
+    # --- lag features ---
+    *[Feature(f"lag_{lag}", "lag", "quantity_sold", lag) for lag in LAGS],
+
+    # --- rolling statistics (std is 0 below min_periods, as before) ---
+    *[Feature(f"roll_{stat}_{w}", f"roll_{stat}", "lag_1", w, max(1, w // 2),
+              fill=0.0 if stat == "std" else None)
+      for w in ROLL_WINDOWS for stat in ROLL_STATS],
+
+    # --- exponentially weighted mean ---
+    *[Feature(f"ewm_mean_{span}", "ewm_mean", "lag_1", span, EWM_MIN_PERIODS)
+      for span in EWM_SPANS],
+
+    # --- demand trend: OLS slope over trailing 14 days ---
+    Feature("demand_trend_14d", "trend", "lag_1", TREND_WINDOW, TREND_MIN_PERIODS),
+
+    # --- promotion / price features ---
+    Feature("has_discount", "expr", inputs=("discount_amount",),
+            fn=lambda discount: (discount > 0).astype(int),
+            sql="CASE WHEN {discount_amount} > 0 THEN 1 ELSE 0 END"),
+    Feature("discount_pct", "expr", inputs=("discount_amount", "unit_price", "quantity_sold"),
+            fn=lambda discount, price, qty:
+                (discount / (price * qty).replace(0, np.nan)).fillna(0).clip(0, 1),
+            sql="LEAST(GREATEST(COALESCE({discount_amount}"
+                " / NULLIF({unit_price} * {quantity_sold}, 0), 0), 0), 1)"),
+    Feature("price_vs_30d_avg", "expr", inputs=("unit_price", "price_avg_30d"),
+            fn=lambda price, avg: (price / avg).fillna(1.0),
+            sql="COALESCE({unit_price} / {price_avg_30d}, 1.0)"),
+
+    # --- calendar: days since month start (pay-cycle proxy) ---
+    Feature("days_since_period_start", "expr", inputs=("day_of_month",), fn=lambda day: day - 1,
+            sql="{day_of_month} - 1"),
+    Feature("day_of_week", stage="context"),
+    Feature("month_of_year", stage="context"),
+    Feature("is_weekend", stage="context"),
+
+    # --- inventory (build_inventory_features) ---
+    Feature("quantity_on_hand", stage="inventory"),
+    Feature("quantity_on_order", stage="inventory"),
+    Feature("reorder_point", stage="inventory"),
+    Feature("needs_reorder", stage="inventory"),
+    Feature("stockout_freq_14d", stage="inventory"),
+    Feature("days_of_stock_remaining", stage="inventory"),
+
+    # --- supplier (static per product) ---
+    Feature("avg_actual_lead_time_days", stage="supplier"),
+    Feature("calculated_on_time_rate", stage="supplier"),
+    Feature("avg_fill_rate", stage="supplier"),
+
+    # --- cross-store (CROSS_SECTIONAL_FEATURES) ---
+    Feature("region_avg_demand_7d", stage="cross_store"),
+
+    # --- target: next-day demand (shifted back by 1) ---
+    Feature("target", "lead", "quantity_sold", 1, model=False),
+]
+
+FEATURE_COLS    = [f.name for f in FEATURES if f.model]
+DEMAND_FEATURES = [f for f in FEATURES if f.stage == "demand"]
+
+_missing_sql = [f.name for f in INTERMEDIATES + FEATURES if f.transform == "expr" and f.sql is None]
+if _missing_sql:
+    raise ValueError(f"expr features without a sql form: {', '.join(_missing_sql)}")
@@ -0,0 +1,486 @@
+"""
+ml/feature_store.py
+===================
+Partitioned storage for the feature matrix built by features.py.
+
+The matrix is written as a Hive-partitioned Parquet dataset:
+
+    s3://retailops-data-lake-{region}/ml/features/dataset/
+        _CURRENT.json
+        versions/<write token>/month=YYYY-MM/store_bucket=N/part-0.parquet
+or  <ML_LOCAL_ARTIFACT_DIR>/ml_features/...
+
+Each write goes to a new versions/<write token>/ directory, and
+_CURRENT.json, which names the version readers use, is replaced only once
+every file is written (one PUT on S3, a rename locally). A crashed or
+in-progress write is therefore never visible: readers keep seeing the
+previous matrix. The previous version is kept for readers that opened it
+just before the swap, and older ones are deleted. A dataset directory
+without _CURRENT.json is treated as not written.
+
+update_features() writes a version that differs from the current one by a
+set of upserted rows and patched columns. Only the month / store_bucket
+files those rows fall into are read and rewritten; the others are copied
+into the new version as they are (a server-side copy on S3). Incremental
+runs of features.py use it, so their cost follows the new dates rather
+than the size of the matrix.
+
+Rows inside each file are ordered by date, and every row group carries
+min/max statistics, so a date filter skips whole months by partition and
+whole row groups inside the remaining files. store_bucket spreads the stores
+of a month over STORE_BUCKETS files; it is a stable hash of store_id, so a
+store always lands in the same bucket.
+
+Columns are stored with the compact dtypes in FEATURE_SCHEMA: float32 for
+continuous values, int8 / bool for flags and small calendar integers, and
+categoricals for the string keys, which Parquet keeps dictionary-encoded and
+which come back as pandas categories. apply_feature_schema() is the one place
+those casts happen, so the stages that load the matrix only fill NULLs.
+
+Readers go through read_features(), which pushes the date range and column
+list down to pyarrow.dataset and returns rows ordered by
+store_id, product_id, date, the same order features.py writes them in.
+A store written by an older run as the single features.parquet object is
+still read (with the same filters) until the next features.py run replaces it.
+
+When ML_FEATURE_CACHE_PATH is set, write_features() also leaves the matrix
+in that local, uncompressed Arrow IPC file, tagged with the write token of
+the version it wrote. read_features() and latest_feature_date() memory-map
+the file instead of reading the dataset again: the columns already have
+their final dtypes and floats keep NaN rather than nulls, so they come back
+without a copy and the stages share the OS page cache. The file is only
+used while its token is the one _CURRENT.json names, so a rebuild, another
+sample, or another writer makes it stale and readers go back to the
+dataset. run_pipeline.py points ML_FEATURE_CACHE_PATH into a temporary
+directory of its own for each run and removes it afterwards.
+"""
+
+import json
+import os
+import posixpath
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import fs
+
+from athena_client import get_session, BUCKET, REGION
+
+FEATURES_DATASET_PREFIX = "ml/features/dataset"
+MANIFEST_NAME           = "_CURRENT.json"
+VERSIONS_DIR            = "versions"
+LEGACY_FEATURES_S3_KEY  = "ml/features/features.parquet"
+PARTITION_COLS          = ["month", "store_bucket"]
+STORE_BUCKETS           = 8
+ROW_GROUP_ROWS          = 50_000
+WRITE_WORKERS           = 8
+
+ML_LOCAL_ARTIFACT_DIR = os.getenv("ML_LOCAL_ARTIFACT_DIR", "").strip()
+if ML_LOCAL_ARTIFACT_DIR:
+    LOCAL_FEATURES_DIR         = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_features"
+    LOCAL_LEGACY_FEATURES_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_features.parquet"
+else:
+    LOCAL_FEATURES_DIR         = None
+    LOCAL_LEGACY_FEATURES_PATH = None
+
+SORT_KEYS = ["store_id", "product_id", "date"]
+
+CATEGORY_COLS = ["store_id", "product_id", "region", "store_type", "category", "supplier_id"]
+FLAG_COLS     = ["has_discount", "needs_reorder"]
+INT8_COLS     = ["day_of_week", "month_of_year", "day_of_month", "days_since_period_start"]
+BOOL_COLS     = ["is_weekend"]
+
+# Column -> dtype for everything that is not float32. Any other numeric column
+# (lags, rolling stats, inventory, supplier metrics, target) is float32.
+FEATURE_SCHEMA = {
+    "date": "datetime64[ns]",
+    **{col: "category" for col in CATEGORY_COLS},
+    **{col: "int8" for col in FLAG_COLS + INT8_COLS},
+    **{col: "bool" for col in BOOL_COLS},
+}
+
+
+def _filesystem() -> tuple[fs.FileSystem, str, str]:
+    """(filesystem, dataset root, legacy single-file path) for this run."""
+    if LOCAL_FEATURES_DIR is not None:
+        return (fs.LocalFileSystem(), LOCAL_FEATURES_DIR.resolve().as_posix(),
+                LOCAL_LEGACY_FEATURES_PATH.resolve().as_posix())
+    # Reuse the credentials of the shared boto3 session rather than letting
+    # the AWS C++ SDK resolve its own.
+    creds = get_session().get_credentials().get_frozen_credentials()
+    s3 = fs.S3FileSystem(access_key=creds.access_key, secret_key=creds.secret_key,
+                         session_token=creds.token, region=REGION)
+    return s3, f"{BUCKET}/{FEATURES_DATASET_PREFIX}", f"{BUCKET}/{LEGACY_FEATURES_S3_KEY}"
+
+
+def _exists(filesystem: fs.FileSystem, path: str) -> bool:
+    return filesystem.get_file_info(path).type != fs.FileType.NotFound
+
+
+def _store_bucket(store_id: pd.Series) -> pd.Series:
+    """Stable store_id -> bucket mapping (the pandas hash is seeded with a fixed key)."""
+    hashes = pd.util.hash_pandas_object(store_id.astype(str), index=False)
+    return (hashes % STORE_BUCKETS).astype("int64")
+
+
+def apply_feature_schema(features: pd.DataFrame) -> pd.DataFrame:
+    """Cast `features` to FEATURE_SCHEMA. Flags with no inventory row become 0."""
+    casts = {}
+    for col in features.columns:
+        dtype = FEATURE_SCHEMA.get(col)
+        if dtype is None and pd.api.types.is_numeric_dtype(features[col]) \
+                and not pd.api.types.is_bool_dtype(features[col]):
+            dtype = "float32"
+        if dtype is not None and features[col].dtype != dtype:
+            casts[col] = dtype
+    flags = [col for col in FLAG_COLS if col in casts]
+    if flags:
+        features = features.fillna({col: 0 for col in flags})
+    return features.astype(casts) if casts else features
+
+
+def describe_location() -> str:
+    if LOCAL_FEATURES_DIR is not None:
+        return str(LOCAL_FEATURES_DIR)
+    return f"s3://{BUCKET}/{FEATURES_DATASET_PREFIX}/"
+
+
+def _cache_path() -> Path | None:
+    """ML_FEATURE_CACHE_PATH, read per call so run_pipeline.py can set it per run."""
+    path = os.environ.get("ML_FEATURE_CACHE_PATH", "").strip()
+    return Path(path) if path else None
+
+
+def _write_cache(features: pd.DataFrame, path: Path, version: str) -> None:
+    """Write `features` (schema applied, SORT_KEYS order) to `path`, tagged with `version`."""
+    arrays = {
+        # pa.array on a float ndarray keeps NaN as a value, so the column
+        # needs no validity bitmap and converts back to pandas without a copy.
+        col: pa.array(features[col].to_numpy()) if pd.api.types.is_float_dtype(features[col])
+        else pa.Array.from_pandas(features[col])
+        for col in features.columns
+    }
+    table = pa.table(arrays).replace_schema_metadata({"version": version})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with pa.OSFile(str(tmp), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=len(table) or None)
+    tmp.replace(path)
+    print(f"     Feature cache: {path}")
+
+
+def _open_cache() -> pa.Table | None:
+    """The memory-mapped cache of the stored version, or None."""
+    path = _cache_path()
+    if path is None or not path.exists():
+        return None
+    reader = pa.ipc.open_file(pa.memory_map(str(path), "r"))
+    metadata = reader.schema.metadata or {}
+    version = current_version()
+    if version is None or metadata.get(b"version", b"").decode() != version:
+        return None
+    return reader.read_all()
+
+
+def _read_manifest(filesystem: fs.FileSystem, root: str) -> dict | None:
+    """The _CURRENT.json of the dataset at `root`, or None if there is none."""
+    path = posixpath.join(root, MANIFEST_NAME)
+    if not _exists(filesystem, path):
+        return None
+    with filesystem.open_input_stream(path) as stream:
+        return json.loads(stream.read())
+
+
+def _write_manifest(filesystem: fs.FileSystem, root: str, manifest: dict) -> None:
+    """Point readers at a new version; atomic on S3 (one PUT) and locally (rename)."""
+    path = posixpath.join(root, MANIFEST_NAME)
+    body = json.dumps(manifest, indent=2).encode()
+    if isinstance(filesystem, fs.LocalFileSystem):
+        tmp = f"{path}.tmp"
+        with filesystem.open_output_stream(tmp) as sink:
+            sink.write(body)
+        filesystem.move(tmp, path)
+    else:
+        with filesystem.open_output_stream(path) as sink:
+            sink.write(body)
+
+
+def _delete_stale(filesystem: fs.FileSystem, root: str, keep: set[str]) -> None:
+    """Remove versions not in `keep`, and any files of the older unversioned layout."""
+    for info in filesystem.get_file_info(fs.FileSelector(root)):
+        if info.base_name in (MANIFEST_NAME, VERSIONS_DIR):
+            continue
+        if info.type == fs.FileType.Directory:
+            filesystem.delete_dir(info.path)
+        else:
+            filesystem.delete_file(info.path)
+    versions = posixpath.join(root, VERSIONS_DIR)
+    for info in filesystem.get_file_info(fs.FileSelector(versions, allow_not_found=True)):
+        if info.base_name not in keep:
+            filesystem.delete_dir(info.path)
+
+
+def current_version() -> str | None:
+    """Write token of the stored matrix, or None when no dataset is stored."""
+    filesystem, root, _ = _filesystem()
+    manifest = _read_manifest(filesystem, root)
+    return None if manifest is None else manifest["version"]
+
+
+def _new_version() -> str:
+    return f"{pd.Timestamp.now(tz='UTC'):%Y%m%dT%H%M%SZ}-{uuid.uuid4().hex[:8]}"
+
+
+def _partition_path(version_root: str, month: str, bucket) -> str:
+    return posixpath.join(version_root, f"month={month}", f"store_bucket={bucket}", "part-0.parquet")
+
+
+def _partition_keys(features: pd.DataFrame) -> pd.DataFrame:
+    """month / store_bucket / date of each row, for grouping rows into partition files."""
+    dates = pd.to_datetime(features["date"])
+    return pd.DataFrame({
+        "month":        dates.dt.strftime("%Y-%m").to_numpy(),
+        "store_bucket": _store_bucket(features["store_id"]).to_numpy(),
+        "date":         dates.to_numpy(),
+    })
+
+
+def _write_partition(filesystem: fs.FileSystem, path: str, table: pa.Table) -> None:
+    filesystem.create_dir(posixpath.dirname(path), recursive=True)
+    pq.write_table(table, path, filesystem=filesystem, row_group_size=ROW_GROUP_ROWS,
+                   write_statistics=True)
+
+
+def _swap_version(filesystem: fs.FileSystem, root: str, legacy: str, previous: dict | None,
+                  manifest: dict) -> None:
+    """Make `manifest` current, then drop all but it and the previous version."""
+    _write_manifest(filesystem, root, manifest)
+    _delete_stale(filesystem, root,
+                  {manifest["version"]} | ({previous["version"]} if previous else set()))
+    if _exists(filesystem, legacy):
+        filesystem.delete_file(legacy)
+
+
+def write_features(features: pd.DataFrame) -> str:
+    """Replace the stored feature matrix with `features`. Returns the new version token."""
+    features = apply_feature_schema(features)
+    filesystem, root, legacy = _filesystem()
+    order = _partition_keys(features).sort_values(["month", "store_bucket", "date"], kind="stable")
+
+    # One Arrow table for the whole frame, so every file shares its schema
+    # (including the dictionaries of categorical columns).
+    table = pa.Table.from_pandas(features, preserve_index=False)
+    parts = [(month, bucket, idx.to_numpy())
+             for (month, bucket), idx in order.groupby(["month", "store_bucket"], sort=True).groups.items()]
+
+    previous = _read_manifest(filesystem, root)
+    version  = _new_version()
+    version_root = posixpath.join(root, VERSIONS_DIR, version)
+
+    def write_part(part) -> None:
+        month, bucket, rows = part
+        _write_partition(filesystem, _partition_path(version_root, month, bucket), table.take(rows))
+
+    filesystem.create_dir(version_root, recursive=True)
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+        list(pool.map(write_part, parts))
+
+    _swap_version(filesystem, root, legacy, previous,
+                  {"version": version, "rows": len(features), "partitions": len(parts)})
+    print(f"     Feature store: {len(features):,} rows in {len(parts)} partitions "
+          f"-> {describe_location()} (version {version})")
+
+    cache_path = _cache_path()
+    if cache_path is not None:
+        _write_cache(features.sort_values(SORT_KEYS, kind="stable", ignore_index=True),
+                     cache_path, version)
+    return version
+
+
+def update_features(rows: pd.DataFrame, patches: pd.DataFrame | None = None,
+                    refresh: Callable[[pd.DataFrame], pd.DataFrame] | None = None) -> str:
+    """
+    Write a new version of the stored matrix that differs from the current
+    one by `rows` and `patches`, and return its token.
+
+    `rows` are upserted: they replace stored rows with the same store_id,
+    product_id and date, or are added. `patches` holds the SORT_KEYS plus
+    the columns to overwrite in existing rows. Only the partition files
+    those rows fall into are read and rewritten; every other file is copied
+    into the new version unchanged (a server-side copy on S3), so the cost
+    follows the size of the change, not of the matrix. `refresh`, if given,
+    is applied to every partition, which makes every file a rewrite.
+
+    Raises FileNotFoundError when no versioned matrix is stored. The
+    per-run cache is not written; readers of this version use the dataset.
+    """
+    filesystem, root, legacy = _filesystem()
+    previous = _read_manifest(filesystem, root)
+    stored = {}
+    if previous is not None:
+        base_root = posixpath.join(root, VERSIONS_DIR, previous["version"])
+        for info in filesystem.get_file_info(fs.FileSelector(base_root, recursive=True)):
+            if info.type == fs.FileType.File and info.base_name.endswith(".parquet"):
+                parts = dict(part.split("=", 1) for part in info.path.split("/") if "=" in part)
+                stored[(parts["month"], int(parts["store_bucket"]))] = info.path
+    if not stored:
+        raise FileNotFoundError(f"no feature matrix at {describe_location()} to update")
+
+    def partitions_of(frame: pd.DataFrame) -> dict:
+        keys = _partition_keys(frame)
+        return {key: frame.iloc[idx] for key, idx in
+                keys.groupby(["month", "store_bucket"], sort=True).indices.items()}
+
+    # New rows take the stored column order; a missing column raises here.
+    columns = pq.read_schema(next(iter(stored.values())), filesystem=filesystem).names
+    rows = apply_feature_schema(rows[columns])
+    new_rows = partitions_of(rows)
+    new_patches = partitions_of(patches) if patches is not None else {}
+
+    version = _new_version()
+    version_root = posixpath.join(root, VERSIONS_DIR, version)
+
+    def update_part(key) -> int:
+        """Write partition `key` of the new version; returns the change in its row count."""
+        path = _partition_path(version_root, *key)
+        if key not in new_rows and key not in new_patches and refresh is None:
+            filesystem.create_dir(posixpath.dirname(path), recursive=True)
+            filesystem.copy_file(stored[key], path)
+            return 0
+        if key in stored:
+            before = apply_feature_schema(
+                pq.read_table(stored[key], filesystem=filesystem).to_pandas())
+        else:
+            before = rows.iloc[:0]
+        part = before
+        if key in new_patches:
+            patch = new_patches[key]
+            merged = part[SORT_KEYS].merge(patch, on=SORT_KEYS, how="left", indicator=True)
+            matched = (merged.pop("_merge") == "both").to_numpy()
+            for col in patch.columns.difference(SORT_KEYS):
+                part[col] = np.where(matched, merged[col].to_numpy(), part[col].to_numpy())
+        if key in new_rows:
+            added = new_rows[key]
+            replaced = part[SORT_KEYS].merge(added[SORT_KEYS], on=SORT_KEYS, how="left",
+                                             indicator=True)["_merge"] == "both"
+            part = pd.concat([part[~replaced.to_numpy()], added], ignore_index=True)
+        if refresh is not None:
+            part = refresh(part)
+        part = apply_feature_schema(part[columns])
+        part = part.sort_values(["date", "store_id", "product_id"], kind="stable", ignore_index=True)
+        _write_partition(filesystem, path, pa.Table.from_pandas(part, preserve_index=False))
+        return len(part) - len(before)
+
+    keys = sorted(set(stored) | set(new_rows) | set(new_patches))
+    filesystem.create_dir(version_root, recursive=True)
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+        added = sum(pool.map(update_part, keys))
+    rewritten = len(set(new_rows) | set(new_patches)) if refresh is None else len(keys)
+
+    total = previous["rows"] + added
+    _swap_version(filesystem, root, legacy, previous,
+                  {"version": version, "rows": total, "partitions": len(keys)})
+    print(f"     Feature store: {len(rows):,} new rows, {rewritten} of {len(keys)} partitions "
+          f"rewritten, {total:,} rows -> {describe_location()} (version {version})")
+    return version
+
+
+def _date_filter(start, end, partitioned: bool) -> ds.Expression | None:
+    """Filter on date, plus the matching month partitions when there are any."""
+    conditions = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        conditions.append(ds.field("date") >= pa.scalar(start, pa.timestamp("ns")))
+        if partitioned:
+            conditions.append(ds.field("month") >= start.strftime("%Y-%m"))
+    if end is not None:
+        end = pd.Timestamp(end)
+        conditions.append(ds.field("date") <= pa.scalar(end, pa.timestamp("ns")))
+        if partitioned:
+            conditions.append(ds.field("month") <= end.strftime("%Y-%m"))
+    expr = None
+    for condition in conditions:
+        expr = condition if expr is None else expr & condition
+    return expr
+
+
+def _open_dataset() -> tuple[ds.Dataset, bool] | None:
+    """(dataset, partitioned) for the stored matrix, or None if nothing is stored."""
+    filesystem, root, legacy = _filesystem()
+    manifest = _read_manifest(filesystem, root)
+    if manifest is not None:
+        return ds.dataset(posixpath.join(root, VERSIONS_DIR, manifest["version"]),
+                          filesystem=filesystem, format="parquet", partitioning="hive"), True
+    if _exists(filesystem, legacy):
+        return ds.dataset(legacy, filesystem=filesystem, format="parquet"), False
+    return None
+
+
+def read_features(columns: list[str] | None = None,
+                  start=None, end=None) -> pd.DataFrame | None:
+    """
+    Feature rows with start <= date <= end (either bound optional), ordered
+    by store_id, product_id, date. Returns None when no matrix is stored.
+    `columns` restricts the columns read; the sort keys are always included.
+    """
+    cached = _open_cache()
+    if cached is not None:
+        if columns is not None:
+            cached = cached.select([c for c in dict.fromkeys(SORT_KEYS + list(columns))
+                                    if c in cached.schema.names])
+        expr = _date_filter(start, end, partitioned=False)
+        if expr is not None:
+            cached = cached.filter(expr)
+        return cached.to_pandas(split_blocks=True)
+
+    opened = _open_dataset()
+    if opened is None:
+        return None
+    dataset, partitioned = opened
+    stored = [name for name in dataset.schema.names if name not in PARTITION_COLS]
+    if columns is None:
+        columns = stored
+    else:
+        columns = [c for c in dict.fromkeys(SORT_KEYS + list(columns)) if c in stored]
+
+    table = dataset.to_table(columns=columns, filter=_date_filter(start, end, partitioned))
+    # A no-op for matrices written with the schema; casts older ones.
+    df = apply_feature_schema(table.to_pandas())
+    if partitioned:
+        # Files rewritten by update_features carry their own dictionaries,
+        # which the reader unions in file order; sort the categories so
+        # the keys sort by value.
+        for col in df.columns.intersection(CATEGORY_COLS):
+            if not df[col].cat.categories.is_monotonic_increasing:
+                df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+        df = df.sort_values(SORT_KEYS, ignore_index=True)
+    return df
+
+
+def latest_feature_date() -> pd.Timestamp | None:
+    """Newest date in the stored matrix, reading only the newest month."""
+    cached = _open_cache()
+    if cached is not None:
+        newest = pc.max(cached.column("date")).as_py()
+        return None if newest is None else pd.Timestamp(newest)
+    opened = _open_dataset()
+    if opened is None:
+        return None
+    dataset, partitioned = opened
+    expr = None
+    if partitioned:
+        months = [part.split("=", 1)[1] for fragment in dataset.get_fragments()
+                  for part in fragment.path.split("/") if part.startswith("month=")]
+        if not months:
+            return None
+        expr = ds.field("month") == max(months)
+    dates = dataset.to_table(columns=["date"], filter=expr).column("date")
+    newest = pc.max(dates).as_py()
+    return None if newest is None else pd.Timestamp(newest)
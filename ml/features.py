@@ -5,7 +5,8 @@ Feature engineering pipeline for demand forecasting.
 
 Reads from Athena mart tables (retailops database, retailops-primary workgroup).
 Produces one row per store × product × date with all features needed for training.
-Writes output to s3://retailops-data-lake-{region}/ml/features/features.parquet
+Writes output as a partitioned Parquet dataset under
+s3://retailops-data-lake-{region}/ml/features/dataset/ (see feature_store.py).
 
 Run:
     python ml/features.py
@@ -15,9 +16,14 @@ Design decisions
 - Minimum 30 days of sales history required per store-product pair.
   Pairs with fewer observations are excluded — a model trained on sparse
   history will produce unreliable lag features and misleading rolling stats.
-- All lag/rolling features are computed in pandas after pulling the full
-  sales history from Athena. Computing them in SQL would require complex
-  window functions and make the query fragile across Athena versions.
+- By default all lag/rolling features are computed in pandas after pulling
+  the full sales history from Athena. ML_FEATURE_ENGINE=sql instead runs one
+  generated window-function query (sql_features.py) that returns only the
+  finished feature rows; `python ml/sql_features.py --parity` checks it
+  against the pandas engine on a product sample. The SQL engine does not
+  save incremental state. demand_trend_14d uses a closed-form rolling OLS
+  slope; `python ml/features.py --trend-parity` checks it against the
+  per-window linregress definition.
 - Stockout frequency is computed from fct_inventory_snapshots, not inferred
   from zero-sales days. Zero sales can mean no demand OR stockout — the
   inventory flag disambiguates this, which matters for demand suppression.
@@ -25,33 +31,125 @@ Design decisions
   because it weights recent observations more heavily. On synthetic data with
   fixed multipliers the difference is small, but on real data with trend or
   regime changes EWM is substantially better.
+- With ML_FEATURES_INCREMENTAL=1 (run_pipeline.py --incremental), a run that
+  finds saved per-series state only pulls dates after the last build. The
+  state holds the trailing raw sales / inventory / region rows each feature
+  window needs and the EWM accumulators. The run adds feature rows for the
+  new dates and fills in the target of the previous inference rows,
+  rewriting only the feature store partitions they fall into
+  (feature_store.update_features); supplier columns are refreshed in every
+  partition only when the supplier metrics changed. The state records the
+  feature store version it belongs to, and a run that finds another version
+  stored rebuilds. Results match a full rebuild up to float rounding. A series newly reaching
+  MIN_HISTORY_DAYS, a missing state, or a sampled run falls back to a full
+  rebuild. State is only saved in incremental mode, by every full rebuild
+  and every incremental run, so a plain full build costs nothing extra.
+- ML_SAMPLE_FRACTION < 1 (run_pipeline.py --sample-frac) restricts every
+  query to a stable hash sample of products, or of store × product series
+  or products per category with ML_SAMPLE_STRATIFY (see sampling.py). The
+  same fraction always selects the same series.
+- The two large extracts (fct_daily_sales, fct_inventory_snapshots) run as
+  Athena UNLOAD to Parquet and are read back with pyarrow, which scales far
+  better than the CSV result path for full history. Set ML_ATHENA_UNLOAD=0
+  to use the regular result fetch instead.
+- With ML_FEATURE_WORKERS=N (run_pipeline.py --feature-workers N), a full
+  build shards sales and inventory by store_id and builds the demand and
+  inventory features of each shard in its own process. Shards are handed
+  over as Arrow IPC files that workers memory-map, not pickled frames. Every
+  demand / inventory feature is per store × product, so sharding by store
+  does not change them. The regional features need all stores, so they are
+  computed afterwards on the combined frame, which is put back into
+  (store_id, product_id, date) order first. The output is the same for any
+  worker count.
 """
 
+import argparse
 import io
+import json
+import multiprocessing
 import os
+import tempfile
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from botocore.exceptions import ClientError
 from scipy import stats as scipy_stats
 
-from athena_client import run_query, get_s3_client, BUCKET, REGION
+from athena_client import run_queries, get_s3_client, BUCKET, REGION
+from feature_registry import (
+    DEMAND_FEATURES, EWM_MIN_PERIODS, EWM_SPANS, INTERMEDIATES, LAGS, PRICE_AVG_MIN_PERIODS,
+    PRICE_AVG_WINDOW, ROLL_WINDOWS, TREND_MIN_PERIODS, TREND_WINDOW, Feature,
+)
+from feature_store import apply_feature_schema, current_version, update_features, write_features
+from sampling import apply_sample, describe_sample, is_sampled, sample_predicate
 
 MIN_HISTORY_DAYS = 30
-FEATURES_S3_KEY  = "ml/features/features.parquet"
-ML_SAMPLE_FRACTION = float(os.getenv("ML_SAMPLE_FRACTION", "1.0"))
+TREND_PARITY_RTOL = 1e-9
+TREND_PARITY_ATOL = 1e-9
+ML_ATHENA_UNLOAD   = os.getenv("ML_ATHENA_UNLOAD", "1").strip().lower() not in ("0", "false", "no")
+UNLOAD_LABELS      = ("fct_daily_sales", "fct_inventory_snapshots") if ML_ATHENA_UNLOAD else ()
+ML_FEATURES_INCREMENTAL = os.getenv("ML_FEATURES_INCREMENTAL", "").strip().lower() in ("1", "true", "yes")
+ML_FEATURE_WORKERS = int(os.getenv("ML_FEATURE_WORKERS", "1"))
+ML_FEATURE_ENGINE  = os.getenv("ML_FEATURE_ENGINE", "pandas").strip().lower()
 ML_LOCAL_ARTIFACT_DIR = os.getenv("ML_LOCAL_ARTIFACT_DIR", "").strip()
 
 if ML_LOCAL_ARTIFACT_DIR:
-    LOCAL_FEATURES_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_features.parquet"
+    LOCAL_FEATURE_STATE_DIR = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_features_state"
 else:
-    LOCAL_FEATURES_PATH = None
+    LOCAL_FEATURE_STATE_DIR = None
+
+FEATURE_STATE_S3_PREFIX = "ml/features/state"
+SERIES_KEYS   = ["store_id", "product_id"]
+SUPPLIER_COLS = ["supplier_id", "avg_actual_lead_time_days",
+                 "calculated_on_time_rate", "avg_fill_rate"]
+CONTEXT_COLS  = ["region", "store_type", "category", "is_weekend",
+                 "day_of_week", "month_of_year", "day_of_month",
+                 "unit_price", "discount_amount", "net_amount"]
+
+# Look-back windows of the inventory and cross-store features; the demand
+# feature windows are declared in feature_registry.py.
+STOCKOUT_WINDOW       = 14              # includes the current snapshot
+REGION_WINDOW         = 7               # includes the current date
+
+# Cross-sectional features: (column, group columns, daily value, rolling rows).
+# Each is the trailing mean, over the group's dates, of the daily mean of the
+# value across the group's rows. Adding e.g. a category-level signal is one
+# more entry: ("category_avg_demand_7d", ["category"], "lag_1", 7).
+CROSS_SECTIONAL_FEATURES = [
+    ("region_avg_demand_7d", ["region", "product_id"], "lag_1", REGION_WINDOW),
+]
+
+# Rows of history the incremental mode keeps per series. Each is the longest
+# look-back of the features computed from that table.
+SALES_TAIL_ROWS     = 30   # price_vs_30d_avg (30 prior prices); lags/rolling need 28
+INVENTORY_TAIL_ROWS = 13   # stockout_freq_14d window minus the current row
+REGION_TAIL_ROWS    = 6    # region_avg_demand_7d window minus the current row
+# Observed rows that still carry EWM weight above 1e-17 (factor^k), per span.
+EWM_STATE_TAIL_ROWS = {span: int(np.ceil(np.log(1e-17) / np.log(1 - 2 / (span + 1))))
+                       for span in EWM_SPANS}
+
+# NULL handling for the typed Athena results.
+SALES_FILL = {
+    "quantity_sold": 0, "unit_price": 0, "discount_amount": 0, "net_amount": 0,
+    "day_of_week": 0, "month_of_year": 0, "day_of_month": 0, "is_weekend": False,
+}
+INVENTORY_FILL = {
+    "quantity_on_hand": 0, "quantity_on_order": 0, "reorder_point": 0,
+    "is_out_of_stock": False, "needs_reorder": False,
+}
 
 
 # ---------------------------------------------------------------------------
 # SQL — pull raw data from Athena mart tables
 # ---------------------------------------------------------------------------
 
-SQL_SALES = """
+# The sales and inventory queries are templates with a FILTER_SLOT after
+# their FROM; _with_filter fills it, and SQL_SALES / SQL_INVENTORY leave it empty.
+FILTER_SLOT = "{filter}"
+
+SQL_SALES_TEMPLATE = """
     SELECT
         sale_date,
         store_id,
@@ -68,10 +166,11 @@ SQL_SALES = """
         CAST(sale_month            AS INTEGER) AS month_of_year,
         CAST(sale_day              AS INTEGER) AS day_of_month
     FROM retailops_marts.fct_daily_sales
+    {filter}
     ORDER BY store_id, product_id, sale_date
 """
 
-SQL_INVENTORY = """
+SQL_INVENTORY_TEMPLATE = """
     SELECT
         snapshot_date,
         store_id,
@@ -82,9 +181,13 @@ SQL_INVENTORY = """
         CAST(is_out_of_stock          AS BOOLEAN) AS is_out_of_stock,
         CAST(needs_reorder            AS BOOLEAN) AS needs_reorder
     FROM retailops_marts.fct_inventory_snapshots
+    {filter}
     ORDER BY store_id, product_id, snapshot_date
 """
 
+SQL_SALES     = SQL_SALES_TEMPLATE.replace(FILTER_SLOT, "")
+SQL_INVENTORY = SQL_INVENTORY_TEMPLATE.replace(FILTER_SLOT, "")
+
 SQL_SUPPLIER = """
     SELECT
         p.product_id,
@@ -103,7 +206,11 @@ SQL_SUPPLIER = """
 # ---------------------------------------------------------------------------
 
 def _trend_slope(series: pd.Series) -> float:
-    """OLS slope of series values against integer index. Returns 0 on failure."""
+    """
+    OLS slope of series values against integer index. Returns 0 on failure.
+    Reference definition for _rolling_trend_slope, which computes the same
+    thing for every window at once.
+    """
     y = series.dropna().values
     if len(y) < 3:
         return 0.0
@@ -112,72 +219,223 @@ def _trend_slope(series: pd.Series) -> float:
     return float(slope)
 
 
+def _rolling_trend_slope(values: pd.Series, series_id: pd.Series,
+                         window: int, min_periods: int) -> pd.Series:
+    """
+    Closed-form equivalent of
+        values.groupby(series_id).rolling(window, min_periods).apply(_trend_slope)
+
+    The OLS slope of a window is
+        (n·Σxy − Σx·Σy) / (n·Σx² − (Σx)²)
+    so it only needs rolling sums, which are O(n) and vectorized across all
+    series. As in _trend_slope, NaNs are dropped and the remaining points
+    are numbered consecutively. Using the running count of non-NaN values in
+    the series as x does exactly that, because the slope does not depend on
+    where x starts. Windows with fewer than min_periods non-NaN values are
+    NaN, and windows with fewer than 3 are 0. Agrees with _trend_slope to
+    float rounding (~1e-12); `python ml/features.py --trend-parity` checks
+    it (check_trend_parity).
+    """
+    valid = values.notna()
+    n_obs = valid.astype("float64")
+    x     = n_obs.groupby(series_id, sort=False).cumsum().where(valid, 0.0)
+    y     = values.where(valid, 0.0)
+
+    sums = (
+        pd.DataFrame({"n": n_obs, "x": x, "y": y, "xx": x * x, "xy": x * y})
+          .groupby(series_id, sort=False)
+          .rolling(window, min_periods=1).sum()
+          .droplevel(0)
+    )
+    n = sums["n"]
+    slope = (
+        (n * sums["xy"] - sums["x"] * sums["y"])
+        / (n * sums["xx"] - sums["x"] ** 2)
+    )
+    return slope.where(n >= 3, 0.0).where(n >= min_periods)
+
+
+def check_trend_parity(n_series: int = 300, seed: int = 0) -> pd.DataFrame:
+    """
+    Compare _rolling_trend_slope with the rolling.apply(_trend_slope)
+    definition on random series: lengths from 1 to 80 rows, integer demand
+    with scattered NaNs and NaN runs inside the window, and a leading NaN as
+    in lag_1. Checked at TREND_MIN_PERIODS and at min_periods=1, which
+    exercises the fewer-than-3-points -> 0 rule. Returns one row per
+    min_periods with the window counts per case, the number of values
+    outside TREND_PARITY_RTOL / TREND_PARITY_ATOL and the largest absolute
+    difference.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 81, size=n_series)
+    series_id = pd.Series(np.repeat(np.arange(n_series), lengths))
+    values = pd.Series(rng.poisson(rng.gamma(2.0, 4.0, size=len(series_id))).astype("float64"))
+    values[rng.random(len(values)) < 0.15] = np.nan
+    for start in rng.choice(len(values), size=n_series // 4, replace=False):
+        values[start:start + rng.integers(2, TREND_WINDOW)] = np.nan
+    values[series_id.ne(series_id.shift())] = np.nan
+
+    missing = values.isna().astype("float64").groupby(series_id, sort=False)
+    gaps = missing.rolling(TREND_WINDOW, min_periods=1).sum().droplevel(0) > 0
+    points = (1 - missing.obj).groupby(series_id, sort=False) \
+        .rolling(TREND_WINDOW, min_periods=1).sum().droplevel(0)
+
+    report = []
+    for min_periods in (TREND_MIN_PERIODS, 1):
+        expected = (
+            values.groupby(series_id, sort=False)
+                  .rolling(TREND_WINDOW, min_periods=min_periods)
+                  .apply(_trend_slope, raw=False)
+                  .droplevel(0)
+                  .to_numpy()
+        )
+        actual = _rolling_trend_slope(values, series_id, TREND_WINDOW, min_periods).to_numpy()
+        close = np.isclose(actual, expected, rtol=TREND_PARITY_RTOL, atol=TREND_PARITY_ATOL,
+                           equal_nan=True)
+        diff = np.abs(actual - expected)
+        report.append({
+            "min_periods":       min_periods,
+            "windows":           len(values),
+            "with_nan_gaps":     int((gaps & (points >= min_periods)).sum()),
+            "below_min_periods": int((points < min_periods).sum()),
+            "fewer_than_3":      int(((points < 3) & (points >= min_periods)).sum()),
+            "mismatches":        int((~close).sum()),
+            "max_abs_diff":      float(np.nanmax(diff)) if np.isfinite(diff).any() else 0.0,
+        })
+    return pd.DataFrame(report)
+
+
+def _compute_registered(df: pd.DataFrame, series_id: pd.Series,
+                        features: list[Feature]) -> dict[str, pd.Series]:
+    """
+    Values of the registered `features` (see feature_registry.py) over the
+    series-sorted frame `df`, in declaration order.
+
+    Sources are resolved on demand and cached, so each shifted series,
+    grouped rolling window and EWM is built once however many features
+    read it.
+    """
+    declared = {f.name: f for f in INTERMEDIATES + features}
+    values   = {}
+    shared   = {}
+
+    def intermediate(key, build):
+        if key not in shared:
+            shared[key] = build()
+        return shared[key]
+
+    def by_series(source: str):
+        return intermediate(("groupby", source),
+                            lambda: resolve(source).groupby(series_id, sort=False))
+
+    def resolve(name: str) -> pd.Series:
+        if name in values:
+            return values[name]
+        if name not in declared:
+            return df[name]
+        f = declared[name]
+        if f.transform in ("lag", "lead"):
+            periods = f.window if f.transform == "lag" else -f.window
+            out = intermediate(("shift", f.source, periods),
+                               lambda: by_series(f.source).shift(periods))
+        elif f.transform.startswith("roll_"):
+            window = intermediate(("rolling", f.source, f.window, f.min_periods),
+                                  lambda: by_series(f.source).rolling(f.window,
+                                                                      min_periods=f.min_periods))
+            out = getattr(window, f.transform[len("roll_"):])().droplevel(0)
+        elif f.transform == "ewm_mean":
+            ewm = intermediate(("ewm", f.source, f.window, f.min_periods),
+                               lambda: by_series(f.source).ewm(span=f.window,
+                                                               min_periods=f.min_periods))
+            out = ewm.mean().droplevel(0)
+        elif f.transform == "trend":
+            out = _rolling_trend_slope(resolve(f.source), series_id, f.window,
+                                       min_periods=f.min_periods)
+        elif f.transform == "expr":
+            out = f.fn(*(resolve(col) for col in f.inputs))
+        else:
+            raise ValueError(f"Feature {f.name!r}: unknown transform {f.transform!r}")
+        if f.fill is not None:
+            out = out.fillna(f.fill)
+        values[name] = out
+        return out
+
+    return {f.name: resolve(f.name) for f in features}
+
+
 def build_demand_features(sales: pd.DataFrame) -> pd.DataFrame:
     """
     For each store × product time series, compute lag, rolling, EWM,
     and trend features. Returns a flat DataFrame indexed by
     (store_id, product_id, sale_date).
+
+    The frame is sorted once by (store_id, product_id, sale_date) and every
+    feature is a grouped shift / rolling / ewm over a contiguous series id,
+    so there is no per-series Python loop. Grouped rolling windows restart at
+    each series boundary, which gives the same values as computing each
+    series on its own. The features themselves are DEMAND_FEATURES from
+    feature_registry.py, computed by _compute_registered.
     """
-    records = []
-
-    for (store_id, product_id), grp in sales.groupby(["store_id", "product_id"]):
-        grp = grp.sort_values("sale_date").set_index("sale_date")
-        qty = grp["quantity_sold"]
-
-        if len(qty) < MIN_HISTORY_DAYS:
-            continue
-
-        feat = pd.DataFrame(index=grp.index)
-        feat["store_id"]    = store_id
-        feat["product_id"]  = product_id
-
-        # --- pass-through context columns ---
-        for col in ["region", "store_type", "category", "is_weekend",
-                    "day_of_week", "month_of_year", "day_of_month",
-                    "unit_price", "discount_amount", "net_amount"]:
-            feat[col] = grp[col]
-
-        # --- lag features ---
-        for lag in [1, 7, 14, 28]:
-            feat[f"lag_{lag}"] = qty.shift(lag)
-
-        # --- rolling statistics ---
-        for w in [7, 14, 28]:
-            r = qty.shift(1).rolling(w, min_periods=max(1, w // 2))
-            feat[f"roll_mean_{w}"] = r.mean()
-            feat[f"roll_std_{w}"]  = r.std().fillna(0)
-            feat[f"roll_min_{w}"]  = r.min()
-            feat[f"roll_max_{w}"]  = r.max()
-
-        # --- exponentially weighted mean ---
-        for span in [7, 14]:
-            feat[f"ewm_mean_{span}"] = qty.shift(1).ewm(span=span, min_periods=3).mean()
-
-        # --- demand trend: OLS slope over trailing 14 days ---
-        feat["demand_trend_14d"] = (
-            qty.shift(1)
-               .rolling(14, min_periods=5)
-               .apply(_trend_slope, raw=False)
-        )
+    df = sales.sort_values(["store_id", "product_id", "sale_date"], kind="stable")
+    series_len = df.groupby(["store_id", "product_id"], observed=True)["sale_date"].transform("size")
+    df = df[series_len >= MIN_HISTORY_DAYS].reset_index(drop=True)
+
+    series_id = df.groupby(["store_id", "product_id"], observed=True, sort=False).ngroup()
+
+    feat = pd.DataFrame({
+        "date":       df["sale_date"],
+        "store_id":   df["store_id"].astype(object),
+        "product_id": df["product_id"].astype(object),
+    })
+
+    # --- pass-through context columns ---
+    for col in CONTEXT_COLS:
+        feat[col] = df[col]
+
+    for name, values in _compute_registered(df, series_id, DEMAND_FEATURES).items():
+        feat[name] = values
 
-        # --- promotion / price features ---
-        price_30d_avg = grp["unit_price"].shift(1).rolling(30, min_periods=7).mean()
-        feat["has_discount"]     = (grp["discount_amount"] > 0).astype(int)
-        feat["discount_pct"]     = (
-            grp["discount_amount"]
-            / (grp["unit_price"] * qty).replace(0, np.nan)
-        ).fillna(0).clip(0, 1)
-        feat["price_vs_30d_avg"] = (grp["unit_price"] / price_30d_avg).fillna(1.0)
+    return feat
 
-        # --- calendar: days since month start (pay-cycle proxy) ---
-        feat["days_since_period_start"] = feat["day_of_month"] - 1
 
-        # --- target: next-day demand (shifted back by 1) ---
-        feat["target"] = qty.shift(-1)
+INVENTORY_COLS = ["quantity_on_hand", "quantity_on_order", "reorder_point",
+                  "needs_reorder", "stockout_freq_14d"]
+
+
+def _matching_rows(left: pd.DataFrame, left_date: str,
+                   right: pd.DataFrame, right_date: str) -> np.ndarray:
+    """
+    Position in `right` of the row with the same (store_id, product_id, date)
+    as each row of `left`, or -1. When both frames hold the same keys in the
+    same order this is just arange; otherwise the packed keys are matched
+    with a binary search over the sorted right-hand keys.
+    """
+    if len(left) == len(right) and all(
+        np.array_equal(left[a].to_numpy(), right[b].to_numpy())
+        for a, b in [("store_id", "store_id"), ("product_id", "product_id"), (left_date, right_date)]
+    ):
+        return np.arange(len(left))
+
+    stores   = pd.Index(pd.unique(np.concatenate([left["store_id"].to_numpy(object),
+                                                  right["store_id"].to_numpy(object)])))
+    products = pd.Index(pd.unique(np.concatenate([left["product_id"].to_numpy(object),
+                                                  right["product_id"].to_numpy(object)])))
+    day0 = min(left[left_date].min(), right[right_date].min()).to_datetime64().astype("datetime64[D]")
+    n_days = int((max(left[left_date].max(), right[right_date].max()).to_datetime64()
+                  .astype("datetime64[D]") - day0).astype("int64")) + 1
 
-        records.append(feat.reset_index().rename(columns={"sale_date": "date"}))
+    def key(df, date_col):
+        store_code   = stores.get_indexer(df["store_id"].to_numpy(object)).astype("int64")
+        product_code = products.get_indexer(df["product_id"].to_numpy(object)).astype("int64")
+        day = (df[date_col].to_numpy("datetime64[D]") - day0).astype("int64")
+        return (store_code * len(products) + product_code) * n_days + day
 
-    return pd.concat(records, ignore_index=True)
+    left_key, right_key = key(left, left_date), key(right, right_date)
+    order = np.argsort(right_key, kind="stable")
+    sorted_key = right_key[order]
+    pos = np.searchsorted(sorted_key, left_key).clip(max=len(sorted_key) - 1)
+    found = sorted_key[pos] == left_key
+    return np.where(found, order[pos], -1)
 
 
 def build_inventory_features(inventory: pd.DataFrame,
@@ -185,39 +443,45 @@ def build_inventory_features(inventory: pd.DataFrame,
     """
     Merge inventory snapshot features onto the demand feature table.
     Computes days_of_stock_remaining and stockout_frequency_14d.
-    """
-    inv = inventory.copy()
-    inv["snapshot_date"] = pd.to_datetime(inv["snapshot_date"])
-
-    # stockout_frequency_14d: fraction of last 14 days with is_out_of_stock
-    inv_feat = []
-    for (store_id, product_id), grp in inv.groupby(["store_id", "product_id"]):
-        grp = grp.sort_values("snapshot_date").set_index("snapshot_date")
-        f = pd.DataFrame(index=grp.index)
-        f["store_id"]   = store_id
-        f["product_id"] = product_id
-        f["quantity_on_hand"]  = grp["quantity_on_hand"]
-        f["quantity_on_order"] = grp["quantity_on_order"]
-        f["reorder_point"]     = grp["reorder_point"]
-        f["needs_reorder"]     = grp["needs_reorder"].astype(int)
-        f["stockout_freq_14d"] = (
-            grp["is_out_of_stock"].astype(float)
-                                  .rolling(14, min_periods=1)
-                                  .mean()
-        )
-        inv_feat.append(f.reset_index().rename(columns={"snapshot_date": "date"}))
 
-    inv_df = pd.concat(inv_feat, ignore_index=True)
+    stockout_freq_14d is one grouped rolling mean over the snapshots sorted by
+    (store_id, product_id, snapshot_date). The inventory columns are then
+    attached to the demand rows by key position (see _matching_rows) instead
+    of a hash merge; demand rows without a snapshot get NaN.
+    """
+    if inventory.empty:
+        return demand_features.assign(**{col: np.nan for col in INVENTORY_COLS},
+                                      days_of_stock_remaining=np.nan)
+    inv = inventory[SERIES_KEYS + ["snapshot_date", "quantity_on_hand", "quantity_on_order",
+                                   "reorder_point", "needs_reorder", "is_out_of_stock"]]
+    inv = inv.assign(snapshot_date=pd.to_datetime(inv["snapshot_date"]))
+    inv = inv.sort_values(SERIES_KEYS + ["snapshot_date"], kind="stable", ignore_index=True)
 
-    # days_of_stock_remaining uses rolling_7d_demand from demand features
-    merged = demand_features.merge(
-        inv_df[["store_id", "product_id", "date",
-                "quantity_on_hand", "quantity_on_order", "reorder_point",
-                "needs_reorder", "stockout_freq_14d"]],
-        on=["store_id", "product_id", "date"],
-        how="left",
+    # stockout_frequency_14d: fraction of the last 14 snapshots out of stock
+    pair_id  = inv.groupby(SERIES_KEYS, observed=True, sort=False).ngroup()
+    stockout = (
+        inv["is_out_of_stock"].astype(float)
+                              .groupby(pair_id, sort=False)
+                              .rolling(STOCKOUT_WINDOW, min_periods=1)
+                              .mean()
+                              .droplevel(0)
     )
+    inv_feat = pd.DataFrame({
+        "quantity_on_hand":  inv["quantity_on_hand"],
+        "quantity_on_order": inv["quantity_on_order"],
+        "reorder_point":     inv["reorder_point"],
+        "needs_reorder":     inv["needs_reorder"].astype(int),
+        "stockout_freq_14d": stockout,
+    })
+
+    rows = _matching_rows(demand_features, "date", inv, "snapshot_date")
+    matched = rows >= 0
+    merged = demand_features.copy()
+    for col in INVENTORY_COLS:
+        values = inv_feat[col].to_numpy()[rows]
+        merged[col] = values if matched.all() else np.where(matched, values, np.nan)
 
+    # days_of_stock_remaining uses rolling_7d_demand from demand features
     roll7 = merged["roll_mean_7"].clip(lower=0.01)
     merged["days_of_stock_remaining"] = (
         merged["quantity_on_hand"].clip(lower=0) / roll7
@@ -226,121 +490,505 @@ def build_inventory_features(inventory: pd.DataFrame,
     return merged
 
 
+def _rolling_mean_by_group(values: np.ndarray, group: np.ndarray, window: int) -> np.ndarray:
+    """
+    Trailing `window`-row mean (min_periods=1, NaNs skipped) of `values`,
+    restarting at each change of `group`. Rows must be grouped contiguously.
+    Vectorized as `window` shifted passes over the whole array rather than a
+    rolling call per group.
+    """
+    n = len(values)
+    idx = np.arange(n)
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    group_start = np.repeat(starts, np.diff(np.r_[starts, n]))
+    total = np.zeros(n)
+    count = np.zeros(n)
+    for k in range(window):
+        src = idx - k
+        use = src >= group_start
+        v = values[np.maximum(src, 0)]
+        use &= ~np.isnan(v)
+        total += np.where(use, v, 0.0)
+        count += use
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count > 0, total / count, np.nan)
+
+
+def _region_daily_demand(demand_features: pd.DataFrame) -> pd.DataFrame:
+    """Mean lag_1 per region × product × date, the input to region_avg_demand_7d."""
+    return (
+        demand_features.groupby(["region", "product_id", "date"], observed=True)["lag_1"]
+                       .mean()
+                       .reset_index()
+                       .rename(columns={"lag_1": "_region_lag1"})
+    )
+
+
+def _region_rolling_demand(region_daily: pd.DataFrame) -> pd.DataFrame:
+    """Add the trailing 7-row mean of _region_lag1 per region × product."""
+    region_daily = region_daily.sort_values(["region", "product_id", "date"], ignore_index=True)
+    group = region_daily.groupby(["region", "product_id"], observed=True, sort=False).ngroup()
+    region_daily["region_avg_demand_7d"] = _rolling_mean_by_group(
+        region_daily["_region_lag1"].to_numpy("float64"), group.to_numpy(), REGION_WINDOW)
+    return region_daily
+
+
+def _cross_sectional_rolling(df: pd.DataFrame, group_cols: list[str], value_col: str,
+                             window: int) -> np.ndarray:
+    """
+    Per row: the trailing `window`-row mean, over the dates of its group, of
+    the daily mean of `value_col` across all rows of the group on that date.
+
+    Each group × date cell gets an integer code from one grouped pass; the
+    cell means are rolled as a flat array ordered by (group, date) and mapped
+    back to the rows by those codes, so there is no merge.
+    """
+    cells = df.groupby(group_cols + ["date"], observed=True, sort=True)
+    cell_of_row = cells.ngroup().to_numpy()
+    cell_mean = cells[value_col].mean().to_numpy("float64")
+    cell_group = np.empty(len(cell_mean), dtype="int64")
+    cell_group[cell_of_row] = df.groupby(group_cols, observed=True, sort=True).ngroup().to_numpy()
+    return _rolling_mean_by_group(cell_mean, cell_group, window)[cell_of_row]
+
+
 def build_cross_store_features(demand_features: pd.DataFrame) -> pd.DataFrame:
     """
     region_avg_demand_7d: average demand for this product across all stores
     in the same region over the trailing 7 days.
     Captures regional demand signals that a single-store model misses.
+
+    Every entry of CROSS_SECTIONAL_FEATURES is computed the same way (see
+    _cross_sectional_rolling). The columns are added to `demand_features`
+    in place and the frame is returned.
     """
-    df = demand_features.copy()
-    df["date"] = pd.to_datetime(df["date"])
+    demand_features["date"] = pd.to_datetime(demand_features["date"])
+    for name, group_cols, value_col, window in CROSS_SECTIONAL_FEATURES:
+        demand_features[name] = _cross_sectional_rolling(demand_features, group_cols,
+                                                         value_col, window)
+    return demand_features
 
-    # rolling 7-day mean per region × product
-    region_daily = (
-        df.groupby(["region", "product_id", "date"])["lag_1"]
-          .mean()
-          .reset_index()
-          .rename(columns={"lag_1": "_region_lag1"})
-    )
-    region_daily = region_daily.sort_values(["region", "product_id", "date"])
-    region_daily["region_avg_demand_7d"] = (
-        region_daily.groupby(["region", "product_id"])["_region_lag1"]
-                    .transform(lambda s: s.rolling(7, min_periods=1).mean())
+
+def _merge_supplier(features: pd.DataFrame, sup_raw: pd.DataFrame) -> pd.DataFrame:
+    """Attach the static per-product supplier columns."""
+    return features.merge(sup_raw[["product_id"] + SUPPLIER_COLS], on="product_id", how="left")
+
+
+def _with_filter(template: str, condition: str) -> str:
+    """`template` (SQL_SALES_TEMPLATE / SQL_INVENTORY_TEMPLATE) restricted to rows matching `condition`."""
+    if FILTER_SLOT not in template:
+        raise ValueError(f"query template has no {FILTER_SLOT} slot")
+    return template.replace(FILTER_SLOT, f"WHERE {condition}")
+
+
+# ---------------------------------------------------------------------------
+# Incremental mode — per-series state
+# ---------------------------------------------------------------------------
+
+def _ewm_scan(values: np.ndarray, present: np.ndarray, span: int,
+              state: tuple | None = None) -> tuple[np.ndarray, tuple]:
+    """
+    pandas' adjusted EWM mean recursion (ewm(span, min_periods=EWM_MIN_PERIODS),
+    ignore_na=False), run over a (series × step) grid one step at a time and
+    vectorized across series. Cells where `present` is False are padding and
+    leave a series' state untouched. `state` is (weighted, old_wt, nobs) per
+    series, as returned by a previous call, so a scan can resume where the
+    last one stopped. Output is bit-identical to Series.ewm(...).mean().
+    """
+    alpha  = 1.0 / (1.0 + (span - 1) / 2)
+    factor = 1.0 - alpha
+    if state is None:
+        weighted = np.full(values.shape[0], np.nan)
+        old_wt   = np.ones(values.shape[0])
+        nobs     = np.zeros(values.shape[0], dtype=np.int64)
+    else:
+        weighted, old_wt, nobs = (np.array(a, dtype=a.dtype) for a in state)
+
+    out = np.full(values.shape, np.nan)
+    for step in range(values.shape[1]):
+        cur, live = values[:, step], present[:, step]
+        observed  = live & ~np.isnan(cur)
+        nobs     += observed
+        started   = live & ~np.isnan(weighted)
+        old_wt    = np.where(started, old_wt * factor, old_wt)
+        update    = started & observed
+        with np.errstate(invalid="ignore"):
+            blended = (old_wt * weighted + cur) / (old_wt + 1.0)
+        weighted  = np.where(update & (weighted != cur), blended, weighted)
+        old_wt    = np.where(update, old_wt + 1.0, old_wt)
+        weighted  = np.where(live & ~started & observed, cur, weighted)
+        out[:, step] = np.where(nobs >= EWM_MIN_PERIODS, weighted, np.nan)
+    return out, (weighted, old_wt, nobs)
+
+
+def _ewm_advance(lag_1: pd.Series, series_codes: np.ndarray, n_series: int,
+                 span: int, state: tuple | None = None) -> tuple[np.ndarray, tuple]:
+    """
+    Run _ewm_scan over rows sorted by series then date. series_codes maps
+    each row to 0..n_series-1. Returns the per-row EWM and the new state.
+    """
+    step = pd.Series(series_codes).groupby(series_codes).cumcount().to_numpy()
+    values  = np.full((n_series, step.max() + 1), np.nan)
+    present = np.zeros(values.shape, dtype=bool)
+    values[series_codes, step]  = lag_1.to_numpy(dtype="float64")
+    present[series_codes, step] = True
+    out, state = _ewm_scan(values, present, span, state)
+    return out[series_codes, step], state
+
+
+def _ewm_final_state(lag_1: pd.Series, series_codes: np.ndarray, n_series: int,
+                     span: int) -> tuple:
+    """
+    The (weighted, old_wt, nobs) state _ewm_advance ends a full scan with,
+    from grouped sums over the rows instead of an n_series × steps grid.
+    Rows are sorted by series then date, as for _ewm_advance.
+
+    After a series' last step, old_wt is Σ factor^(last step − i) over its
+    observed rows i and weighted is Σ factor^(…)·x_i / old_wt. Weights are
+    taken relative to the last observed row, so they never underflow before
+    the rows that matter; rows EWM_STATE_TAIL_ROWS[span] or more steps before
+    the last observed one weigh under 1e-17 and are left out. Agrees with the
+    scan to float rounding.
+    """
+    factor   = 1.0 - 1.0 / (1.0 + (span - 1) / 2)
+    values   = lag_1.to_numpy(dtype="float64")
+    observed = ~np.isnan(values)
+    step     = pd.Series(series_codes).groupby(series_codes).cumcount().to_numpy()
+    nobs     = np.bincount(series_codes, weights=observed, minlength=n_series).astype(np.int64)
+    n_steps  = np.bincount(series_codes, minlength=n_series)
+    last_obs = np.full(n_series, -1)
+    np.maximum.at(last_obs, series_codes[observed], step[observed])
+
+    age  = last_obs[series_codes] - step
+    tail = observed & (age < EWM_STATE_TAIL_ROWS[span])
+    weight = factor ** age[tail]
+    total  = np.bincount(series_codes[tail], weights=weight, minlength=n_series)
+    summed = np.bincount(series_codes[tail], weights=weight * values[tail], minlength=n_series)
+    started = nobs > 0
+    with np.errstate(invalid="ignore"):
+        weighted = np.where(started, summed / total, np.nan)
+    old_wt = np.where(started, total * factor ** (n_steps - 1 - last_obs), 1.0)
+    return weighted, old_wt, nobs
+
+
+def _keys_as_object(df: pd.DataFrame) -> pd.DataFrame:
+    """Plain-object series keys, so state frames merge regardless of category sets."""
+    for col in SERIES_KEYS:
+        df[col] = df[col].astype(object)
+    return df
+
+
+def _tail_rows(df: pd.DataFrame, date_col: str, n_rows: int) -> pd.DataFrame:
+    return (
+        df.sort_values(SERIES_KEYS + [date_col], kind="stable")
+          .groupby(SERIES_KEYS, observed=True, sort=False)
+          .tail(n_rows)
+          .reset_index(drop=True)
     )
 
-    df = df.merge(
-        region_daily[["region", "product_id", "date", "region_avg_demand_7d"]],
-        on=["region", "product_id", "date"],
-        how="left",
+
+def _supplier_snapshot(sup_raw: pd.DataFrame) -> pd.DataFrame:
+    """The supplier columns in a canonical form, to tell whether they changed between runs."""
+    return (sup_raw[["product_id"] + SUPPLIER_COLS]
+            .astype({"product_id": object, "supplier_id": object})
+            .sort_values("product_id", kind="stable", ignore_index=True))
+
+
+def _capture_feature_state(sales: pd.DataFrame, inventory: pd.DataFrame,
+                           demand_feat: pd.DataFrame, sup_raw: pd.DataFrame,
+                           feature_version: str) -> dict:
+    """
+    Per-series state after a full build, for the next incremental run.
+    `feature_version` is the feature store version the build wrote.
+    """
+    sales = _keys_as_object(sales.copy())
+    series = sales.groupby(SERIES_KEYS, sort=True).size().rename("n_rows").reset_index()
+
+    demand = _keys_as_object(demand_feat[SERIES_KEYS + ["date", "lag_1"]].copy())
+    codes  = demand.groupby(SERIES_KEYS, sort=False).ngroup().to_numpy()
+    ewm    = demand.drop_duplicates(SERIES_KEYS)[SERIES_KEYS].reset_index(drop=True)
+    for span in EWM_SPANS:
+        weighted, old_wt, nobs = _ewm_final_state(demand["lag_1"], codes, len(ewm), span)
+        ewm[f"ewm_{span}_weighted"], ewm[f"ewm_{span}_old_wt"], ewm[f"ewm_{span}_nobs"] = (
+            weighted, old_wt, nobs
+        )
+    series = series.merge(ewm, on=SERIES_KEYS, how="left")
+
+    region_daily = _region_daily_demand(demand_feat.assign(date=pd.to_datetime(demand_feat["date"])))
+    return {
+        "series":         series,
+        "sales_tail":     _tail_rows(sales, "sale_date", SALES_TAIL_ROWS),
+        "inventory_tail": _tail_rows(_keys_as_object(inventory.copy()), "snapshot_date",
+                                     INVENTORY_TAIL_ROWS),
+        "region_tail":    (region_daily.sort_values(["region", "product_id", "date"])
+                                       .groupby(["region", "product_id"], observed=True)
+                                       .tail(REGION_TAIL_ROWS)
+                                       .reset_index(drop=True)),
+        "supplier":       _supplier_snapshot(sup_raw),
+        "meta": {
+            "last_sales_date":    str(pd.Timestamp(sales["sale_date"].max()).date()),
+            "last_snapshot_date": str(pd.Timestamp(inventory["snapshot_date"].max()).date()),
+            "feature_version":    feature_version,
+        },
+    }
+
+
+def save_feature_state(state: dict) -> None:
+    frames = {name: df for name, df in state.items() if name != "meta"}
+    meta   = json.dumps(state["meta"], indent=2)
+    if LOCAL_FEATURE_STATE_DIR is not None:
+        LOCAL_FEATURE_STATE_DIR.mkdir(parents=True, exist_ok=True)
+        for name, df in frames.items():
+            df.to_parquet(LOCAL_FEATURE_STATE_DIR / f"{name}.parquet", index=False)
+        (LOCAL_FEATURE_STATE_DIR / "meta.json").write_text(meta, encoding="utf-8")
+        print(f"     Feature state -> {LOCAL_FEATURE_STATE_DIR}")
+        return
+    s3 = get_s3_client()
+    for name, df in frames.items():
+        buf = io.BytesIO()
+        df.to_parquet(buf, index=False)
+        s3.put_object(Bucket=BUCKET, Key=f"{FEATURE_STATE_S3_PREFIX}/{name}.parquet",
+                      Body=buf.getvalue())
+    s3.put_object(Bucket=BUCKET, Key=f"{FEATURE_STATE_S3_PREFIX}/meta.json", Body=meta.encode())
+    print(f"     Feature state -> s3://{BUCKET}/{FEATURE_STATE_S3_PREFIX}/")
+
+
+def load_feature_state() -> dict | None:
+    """
+    The saved state, or None if there is none. State saved without a
+    feature_version (by an older build) also counts as none.
+    """
+    names = ["series", "sales_tail", "inventory_tail", "region_tail", "supplier"]
+    if LOCAL_FEATURE_STATE_DIR is not None:
+        if not (LOCAL_FEATURE_STATE_DIR / "meta.json").exists():
+            return None
+        meta = json.loads((LOCAL_FEATURE_STATE_DIR / "meta.json").read_text(encoding="utf-8"))
+        if "feature_version" not in meta:
+            return None
+        state = {name: pd.read_parquet(LOCAL_FEATURE_STATE_DIR / f"{name}.parquet") for name in names}
+        state["meta"] = meta
+        return state
+    s3 = get_s3_client()
+    try:
+        meta = s3.get_object(Bucket=BUCKET, Key=f"{FEATURE_STATE_S3_PREFIX}/meta.json")
+    except ClientError:
+        return None
+    state = {"meta": json.loads(meta["Body"].read())}
+    if "feature_version" not in state["meta"]:
+        return None
+    for name in names:
+        obj = s3.get_object(Bucket=BUCKET, Key=f"{FEATURE_STATE_S3_PREFIX}/{name}.parquet")
+        state[name] = pd.read_parquet(io.BytesIO(obj["Body"].read()))
+    return state
+
+
+def _build_features_incremental(state: dict) -> pd.DataFrame | None:
+    """
+    Add feature rows for sales dates after the saved state and fill in the
+    target of the previous inference rows, rewriting only the feature store
+    partitions they fall into. Returns the added rows, or None when a full
+    rebuild is required instead.
+    """
+    if current_version() != state["meta"]["feature_version"]:
+        print("  Feature matrix is not the version the state was saved with; running a full rebuild")
+        return None
+
+    last_sales = pd.Timestamp(state["meta"]["last_sales_date"])
+    last_snap  = pd.Timestamp(state["meta"]["last_snapshot_date"])
+    supplier_label = "dim_products + mart_supplier_performance"
+    print(f"\n[1/3] Loading sales after {last_sales.date()} and inventory after "
+          f"{last_snap.date()} from Athena …")
+    results = run_queries({
+        supplier_label: SQL_SUPPLIER,
+        "fct_daily_sales (new dates)": _with_filter(
+            SQL_SALES_TEMPLATE, f"sale_date > DATE '{last_sales.date()}'"),
+        "fct_inventory_snapshots (new dates)": _with_filter(
+            SQL_INVENTORY_TEMPLATE, f"snapshot_date > DATE '{last_snap.date()}'"),
+    })
+    sup_raw   = results[supplier_label]
+    sales_new = _keys_as_object(results["fct_daily_sales (new dates)"].fillna(SALES_FILL))
+    inv_new   = _keys_as_object(results["fct_inventory_snapshots (new dates)"].fillna(INVENTORY_FILL))
+    if sales_new.empty:
+        print("     No new sales dates; feature matrix is up to date")
+        return pd.DataFrame()
+
+    series = state["series"]
+    counts = series[SERIES_KEYS + ["n_rows"]].merge(
+        sales_new.groupby(SERIES_KEYS).size().rename("n_new").reset_index(),
+        on=SERIES_KEYS, how="outer",
+    ).fillna({"n_rows": 0, "n_new": 0})
+    crossing = (counts["n_rows"] < MIN_HISTORY_DAYS) & (
+        counts["n_rows"] + counts["n_new"] >= MIN_HISTORY_DAYS)
+    if crossing.any():
+        print(f"  {int(crossing.sum())} series reached {MIN_HISTORY_DAYS} days of history; "
+              "running a full rebuild")
+        return None
+
+    print(f"\n[2/3] Building features for {sales_new['sale_date'].nunique()} new date(s) …")
+    sales_hist = pd.concat([state["sales_tail"], sales_new], ignore_index=True)
+    demand     = build_demand_features(sales_hist)
+    prior      = demand[demand["date"] <= last_sales]
+    demand_new = demand[demand["date"] > last_sales].reset_index(drop=True)
+
+    # The tail is too short for EWM, so those columns come from the saved accumulators.
+    row_of = series[SERIES_KEYS].reset_index().rename(columns={"index": "_row"})
+    rows   = demand_new[SERIES_KEYS].merge(row_of, on=SERIES_KEYS, how="left")["_row"].to_numpy()
+    touched, codes = np.unique(rows, return_inverse=True)
+    for span in EWM_SPANS:
+        cols = [f"ewm_{span}_weighted", f"ewm_{span}_old_wt", f"ewm_{span}_nobs"]
+        prev_state = tuple(series[c].to_numpy()[touched] for c in cols)
+        demand_new[f"ewm_mean_{span}"], new_state = _ewm_advance(
+            demand_new["lag_1"], codes, len(touched), span, prev_state)
+        for col, values in zip(cols, new_state):
+            series.loc[touched, col] = values
+
+    inv_hist     = pd.concat([state["inventory_tail"], inv_new], ignore_index=True)
+    features_new = build_inventory_features(inv_hist, demand_new)
+    features_new["date"] = pd.to_datetime(features_new["date"])
+
+    region_new  = _region_daily_demand(features_new)
+    region_hist = _region_rolling_demand(pd.concat([state["region_tail"], region_new], ignore_index=True))
+    features_new = features_new.merge(
+        region_hist.loc[region_hist["date"] > last_sales,
+                        ["region", "product_id", "date", "region_avg_demand_7d"]],
+        on=["region", "product_id", "date"], how="left",
     )
-    return df
+    features_new = _merge_supplier(features_new, sup_raw).dropna(subset=["lag_28"])
+
+    # The previous inference row (last saved date) of each series with new
+    # sales now has a known target.
+    last_dates = (state["sales_tail"].groupby(SERIES_KEYS)["sale_date"].max()
+                  .rename("date").reset_index())
+    relabel = (prior[SERIES_KEYS + ["date", "target"]].dropna(subset=["target"])
+               .merge(last_dates, on=SERIES_KEYS + ["date"]))
+
+    # Supplier metrics are only rewritten everywhere when they changed.
+    supplier = _supplier_snapshot(sup_raw)
+    refresh = None
+    if not supplier.equals(state["supplier"]):
+        print("     Supplier metrics changed; refreshing them in every partition")
+        refresh = lambda part: _merge_supplier(part.drop(columns=SUPPLIER_COLS), sup_raw)
+
+    print("\n[3/3] Writing features and state …")
+    print(f"     New feature rows: {len(features_new):,}  "
+          f"Inference rows relabelled: {len(relabel):,}")
+    version = update_features(features_new, patches=relabel, refresh=refresh)
+
+    series = counts.merge(series.drop(columns="n_rows"), on=SERIES_KEYS, how="left")
+    series["n_rows"] = (series["n_rows"] + series.pop("n_new")).astype("int64")
+    save_feature_state({
+        "series":         series,
+        "sales_tail":     _tail_rows(sales_hist, "sale_date", SALES_TAIL_ROWS),
+        "inventory_tail": _tail_rows(inv_hist, "snapshot_date", INVENTORY_TAIL_ROWS),
+        "region_tail":    (pd.concat([state["region_tail"], region_new], ignore_index=True)
+                            .sort_values(["region", "product_id", "date"])
+                            .groupby(["region", "product_id"], observed=True)
+                            .tail(REGION_TAIL_ROWS)
+                            .reset_index(drop=True)),
+        "supplier":       supplier,
+        "meta": {
+            "last_sales_date":    str(sales_new["sale_date"].max().date()),
+            "last_snapshot_date": str(max(last_snap, inv_new["snapshot_date"].max()
+                                          if not inv_new.empty else last_snap).date()),
+            "feature_version":    version,
+        },
+    })
+    print("     Done.")
+    return features_new
+
+
+# ---------------------------------------------------------------------------
+# Sharded build
+# ---------------------------------------------------------------------------
+
+def _write_ipc(df: pd.DataFrame, path: Path) -> None:
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_ipc(path) -> pd.DataFrame:
+    with pa.memory_map(str(path), "r") as source:
+        return pa.ipc.open_file(source).read_all().to_pandas()
+
+
+def _build_feature_shard(shard_dir: str) -> str:
+    """Worker: demand + inventory features for one shard of stores."""
+    shard_dir = Path(shard_dir)
+    sales = _read_ipc(shard_dir / "sales.arrow")
+    inv   = _read_ipc(shard_dir / "inventory.arrow")
+    features = build_inventory_features(inv, build_demand_features(sales))
+    _write_ipc(features, shard_dir / "features.arrow")
+    return str(shard_dir / "features.arrow")
+
+
+def _store_shards(sales: pd.DataFrame, n_shards: int) -> pd.Series:
+    """store_id -> shard, contiguous in store_id order and balanced by sales rows."""
+    rows  = sales["store_id"].astype(object).value_counts().sort_index()
+    start = rows.cumsum() - rows
+    return (start * n_shards // rows.sum()).astype(int)
+
+
+def _build_store_features_sharded(sales: pd.DataFrame, inventory: pd.DataFrame,
+                                  workers: int) -> pd.DataFrame:
+    """build_inventory_features(inventory, build_demand_features(sales)), sharded by store."""
+    shard_of    = _store_shards(sales, workers)
+    sales_shard = sales["store_id"].astype(object).map(shard_of)
+    inv_shard   = inventory["store_id"].astype(object).map(shard_of)
+
+    # spawn, not fork: the parent holds boto3 / Athena fetch thread pools.
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="ml_features_") as tmp:
+        shard_dirs = []
+        for shard in sorted(shard_of.unique()):
+            shard_dir = Path(tmp) / f"shard_{shard:03d}"
+            shard_dir.mkdir()
+            _write_ipc(sales[sales_shard == shard], shard_dir / "sales.arrow")
+            _write_ipc(inventory[inv_shard == shard], shard_dir / "inventory.arrow")
+            shard_dirs.append(str(shard_dir))
+        print(f"     {len(shard_dirs)} store shards on {workers} worker processes")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            parts = [_read_ipc(path) for path in pool.map(_build_feature_shard, shard_dirs)]
+    return pd.concat(parts, ignore_index=True)
 
 
 # ---------------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------------
 
-def build_features() -> pd.DataFrame:
-    print("=" * 70)
-    print("FEATURE ENGINEERING PIPELINE")
-    print("=" * 70)
+def _summarize_features(features: pd.DataFrame) -> None:
+    n_train = features["target"].notna().sum()
+    n_infer = features["target"].isna().sum()
+    print(f"\n     Final feature matrix : {len(features):,} rows x {len(features.columns)} columns")
+    print(f"     Training rows (target known)  : {n_train:,}")
+    print(f"     Inference rows (target=NaN)   : {n_infer:,}  <- last date per series")
+    print(f"     Date range: {features['date'].min().date()} -> {features['date'].max().date()}")
+    print(f"     Store-product pairs: {features.groupby(['store_id','product_id'], observed=True).ngroups:,}")
+
 
-    # Approximate row counts for sampling (to avoid count queries)
-    approx_sales_rows = 150000
-    approx_inventory_rows = 500000
-    approx_supplier_rows = 1000
-
-    # Modify SQL for sampling if needed
-    sales_sql = SQL_SALES
-    inventory_sql = SQL_INVENTORY
-    supplier_sql = SQL_SUPPLIER
-
-    if 0 < ML_SAMPLE_FRACTION < 1.0:
-        supplier_limit = int(approx_supplier_rows * ML_SAMPLE_FRACTION)
-        # Sample suppliers/products first, then filter sales/inventory to those products
-        supplier_sql = SQL_SUPPLIER.rstrip() + f"\nORDER BY RANDOM() LIMIT {supplier_limit}"
-        print(f"  Using approximate sampling: supplier LIMIT {supplier_limit}, then filter sales/inventory to those products")
+def compute_features(sales_raw: pd.DataFrame, inv_raw: pd.DataFrame, sup_raw: pd.DataFrame,
+                     workers: int | None = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    The pandas feature engine: (feature matrix, demand features) from the
+    NULL-filled sales, inventory and supplier frames.
+    """
+    workers = ML_FEATURE_WORKERS if workers is None else workers
+    if workers > 1:
+        # The sharded frame has every demand column, so it also stands in
+        # for demand_feat when the incremental state is captured.
+        demand_feat = features = _build_store_features_sharded(sales_raw, inv_raw, workers)
     else:
-        supplier_sql = SQL_SUPPLIER
-
-    print("\n[1/4] Loading supplier features from Athena …")
-    sup_raw = run_query(supplier_sql, "dim_products + mart_supplier_performance")
-    for col in ["avg_actual_lead_time_days", "calculated_on_time_rate", "avg_fill_rate"]:
-        sup_raw[col] = pd.to_numeric(sup_raw[col], errors="coerce")
-
-    if 0 < ML_SAMPLE_FRACTION < 1.0:
-        sampled_products = set(sup_raw["product_id"].unique())
-        product_list = ",".join(f"'{p}'" for p in sampled_products)
-        sales_sql = SQL_SALES.replace(
-            "FROM retailops_marts.fct_daily_sales",
-            f"FROM retailops_marts.fct_daily_sales WHERE product_id IN ({product_list})"
-        )
-        inventory_sql = SQL_INVENTORY.replace(
-            "FROM retailops_marts.fct_inventory_snapshots",
-            f"FROM retailops_marts.fct_inventory_snapshots WHERE product_id IN ({product_list})"
-        )
-        print(f"     sampled {len(sampled_products)} products from {len(sup_raw)} suppliers")
-        print(f"     sales_sql: {sales_sql[:200]}...")
-        print(f"     inventory_sql: {inventory_sql[:200]}...")
-
-    print("\n[2/4] Loading sales history from Athena …")
-    sales_raw = run_query(sales_sql, "fct_daily_sales")
-    sales_raw["sale_date"] = pd.to_datetime(sales_raw["sale_date"])
-    for col in ["quantity_sold", "unit_price", "discount_amount", "net_amount"]:
-        sales_raw[col] = pd.to_numeric(sales_raw[col], errors="coerce").fillna(0)
-    for col in ["day_of_week", "month_of_year", "day_of_month"]:
-        sales_raw[col] = pd.to_numeric(sales_raw[col], errors="coerce").fillna(0).astype(int)
-    sales_raw["is_weekend"] = sales_raw["is_weekend"].map(
-        {"true": True, "false": False, "True": True, "False": False}
-    ).fillna(False)
-
-    print("\n[3/4] Loading inventory snapshots from Athena …")
-    inv_raw = run_query(inventory_sql, "fct_inventory_snapshots")
-    inv_raw["snapshot_date"] = pd.to_datetime(inv_raw["snapshot_date"])
-    for col in ["quantity_on_hand", "quantity_on_order", "reorder_point"]:
-        inv_raw[col] = pd.to_numeric(inv_raw[col], errors="coerce").fillna(0)
-    inv_raw["is_out_of_stock"] = inv_raw["is_out_of_stock"].map(
-        {"true": True, "false": False, "True": True, "False": False}
-    ).fillna(False)
-    inv_raw["needs_reorder"] = inv_raw["needs_reorder"].map(
-        {"true": True, "false": False, "True": True, "False": False}
-    ).fillna(False)
-
-    print("\n[4/4] Building features …")
-    demand_feat = build_demand_features(sales_raw)
+        demand_feat = build_demand_features(sales_raw)
+        features = build_inventory_features(inv_raw, demand_feat)
     print(f"     demand features: {len(demand_feat):,} rows")
 
-    features = build_inventory_features(inv_raw, demand_feat)
+    # Same row order for any worker count, so the regional means below sum
+    # their inputs in the same order.
+    features = features.sort_values(["store_id", "product_id", "date"], kind="stable",
+                                    ignore_index=True)
     features = build_cross_store_features(features)
 
     # merge supplier features (static per product)
-    features = features.merge(
-        sup_raw[["product_id", "supplier_id",
-                 "avg_actual_lead_time_days",
-                 "calculated_on_time_rate",
-                 "avg_fill_rate"]],
-        on="product_id", how="left",
-    )
+    features = _merge_supplier(features, sup_raw)
 
     # Drop rows with insufficient lag history (first 28 days of each series).
     # Do NOT drop rows where target is NaN here — the last row of each series
@@ -353,29 +1001,86 @@ def build_features() -> pd.DataFrame:
 
     features["date"] = pd.to_datetime(features["date"])
     features = features.sort_values(["store_id", "product_id", "date"]).reset_index(drop=True)
+    return apply_feature_schema(features), demand_feat
 
-    n_train = features["target"].notna().sum()
-    n_infer = features["target"].isna().sum()
-    print(f"\n     Final feature matrix : {len(features):,} rows x {len(features.columns)} columns")
-    print(f"     Training rows (target known)  : {n_train:,}")
-    print(f"     Inference rows (target=NaN)   : {n_infer:,}  <- last date per series (2026-02-10)")
-    print(f"     Date range: {features['date'].min().date()} -> {features['date'].max().date()}")
-    print(f"     Store-product pairs: {features.groupby(['store_id','product_id']).ngroups:,}")
 
-    if LOCAL_FEATURES_PATH is not None:
-        Path(ML_LOCAL_ARTIFACT_DIR).mkdir(parents=True, exist_ok=True)
-        print(f"\n     Writing local features -> {LOCAL_FEATURES_PATH}")
-        features.to_parquet(LOCAL_FEATURES_PATH, index=False, engine="pyarrow")
-    else:
-        print(f"\n     Writing to s3://{BUCKET}/{FEATURES_S3_KEY} …")
-        buf = io.BytesIO()
-        features.to_parquet(buf, index=False, engine="pyarrow")
-        buf.seek(0)
-        get_s3_client().put_object(Bucket=BUCKET, Key=FEATURES_S3_KEY, Body=buf.getvalue())
+def build_features(incremental: bool | None = None,
+                   workers: int | None = None) -> pd.DataFrame:
+    print("=" * 70)
+    print("FEATURE ENGINEERING PIPELINE")
+    print("=" * 70)
+
+    sampled = is_sampled()
+    incremental = ML_FEATURES_INCREMENTAL if incremental is None else incremental
+    if incremental:
+        if sampled:
+            print("  Incremental mode is not used for sampled runs; running a full build")
+        else:
+            state = load_feature_state()
+            if state is None:
+                print("  No saved feature state; running a full build")
+            else:
+                features = _build_features_incremental(state)
+                if features is not None:
+                    return features
+
+    supplier_label = "dim_products + mart_supplier_performance"
+    if sampled:
+        print(f"  Sampling {describe_sample()}")
+
+    if ML_FEATURE_ENGINE == "sql":
+        from sql_features import build_features_sql
+
+        print("\n[1/2] Computing features in Athena (ML_FEATURE_ENGINE=sql) …")
+        features = apply_feature_schema(build_features_sql(sample_predicate("fct_daily_sales")))
+        print("\n[2/2] Writing features …")
+        _summarize_features(features)
+        write_features(features)
+        print("     Done.")
+        return features
+
+    print("\n[1/3] Loading supplier features, sales history and inventory snapshots from Athena …")
+    results = run_queries({
+        supplier_label:            apply_sample(SQL_SUPPLIER, "dim_products"),
+        "fct_daily_sales":         apply_sample(SQL_SALES, "fct_daily_sales"),
+        "fct_inventory_snapshots": apply_sample(SQL_INVENTORY, "fct_inventory_snapshots"),
+    }, unload=UNLOAD_LABELS)
+    sup_raw = results[supplier_label]
+
+    # run_queries returns typed columns (float64 / int / bool / datetime64);
+    # only NULL handling is left to do here.
+    print("\n[2/3] Preparing sales and inventory frames …")
+    sales_raw = results["fct_daily_sales"].fillna(SALES_FILL)
+    inv_raw = results["fct_inventory_snapshots"].fillna(INVENTORY_FILL)
+
+    print("\n[3/3] Building features …")
+    features, demand_feat = compute_features(sales_raw, inv_raw, sup_raw, workers)
+
+    _summarize_features(features)
+    version = write_features(features)
+    if incremental and not sampled:
+        save_feature_state(_capture_feature_state(sales_raw, inv_raw, demand_feat, sup_raw, version))
     print("     Done.")
 
     return features
 
 
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build the feature matrix")
+    parser.add_argument("--trend-parity", action="store_true",
+                        help="Check _rolling_trend_slope against _trend_slope instead of building.")
+    parser.add_argument("--series", type=int, default=300, help="Random series in the trend check.")
+    args = parser.parse_args()
+
+    if not args.trend_parity:
+        build_features()
+        return
+    report = check_trend_parity(args.series)
+    print(report.to_string(index=False))
+    if report["mismatches"].any():
+        raise SystemExit("Trend parity FAILED")
+    print(f"  Trend parity OK (rtol={TREND_PARITY_RTOL:g}, atol={TREND_PARITY_ATOL:g})")
+
+
 if __name__ == "__main__":
-    build_features()
+    main()
@@ -61,22 +61,27 @@ import pandas as pd
 from datetime import date, datetime
 from pathlib import Path
 
-from athena_client import run_query, get_s3_client, BUCKET
+from athena_client import run_queries, get_s3_client, BUCKET
+# Same supplier query as feature engineering, so the result cache serves both.
+from features import SQL_SUPPLIER
 from train import (
     FEATURE_COLS, CATEGORICAL_COLS, MODEL_VERSION, MODEL_S3_PREFIX,
-    FEATURES_S3_KEY, make_lgb_dataset, N_HORIZONS,
+    make_lgb_dataset, N_HORIZONS,
 )
+from feature_store import read_features
+from sampling import apply_sample
 
 SERVICE_LEVEL_Z = 1.65   # 95 % service level
 RECS_S3_PREFIX  = "ml/reorder_recommendations"
+# Rows used per series: the inference row and the 14 labelled rows before it
+# (demand_std_14d).
+FEATURE_TAIL_ROWS = 15
 ML_LOCAL_ARTIFACT_DIR = os.getenv("ML_LOCAL_ARTIFACT_DIR", "").strip()
 if ML_LOCAL_ARTIFACT_DIR:
     LOCAL_MODEL_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / f"demand_forecast_lgbm_{MODEL_VERSION}.pkl"
-    LOCAL_FEATURES_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_features.parquet"
     LOCAL_RECS_DIR = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_reorder_recommendations"
 else:
     LOCAL_MODEL_PATH = None
-    LOCAL_FEATURES_PATH = None
     LOCAL_RECS_DIR = None
 
 SQL_LATEST_INVENTORY = """
@@ -90,18 +95,6 @@ SQL_LATEST_INVENTORY = """
     WHERE snapshot_date = (SELECT MAX(snapshot_date) FROM retailops_marts.fct_inventory_snapshots)
 """
 
-SQL_SUPPLIER_LEAD = """
-    SELECT
-        p.product_id,
-        p.supplier_id,
-        CAST(sp.avg_actual_lead_time_days AS DOUBLE) AS avg_actual_lead_time_days,
-        CAST(sp.calculated_on_time_rate   AS DOUBLE) AS calculated_on_time_rate
-    FROM retailops_marts.dim_products p
-    LEFT JOIN retailops_marts.mart_supplier_performance sp
-      ON p.supplier_id = sp.supplier_id
-"""
-
-
 def _pipeline_date() -> str:
     """Return PIPELINE_DATE env var if set, otherwise today UTC."""
     return os.environ.get("PIPELINE_DATE", "").strip() or datetime.utcnow().strftime("%Y-%m-%d")
@@ -120,17 +113,30 @@ def load_models() -> dict:
 
 
 def load_features() -> pd.DataFrame:
-    if LOCAL_FEATURES_PATH is not None and LOCAL_FEATURES_PATH.exists():
-        print(f"  Loading features from local file: {LOCAL_FEATURES_PATH}")
-        df = pd.read_parquet(LOCAL_FEATURES_PATH)
-    else:
-        s3  = get_s3_client()
-        obj = s3.get_object(Bucket=BUCKET, Key=FEATURES_S3_KEY)
-        df  = pd.read_parquet(io.BytesIO(obj["Body"].read()))
-    df["date"] = pd.to_datetime(df["date"])
-    for col in FEATURE_COLS:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+    """
+    The last FEATURE_TAIL_ROWS rows of every series, wherever its latest row
+    falls. The series keys and dates are read first to find how far back that
+    reaches, so only those dates are read in full.
+    """
+    keys = read_features(columns=["date"])
+    if keys is None:
+        raise FileNotFoundError("No feature matrix found; run ml/features.py first")
+    series = ["store_id", "product_id"]
+    first_needed = (keys.groupby(series, observed=True, sort=False).tail(FEATURE_TAIL_ROWS)
+                        .groupby(series, observed=True)["date"].min()
+                        .rename("first_needed"))
+    latest = keys["date"].max()
+    last_row = keys.groupby(series, observed=True)["date"].max()
+    stale = int((last_row < latest).sum())
+    if stale:
+        print(f"  {stale:,} series end before {latest.date()}; their last rows are used "
+              f"(oldest {last_row.min().date()})")
+
+    start = first_needed.min()
+    print(f"  Loading features for {start.date()} -> {latest.date()} from the feature store")
+    df = read_features(columns=["target"] + FEATURE_COLS + CATEGORICAL_COLS, start=start)
+    df = df[df["date"] >= df.join(first_needed, on=series)["first_needed"]].reset_index(drop=True)
+    df[FEATURE_COLS] = df[FEATURE_COLS].fillna(0)
     return df
 
 
@@ -155,13 +161,15 @@ def generate_recommendations() -> pd.DataFrame:
     features = load_features()
 
     print("\n[2/4] Loading latest inventory and supplier data from Athena …")
-    inv = run_query(SQL_LATEST_INVENTORY, "latest inventory")
-    for col in ["quantity_on_hand", "quantity_on_order", "reorder_point"]:
-        inv[col] = pd.to_numeric(inv[col], errors="coerce").fillna(0)
-
-    sup = run_query(SQL_SUPPLIER_LEAD, "supplier lead times")
-    for col in ["avg_actual_lead_time_days", "calculated_on_time_rate"]:
-        sup[col] = pd.to_numeric(sup[col], errors="coerce")
+    # Sampled runs read the same sample as feature engineering.
+    results = run_queries({
+        "latest inventory":    apply_sample(SQL_LATEST_INVENTORY, "fct_inventory_snapshots"),
+        "supplier lead times": apply_sample(SQL_SUPPLIER, "dim_products"),
+    })
+    inv = results["latest inventory"].fillna(
+        {"quantity_on_hand": 0, "quantity_on_order": 0, "reorder_point": 0}
+    )
+    sup = results["supplier lead times"]
 
     print("\n[3/4] Generating 7-day forecasts from inference rows ...")
     # Use NaN-target rows as the inference slice (last date per series = 2026-02-10).
@@ -179,8 +187,6 @@ def generate_recommendations() -> pd.DataFrame:
     print(f"  h=1 forecast -> {(inference_date + pd.Timedelta(days=1)).date()}")
 
     infer_clean = infer_rows.dropna(subset=FEATURE_COLS).copy()
-    for col in CATEGORICAL_COLS:
-        infer_clean[col] = infer_clean[col].astype("category")
 
     # collect per-horizon predictions
     horizon_preds = {}
@@ -196,7 +202,7 @@ def generate_recommendations() -> pd.DataFrame:
     # demand std dev over trailing 14 days (from labelled rows only)
     demand_std = (
         features[features["target"].notna()]
-        .groupby(["store_id", "product_id"])
+        .groupby(["store_id", "product_id"], observed=True)
         .apply(lambda g: g.sort_values("date").tail(14)["target"].std())
         .reset_index()
         .rename(columns={0: "demand_std_14d"})
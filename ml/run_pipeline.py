@@ -4,7 +4,10 @@ ml/run_pipeline.py
 ECS entrypoint for the ML pipeline.
 
 Called by the ECS task command:
-    python run_pipeline.py [--date YYYY-MM-DD] [--sample-frac 0.01] [--local-artifacts ./tmp]
+    python run_pipeline.py [--date YYYY-MM-DD] [--sample-frac 0.01] [--sample-stratify store|category]
+                           [--local-artifacts ./tmp]
+                           [--query-cache] [--incremental] [--feature-workers N]
+                           [--feature-engine pandas|sql] [--optuna-workers N]
 
 Runs the four ML stages in order:
     1. features.py   — feature engineering from Athena mart tables
@@ -16,6 +19,33 @@ The --date argument is passed in by Step Functions via ContainerOverrides
 on the PIPELINE_DATE environment variable. If not provided, defaults to
 today's date (UTC).
 
+Athena execution statistics for every query the stages ran (engine time,
+queue time, data scanned, result rows) are written at the end of the run,
+including failed runs, to:
+    s3://retailops-data-lake-{region}/ml/query_stats/dt=YYYY-MM-DD/query_stats.json
+or <local-artifacts>/ml_query_stats/query_stats_YYYY-MM-DD.json
+
+With --local-artifacts and --query-cache, Athena results are cached under
+<local-artifacts>/athena_cache and reused by later stages and re-runs until a
+mart they read is rebuilt (see athena_client.py).
+
+Within a run, the stages after feature engineering read the matrix from a
+memory-mapped Arrow copy in a temporary directory of the run's own
+(ML_FEATURE_CACHE_PATH), removed when the run exits (see feature_store.py).
+
+With --incremental, feature engineering only computes the dates that arrived
+since the previous run, from per-series state saved next to the feature
+matrix (see features.py).
+
+With --feature-workers N, a full feature build runs the per-store feature
+work in N processes (ML_FEATURE_WORKERS=N). --feature-engine sql computes
+the features in Athena with window functions instead (ML_FEATURE_ENGINE=sql,
+see sql_features.py).
+
+With --optuna-workers N, training runs the Optuna trials in N processes
+that share a SQLite study under the artifact dir, with the LightGBM threads
+split between them (ML_OPTUNA_WORKERS=N, see train.py).
+
 Exit codes:
     0 — all stages completed successfully
     1 — one or more stages failed (Step Functions will catch this and route
@@ -23,9 +53,15 @@ Exit codes:
 """
 
 import argparse
+import atexit
 import os
+import shutil
 import sys
+import tempfile
 from datetime import date, datetime, timezone
+from pathlib import Path
+
+QUERY_STATS_S3_PREFIX = "ml/query_stats"
 
 
 def _resolve_date(arg_date: str | None) -> str:
@@ -38,6 +74,32 @@ def _resolve_date(arg_date: str | None) -> str:
     return datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
 
+def _tag_query_stats(records: list[dict], stage_name: str) -> None:
+    """Label the query stats records produced by one stage with its name."""
+    for record in records:
+        record["stage"] = stage_name
+
+
+def _write_query_stats(pipeline_date: str) -> None:
+    """Persist the Athena query statistics collected by athena_client this run."""
+    import athena_client
+
+    if not athena_client.QUERY_STATS:
+        return
+    local_dir = os.environ.get("ML_LOCAL_ARTIFACT_DIR", "").strip()
+    if local_dir:
+        path = Path(local_dir) / "ml_query_stats" / f"query_stats_{pipeline_date}.json"
+        athena_client.dump_query_stats(path)
+        print(f"Query stats   : {path}")
+    else:
+        key = f"{QUERY_STATS_S3_PREFIX}/dt={pipeline_date}/query_stats.json"
+        athena_client.get_s3_client().put_object(
+            Bucket=athena_client.BUCKET, Key=key,
+            Body=athena_client.dump_query_stats().encode(),
+        )
+        print(f"Query stats   : s3://{athena_client.BUCKET}/{key}")
+
+
 def main():
     parser = argparse.ArgumentParser(description="RetailOps ML pipeline entrypoint")
     parser.add_argument(
@@ -52,25 +114,73 @@ def main():
         default=None,
         help="Optional sample fraction for feature engineering (e.g. 0.01 for 1%).",
     )
+    parser.add_argument(
+        "--sample-stratify",
+        choices=["store", "category"],
+        default=None,
+        help="Sample store × product series, or products within each category (ML_SAMPLE_STRATIFY).",
+    )
     parser.add_argument(
         "--local-artifacts",
         type=str,
         default=None,
         help="Optional local path to write and read ML artifacts instead of S3.",
     )
+    parser.add_argument(
+        "--query-cache",
+        action="store_true",
+        help="Cache Athena results as Parquet under the local artifact dir (ML_QUERY_CACHE=1).",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Append features for new dates only, using saved per-series state (ML_FEATURES_INCREMENTAL=1).",
+    )
+    parser.add_argument(
+        "--feature-workers",
+        type=int,
+        default=None,
+        help="Processes for the per-store feature build (ML_FEATURE_WORKERS, default 1).",
+    )
+    parser.add_argument(
+        "--feature-engine",
+        choices=["pandas", "sql"],
+        default=None,
+        help="Compute features in pandas (default) or in Athena SQL (ML_FEATURE_ENGINE).",
+    )
+    parser.add_argument(
+        "--optuna-workers",
+        type=int,
+        default=None,
+        help="Processes for the Optuna search, sharing a local SQLite study (ML_OPTUNA_WORKERS, default 1).",
+    )
     args = parser.parse_args()
     pipeline_date = _resolve_date(args.date)
 
     if args.sample_frac is not None:
         os.environ["ML_SAMPLE_FRACTION"] = str(args.sample_frac)
+    if args.sample_stratify is not None:
+        os.environ["ML_SAMPLE_STRATIFY"] = args.sample_stratify
     if args.local_artifacts:
         os.environ["ML_LOCAL_ARTIFACT_DIR"] = args.local_artifacts
+    if args.query_cache:
+        os.environ["ML_QUERY_CACHE"] = "1"
+    if args.incremental:
+        os.environ["ML_FEATURES_INCREMENTAL"] = "1"
+    if args.feature_workers is not None:
+        os.environ["ML_FEATURE_WORKERS"] = str(args.feature_workers)
+    if args.feature_engine is not None:
+        os.environ["ML_FEATURE_ENGINE"] = args.feature_engine
+    if args.optuna_workers is not None:
+        os.environ["ML_OPTUNA_WORKERS"] = str(args.optuna_workers)
 
     print("=" * 70)
     print("RETAILOPS ML PIPELINE")
     print(f"Pipeline date : {pipeline_date}")
     if args.sample_frac is not None:
         print(f"Sample fraction: {args.sample_frac}")
+    if args.sample_stratify is not None:
+        print(f"Sample stratify: {args.sample_stratify}")
     if args.local_artifacts:
         print(f"Local artifacts: {args.local_artifacts}")
     print(f"Started at    : {datetime.now(timezone.utc).isoformat()}")
@@ -87,10 +197,19 @@ def main():
         ("Reorder Recommendations",  "reorder_recommendations", "generate_recommendations"),
     ]
 
+    # The stages share the feature matrix through a cache file private to this run.
+    if not os.environ.get("ML_FEATURE_CACHE_PATH", "").strip():
+        cache_dir = tempfile.mkdtemp(prefix="retailops-ml-")
+        atexit.register(shutil.rmtree, cache_dir, ignore_errors=True)
+        os.environ["ML_FEATURE_CACHE_PATH"] = str(Path(cache_dir) / "ml_features.arrow")
+
+    import athena_client
+
     for stage_name, module_path, fn_name in stages:
         print(f"\n{'─' * 70}")
         print(f"STAGE: {stage_name}")
         print(f"{'─' * 70}")
+        n_queries_before = len(athena_client.QUERY_STATS)
         try:
             import importlib
             module = importlib.import_module(module_path)
@@ -100,7 +219,12 @@ def main():
             print(f"\n[FATAL] Stage '{stage_name}' failed: {exc}", file=sys.stderr)
             import traceback
             traceback.print_exc(file=sys.stderr)
+            _tag_query_stats(athena_client.QUERY_STATS[n_queries_before:], stage_name)
+            _write_query_stats(pipeline_date)
             sys.exit(1)
+        _tag_query_stats(athena_client.QUERY_STATS[n_queries_before:], stage_name)
+
+    _write_query_stats(pipeline_date)
 
     print("\n" + "=" * 70)
     print("ML PIPELINE COMPLETE")
@@ -0,0 +1,116 @@
+"""
+ml/sampling.py
+==============
+Deterministic sampling of the mart queries for ML_SAMPLE_FRACTION < 1.
+
+A sampled run keeps a row when a stable hash of its key falls in the first
+k of SAMPLE_BUCKETS buckets, k = ML_SAMPLE_FRACTION × SAMPLE_BUCKETS:
+
+    mod(from_big_endian_64(xxhash64(to_utf8(product_id))), 1000) < k
+
+The predicate goes into every query that reads a sampled table (sales,
+inventory, products, latest inventory), so all of them select the same
+series without a separate lookup query. Features, training and
+recommendations therefore see the same sample, and the same fraction
+selects the same series in every run.
+
+ML_SAMPLE_STRATIFY chooses what is sampled:
+    (unset)   products; a sampled product is kept in every store.
+    store     store × product series, hashed together, so every store keeps
+              about the same share of its own products.
+    category  products, ranked by hash within each category of dim_products,
+              keeping ceil(fraction × products in the category), so every
+              category keeps its share and at least one product.
+
+The DuckDB backend shims xxhash64 / to_utf8 / from_big_endian_64 with its
+own hash (see athena_client.py). Local samples are just as stable, but are
+not the same series Athena picks.
+"""
+
+import os
+
+ML_SAMPLE_FRACTION = float(os.getenv("ML_SAMPLE_FRACTION", "1.0"))
+ML_SAMPLE_STRATIFY = os.getenv("ML_SAMPLE_STRATIFY", "").strip().lower()
+SAMPLE_BUCKETS     = 1000
+STRATIFY_OPTIONS   = ("", "store", "category")
+
+# Key columns of each sampled mart table.
+TABLE_KEYS = {
+    "fct_daily_sales":         ("store_id", "product_id"),
+    "fct_inventory_snapshots": ("store_id", "product_id"),
+    "dim_products":            ("product_id",),
+}
+
+if ML_SAMPLE_STRATIFY not in STRATIFY_OPTIONS:
+    raise ValueError(f"ML_SAMPLE_STRATIFY must be one of {STRATIFY_OPTIONS[1:]}, "
+                     f"got {ML_SAMPLE_STRATIFY!r}")
+
+
+def is_sampled() -> bool:
+    return 0 < ML_SAMPLE_FRACTION < 1.0
+
+
+def _hash(expr: str) -> str:
+    return f"from_big_endian_64(xxhash64(to_utf8({expr})))"
+
+
+def _buckets_kept() -> int:
+    return max(1, round(ML_SAMPLE_FRACTION * SAMPLE_BUCKETS))
+
+
+def _in_bucket(expr: str) -> str:
+    # mod() keeps the sign of the (signed) hash; shift it into [0, SAMPLE_BUCKETS).
+    bucket = f"mod(mod({_hash(expr)}, {SAMPLE_BUCKETS}) + {SAMPLE_BUCKETS}, {SAMPLE_BUCKETS})"
+    return f"{bucket} < {_buckets_kept()}"
+
+
+def sample_predicate(table: str) -> str | None:
+    """
+    Condition on the columns of retailops_marts.<table> that selects this
+    run's sample, or None for a full run (or a table the sample does not
+    restrict, such as dim_products when sampling store × product series).
+    """
+    if not is_sampled():
+        return None
+    keys = TABLE_KEYS[table]
+    if ML_SAMPLE_STRATIFY == "store":
+        if "store_id" not in keys:
+            return None
+        return _in_bucket("store_id || ':' || product_id")
+    if ML_SAMPLE_STRATIFY == "category":
+        return f"""product_id IN (
+            SELECT product_id FROM (
+                SELECT product_id,
+                       row_number() OVER (PARTITION BY category
+                                          ORDER BY {_hash("product_id")}, product_id) AS sample_rank,
+                       count(*) OVER (PARTITION BY category) AS category_products
+                FROM retailops_marts.dim_products
+            ) ranked
+            WHERE sample_rank <= ceil(category_products * {ML_SAMPLE_FRACTION})
+        )"""
+    return _in_bucket("product_id")
+
+
+def apply_sample(sql: str, table: str) -> str:
+    """
+    `sql` with its first read of retailops_marts.<table> replaced by a
+    subquery restricted to the sample. Aliases and any WHERE clause of the
+    outer query are kept. Returns `sql` unchanged for a full run. Raises
+    ValueError if `sql` does not read the table, also on a full run, so a
+    renamed table cannot silently turn a sampled run into a full one.
+    """
+    source = f"retailops_marts.{table}"
+    if f"FROM {source}" not in sql:
+        raise ValueError(f"query does not read FROM {source}; cannot apply the sample")
+    condition = sample_predicate(table)
+    if condition is None:
+        return sql
+    return sql.replace(f"FROM {source}", f"FROM (SELECT * FROM {source} WHERE {condition})", 1)
+
+
+def describe_sample() -> str:
+    unit = {"": "products", "store": "store × product series",
+            "category": "products per category"}[ML_SAMPLE_STRATIFY]
+    if ML_SAMPLE_STRATIFY == "category":
+        return f"{ML_SAMPLE_FRACTION:.2%} of {unit} (hash-ranked)"
+    return f"{_buckets_kept()}/{SAMPLE_BUCKETS} hash buckets of {unit}"
@@ -0,0 +1,327 @@
+"""
+ml/sql_features.py
+==================
+SQL feature engine: computes the feature matrix inside Athena with window
+functions, so only the finished feature rows leave the warehouse instead of
+the full raw sales and inventory history.
+
+Selected with ML_FEATURE_ENGINE=sql (see features.py). The demand columns
+are compiled from the same declarations as the pandas engine
+(DEMAND_FEATURES in feature_registry.py: transform, window, min_periods,
+fill, and the sql form of each expr feature), and each keeps the pandas
+semantics:
+
+    lag                LAG(q, k)
+    roll_*             AVG / STDDEV_SAMP / MIN / MAX over the window rows
+                       before the current one, NULL below min_periods
+    ewm_mean           adjusted EWM over all earlier rows, as
+                       SUM(q·β^-rn) / SUM(β^-rn) with β = 1 - 2 / (span + 1)
+    trend              REGR_SLOPE over the window rows before the current one
+    region_avg_demand_7d  per region × product × date mean of lag_1, then a
+                       7-row rolling mean
+
+The β^-rn weights grow with the row number, so the EWM is only exact for
+series up to SQL_EWM_MAX_ROWS rows (about 6.5 years of daily history for
+span 7). Beyond that the weights overflow and build_features_sql raises
+instead of returning wrong values.
+
+Parity with the pandas engine is checked on a product sample with
+
+    python ml/sql_features.py --parity [--products 20]
+
+which also runs offline against the DuckDB backend (ATHENA_BACKEND=duckdb).
+The two engines agree to float rounding.
+"""
+
+import argparse
+import math
+import re
+
+import numpy as np
+import pandas as pd
+
+from athena_client import run_queries
+from feature_registry import DEMAND_FEATURES, INTERMEDIATES
+from feature_store import apply_feature_schema
+from features import (
+    CONTEXT_COLS, EWM_SPANS, INVENTORY_FILL, LAGS, MIN_HISTORY_DAYS, REGION_WINDOW, SALES_FILL,
+    SQL_INVENTORY, SQL_INVENTORY_TEMPLATE, SQL_SALES, SQL_SALES_TEMPLATE, SQL_SUPPLIER,
+    STOCKOUT_WINDOW, SUPPLIER_COLS, UNLOAD_LABELS, _with_filter, compute_features,
+)
+
+SQL_FEATURES_LABEL = "features (sql engine)"
+# Largest row number whose EWM weight β^-rn still fits in a double, for the
+# smallest span.
+SQL_EWM_MAX_ROWS = int(math.log(np.finfo(np.float64).max) / -math.log(1 - 2 / (min(EWM_SPANS) + 1)))
+
+PARITY_RTOL = 1e-6
+PARITY_ATOL = 1e-6
+
+_ORDER_BY_RE = re.compile(r"\s+ORDER\s+BY\s[^)]*$", re.IGNORECASE)
+
+_SERIES = "PARTITION BY store_id, product_id ORDER BY sale_date"
+
+# Sales columns that the sales CTE renames.
+_SQL_COLUMNS = {"quantity_sold": "q"}
+
+_ROLL_SQL = {"roll_mean": "AVG", "roll_std": "STDDEV_SAMP", "roll_min": "MIN", "roll_max": "MAX"}
+
+
+def _subquery(sql: str) -> str:
+    """SQL_SALES / SQL_INVENTORY without the trailing ORDER BY."""
+    return _ORDER_BY_RE.sub("", sql.strip())
+
+
+def _frame(n_rows: int | None, shift: int) -> str:
+    """
+    Window over the n_rows rows ending `shift` rows before the current one
+    (all of them from the series start if n_rows is None).
+    """
+    start = "UNBOUNDED PRECEDING" if n_rows is None else f"{n_rows + shift - 1} PRECEDING"
+    end = "CURRENT ROW" if shift == 0 else f"{shift} PRECEDING"
+    return f"OVER ({_SERIES} ROWS BETWEEN {start} AND {end})"
+
+
+def _at_least(column: str, frame: str, min_periods: int | None, expr: str) -> str:
+    if not min_periods:
+        return expr
+    return f"CASE WHEN COUNT({column}) {frame} >= {min_periods} THEN {expr} END"
+
+
+def _fill(column: str, value) -> str:
+    literal = ("TRUE" if value else "FALSE") if isinstance(value, bool) else repr(value)
+    return f"COALESCE({column}, {literal}) AS {column}"
+
+
+def _demand_columns() -> list[str]:
+    """
+    DEMAND_FEATURES compiled from their registry declarations. A window over
+    a lag feature becomes the same window over its source column, moved back
+    by the lag, so every rolling statistic reads q directly.
+    """
+    declared = {f.name: f for f in INTERMEDIATES + DEMAND_FEATURES}
+
+    def shifted(name: str) -> tuple[str, int]:
+        """(column, rows back) that the feature or column `name` reads."""
+        if name not in declared:
+            return _SQL_COLUMNS.get(name, name), 0
+        f = declared[name]
+        if f.transform != "lag":
+            raise ValueError(f"SQL feature engine: cannot window over feature {name!r}")
+        column, shift = shifted(f.source)
+        return column, shift + f.window
+
+    def sql(name: str) -> str:
+        if name not in declared:
+            return _SQL_COLUMNS.get(name, name)
+        f = declared[name]
+        if f.transform == "lag":
+            column, shift = shifted(name)
+            out = f"LAG({column}, {shift}) OVER ({_SERIES})"
+        elif f.transform == "lead":
+            column, shift = shifted(f.source)
+            if shift:
+                raise ValueError(f"SQL feature engine: {name!r} leads a lagged feature")
+            out = f"LEAD({column}, {f.window}) OVER ({_SERIES})"
+        elif f.transform in _ROLL_SQL or f.transform in ("ewm_mean", "trend"):
+            column, shift = shifted(f.source)
+            if f.transform == "ewm_mean":
+                frame = _frame(None, shift)
+                weight = f"POWER({1 - 2 / (f.window + 1)!r}, -CAST(rn AS DOUBLE))"
+                out = f"SUM({column} * {weight}) {frame} / SUM({weight}) {frame}"
+            elif f.transform == "trend":
+                frame = _frame(f.window, shift)
+                out = f"REGR_SLOPE({column}, CAST(rn AS DOUBLE)) {frame}"
+            else:
+                frame = _frame(f.window, shift)
+                out = f"{_ROLL_SQL[f.transform]}({column}) {frame}"
+            out = _at_least(column, frame, f.min_periods, out)
+        elif f.transform == "expr":
+            out = f.sql.format(**{
+                col: f"({sql(col)})" if col in declared else sql(col)
+                for col in f.inputs
+            })
+        else:
+            raise ValueError(f"Feature {f.name!r}: unknown transform {f.transform!r}")
+        if f.fill is not None:
+            out = f"COALESCE({out}, {f.fill!r})"
+        return out
+
+    return [f"{sql(f.name)} AS {f.name}" for f in DEMAND_FEATURES]
+
+
+def feature_sql(product_filter: str | None = None) -> str:
+    """The full feature query, optionally restricted by a product_id condition."""
+    sales_sql, inventory_sql = SQL_SALES, SQL_INVENTORY
+    if product_filter:
+        sales_sql = _with_filter(SQL_SALES_TEMPLATE, product_filter)
+        inventory_sql = _with_filter(SQL_INVENTORY_TEMPLATE, product_filter)
+
+    sales_cols = ["sale_date", "store_id", "product_id", "region", "store_type", "category"]
+    sales_cols += [_fill(col, value) for col, value in SALES_FILL.items() if col != "quantity_sold"]
+    inventory_fill = [_fill(col, value) for col, value in INVENTORY_FILL.items()]
+    lag_28 = f"lag_{max(LAGS)}"
+    context = ", ".join(f"d.{col}" for col in CONTEXT_COLS)
+    demand = ",\n            ".join(_demand_columns())
+    demand_out = ", ".join(f"d.{f.name}" for f in DEMAND_FEATURES)
+    supplier = ", ".join(f"s.{col}" for col in SUPPLIER_COLS)
+
+    return f"""
+    WITH sales AS (
+        SELECT
+            {", ".join(sales_cols)},
+            COALESCE(quantity_sold, 0) AS q,
+            COUNT(*) OVER (PARTITION BY store_id, product_id) AS n_rows
+        FROM ({_subquery(sales_sql)}) raw
+    ),
+    history AS (
+        SELECT *, ROW_NUMBER() OVER ({_SERIES}) AS rn
+        FROM sales
+        WHERE n_rows >= {MIN_HISTORY_DAYS}
+    ),
+    demand AS (
+        SELECT
+            store_id, product_id, sale_date, rn,
+            {", ".join(CONTEXT_COLS)},
+            {demand}
+        FROM history
+    ),
+    inventory AS (
+        SELECT
+            store_id, product_id, snapshot_date,
+            {", ".join(inventory_fill)}
+        FROM ({_subquery(inventory_sql)}) raw
+    ),
+    inventory_features AS (
+        SELECT
+            store_id, product_id, snapshot_date,
+            quantity_on_hand, quantity_on_order, reorder_point,
+            CASE WHEN needs_reorder THEN 1 ELSE 0 END AS needs_reorder,
+            AVG(CASE WHEN is_out_of_stock THEN 1e0 ELSE 0e0 END) OVER (
+                PARTITION BY store_id, product_id ORDER BY snapshot_date
+                ROWS BETWEEN {STOCKOUT_WINDOW - 1} PRECEDING AND CURRENT ROW
+            ) AS stockout_freq_14d
+        FROM inventory
+    ),
+    region_daily AS (
+        SELECT region, product_id, sale_date, AVG(lag_1) AS region_lag1
+        FROM demand
+        GROUP BY region, product_id, sale_date
+    ),
+    region_rolling AS (
+        SELECT
+            region, product_id, sale_date,
+            AVG(region_lag1) OVER (
+                PARTITION BY region, product_id ORDER BY sale_date
+                ROWS BETWEEN {REGION_WINDOW - 1} PRECEDING AND CURRENT ROW
+            ) AS region_avg_demand_7d
+        FROM region_daily
+    ),
+    supplier AS ({_subquery(SQL_SUPPLIER)})
+    SELECT
+        d.sale_date AS "date", d.store_id, d.product_id,
+        {context},
+        {demand_out},
+        i.quantity_on_hand, i.quantity_on_order, i.reorder_point,
+        i.needs_reorder, i.stockout_freq_14d,
+        CASE WHEN i.quantity_on_hand < 0 THEN 0 ELSE i.quantity_on_hand END
+            / CASE WHEN d.roll_mean_7 < 0.01 THEN 0.01 ELSE d.roll_mean_7 END
+            AS days_of_stock_remaining,
+        r.region_avg_demand_7d,
+        {supplier}
+    FROM demand d
+    LEFT JOIN inventory_features i
+        ON i.store_id = d.store_id AND i.product_id = d.product_id AND i.snapshot_date = d.sale_date
+    LEFT JOIN region_rolling r
+        ON r.region = d.region AND r.product_id = d.product_id AND r.sale_date = d.sale_date
+    LEFT JOIN supplier s
+        ON s.product_id = d.product_id
+    WHERE d.{lag_28} IS NOT NULL
+"""
+
+
+def build_features_sql(product_filter: str | None = None) -> pd.DataFrame:
+    """Feature matrix computed by the SQL engine, in the pandas engine's row and column order."""
+    unload = (SQL_FEATURES_LABEL,) if UNLOAD_LABELS else ()
+    features = run_queries({SQL_FEATURES_LABEL: feature_sql(product_filter)}, unload=unload)[
+        SQL_FEATURES_LABEL
+    ]
+    ewm_cols = [f"ewm_mean_{span}" for span in EWM_SPANS]
+    if features[ewm_cols].isna().any().any():
+        raise ValueError(
+            f"SQL feature engine: EWM weights overflowed for a series longer than "
+            f"{SQL_EWM_MAX_ROWS} rows; use ML_FEATURE_ENGINE=pandas"
+        )
+    features["date"] = pd.to_datetime(features["date"])
+    for col in ["store_id", "product_id"]:
+        features[col] = features[col].astype(object)
+    return features.sort_values(["store_id", "product_id", "date"]).reset_index(drop=True)
+
+
+def check_parity(n_products: int = 20, seed: int = 0) -> pd.DataFrame:
+    """
+    Build the features of a random product sample with both engines and
+    compare them column by column. Returns one row per column with the
+    number of mismatching values and the largest absolute difference.
+    """
+    products = run_queries({"parity products": SQL_SUPPLIER})["parity products"]["product_id"]
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(np.sort(products.astype(str).unique()),
+                        size=min(n_products, products.nunique()), replace=False)
+    product_filter = "product_id IN ({})".format(",".join(f"'{p}'" for p in sorted(sample)))
+    print(f"  Parity sample: {len(sample)} products")
+
+    results = run_queries({
+        "fct_daily_sales (parity)":         _with_filter(SQL_SALES_TEMPLATE, product_filter),
+        "fct_inventory_snapshots (parity)": _with_filter(SQL_INVENTORY_TEMPLATE, product_filter),
+        "supplier (parity)":                SQL_SUPPLIER,
+    })
+    expected, _ = compute_features(
+        results["fct_daily_sales (parity)"].fillna(SALES_FILL),
+        results["fct_inventory_snapshots (parity)"].fillna(INVENTORY_FILL),
+        results["supplier (parity)"],
+        workers=1,
+    )
+    actual = apply_feature_schema(build_features_sql(product_filter))
+
+    if len(expected) != len(actual) or list(expected.columns) != list(actual.columns):
+        raise AssertionError(
+            f"shape/columns differ: pandas {expected.shape} {list(expected.columns)} "
+            f"vs sql {actual.shape} {list(actual.columns)}"
+        )
+    report = []
+    for col in expected.columns:
+        a, b = expected[col], actual[col]
+        if pd.api.types.is_numeric_dtype(a) and not pd.api.types.is_bool_dtype(a):
+            a, b = a.to_numpy("float64"), b.to_numpy("float64")
+            close = np.isclose(a, b, rtol=PARITY_RTOL, atol=PARITY_ATOL, equal_nan=True)
+            diff = np.abs(a - b)
+            max_diff = float(np.nanmax(diff)) if np.isfinite(diff).any() else 0.0
+        else:
+            close = (a.astype(str).to_numpy() == b.astype(str).to_numpy())
+            max_diff = np.nan
+        report.append({"column": col, "mismatches": int((~close).sum()), "max_abs_diff": max_diff})
+    return pd.DataFrame(report)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="SQL feature engine tools")
+    parser.add_argument("--parity", action="store_true",
+                        help="Compare the SQL engine with the pandas engine on a product sample.")
+    parser.add_argument("--products", type=int, default=20, help="Products in the parity sample.")
+    parser.add_argument("--print-sql", action="store_true", help="Print the generated feature query.")
+    args = parser.parse_args()
+
+    if args.print_sql:
+        print(feature_sql())
+    if args.parity:
+        report = check_parity(args.products)
+        print(report.to_string(index=False))
+        failed = report[report["mismatches"] > 0]
+        if not failed.empty:
+            raise SystemExit(f"Parity FAILED for: {', '.join(failed['column'])}")
+        print("  Parity OK")
+
+
+if __name__ == "__main__":
+    main()
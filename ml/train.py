@@ -37,60 +37,94 @@ Model: LightGBM direct multi-step
     error accumulation from recursive forecasting and allows each horizon to
     learn different feature relationships (e.g. lag_7 is more informative
     for h=7 than for h=1).
+
+Parallel search
+---------------
+With ML_OPTUNA_WORKERS=N (run_pipeline.py --optuna-workers N), the Optuna
+trials run in N processes that share one study in a local SQLite store
+(<artifact dir>/ml_optuna/studies.db, or under the temp dir). The workers
+memory-map the parent's training frame from one Arrow IPC file, build their
+own CV Datasets from it with the parent's day0, and train with cores // N
+LightGBM threads. Before each trial a worker counts the trials that have
+completed, been pruned or are still running, and stops at N_OPTUNA_TRIALS;
+failed and abandoned trials do not use up the budget. Only workers that
+check at the same moment can still overshoot. The study is named after
+the training data and a hash of the rows, their schema, SEARCH_SPACE, the
+CV setup and train.py itself, so only a rerun with all of those unchanged
+resumes it.
+
+Trials report their mean WAPE after each CV fold, and a median pruner stops
+those already worse than the median of earlier trials at that fold. Pruned
+trials are listed in the metadata under optuna_search.
 """
 
+import hashlib
 import io
 import json
+import multiprocessing
 import os
 import pickle
+import tempfile
 import warnings
 import numpy as np
 import pandas as pd
 import lightgbm as lgb
 import optuna
 import boto3
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 from athena_client import get_s3_client, BUCKET
+from feature_registry import FEATURE_COLS
+from feature_store import read_features
+from features import _read_ipc, _write_ipc
 
 warnings.filterwarnings("ignore", category=UserWarning)
 optuna.logging.set_verbosity(optuna.logging.WARNING)
 
-FEATURES_S3_KEY   = "ml/features/features.parquet"
-MODEL_VERSION     = "v1"
-MODEL_S3_PREFIX   = "ml/models"
-N_HORIZONS        = 7
-N_OPTUNA_TRIALS   = 50
-
+MODEL_VERSION      = "v1"
+MODEL_S3_PREFIX    = "ml/models"
+N_HORIZONS         = 7
+N_OPTUNA_TRIALS    = 50
+CV_NUM_BOOST_ROUND = 300
+OPTUNA_PRUNER_STARTUP_TRIALS = 5   # trials that always run every fold
+# Trial states that use up N_OPTUNA_TRIALS; FAIL and orphaned RUNNING trials do not.
+BUDGET_STATES = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+
+# Dataset parameters of the CV sets. Without feature pre-filtering the bins
+# do not depend on min_child_samples, so one binned Dataset serves every trial.
+# A feature that cannot be split at a trial's min_child_samples then stays in
+# the feature_fraction draw, so CV WAPE can differ slightly from a fit on a
+# freshly built Dataset (see model_card.md).
+CV_DATASET_PARAMS = {"feature_pre_filter": False, "verbose": -1}
+
+ML_OPTUNA_WORKERS = int(os.getenv("ML_OPTUNA_WORKERS", "1"))
 ML_LOCAL_ARTIFACT_DIR = os.getenv("ML_LOCAL_ARTIFACT_DIR", "").strip()
 if ML_LOCAL_ARTIFACT_DIR:
-    LOCAL_FEATURES_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_features.parquet"
     LOCAL_MODEL_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / f"demand_forecast_lgbm_{MODEL_VERSION}.pkl"
     LOCAL_METADATA_PATH = Path(ML_LOCAL_ARTIFACT_DIR) / f"demand_forecast_lgbm_{MODEL_VERSION}_metadata.json"
+    LOCAL_OPTUNA_DIR = Path(ML_LOCAL_ARTIFACT_DIR) / "ml_optuna"
 else:
-    LOCAL_FEATURES_PATH = None
     LOCAL_MODEL_PATH = None
     LOCAL_METADATA_PATH = None
-
-FEATURE_COLS = [
-    "lag_1", "lag_7", "lag_14", "lag_28",
-    "roll_mean_7", "roll_std_7", "roll_min_7", "roll_max_7",
-    "roll_mean_14", "roll_std_14", "roll_min_14", "roll_max_14",
-    "roll_mean_28", "roll_std_28", "roll_min_28", "roll_max_28",
-    "ewm_mean_7", "ewm_mean_14",
-    "demand_trend_14d",
-    "has_discount", "discount_pct", "price_vs_30d_avg",
-    "days_since_period_start", "day_of_week", "month_of_year",
-    "is_weekend",
-    "quantity_on_hand", "quantity_on_order", "reorder_point",
-    "needs_reorder", "stockout_freq_14d", "days_of_stock_remaining",
-    "avg_actual_lead_time_days", "calculated_on_time_rate", "avg_fill_rate",
-    "region_avg_demand_7d",
-]
+    LOCAL_OPTUNA_DIR = Path(tempfile.gettempdir()) / "retailops_ml_optuna"
 
 CATEGORICAL_COLS = ["store_id", "product_id", "region", "store_type", "category"]
 
+# Optuna search space: name -> (type, low, high, log scale), suggested in this
+# order; FIXED_PARAMS are added to every trial and to the final models.
+SEARCH_SPACE = {
+    "num_leaves":        ("int",   20,   150,  False),
+    "learning_rate":     ("float", 0.01, 0.2,  True),
+    "min_child_samples": ("int",   5,    50,   False),
+    "feature_fraction":  ("float", 0.5,  1.0,  False),
+    "bagging_fraction":  ("float", 0.5,  1.0,  False),
+    "reg_alpha":         ("float", 1e-4, 1.0,  True),
+    "reg_lambda":        ("float", 1e-4, 1.0,  True),
+}
+FIXED_PARAMS = {"bagging_freq": 1, "objective": "regression_l1"}
+
 
 # ---------------------------------------------------------------------------
 # Metrics
@@ -157,7 +191,7 @@ def evaluate_baselines(df: pd.DataFrame,
         ("rolling_mean",   lambda s: rolling_mean_forecast(s)),
     ]:
         preds, actuals = [], []
-        for (store_id, product_id), val_grp in val.groupby(["store_id", "product_id"]):
+        for (store_id, product_id), val_grp in val.groupby(["store_id", "product_id"], observed=True):
             hist = train[
                 (train["store_id"] == store_id) &
                 (train["product_id"] == product_id)
@@ -211,24 +245,70 @@ def make_lgb_dataset(df: pd.DataFrame, horizon: int) -> tuple:
     df = df.copy()
     # Restrict to labelled rows only before shifting
     df = df[df["target"].notna()]
-    df["target_h"] = df.groupby(["store_id", "product_id"])["target"].shift(-(horizon - 1))
+    df["target_h"] = df.groupby(["store_id", "product_id"], observed=True)["target"].shift(-(horizon - 1))
     df = df.dropna(subset=["target_h"] + FEATURE_COLS)
 
+    # Categorical columns already have the category dtype from the feature store.
     X = df[FEATURE_COLS + CATEGORICAL_COLS].copy()
-    for col in CATEGORICAL_COLS:
-        X[col] = X[col].astype("category")
     y = df["target_h"].values
     return X, y
 
 
-def cv_wape_for_params(params: dict, df: pd.DataFrame, day0: pd.Timestamp) -> float:
+def horizon_targets(df: pd.DataFrame) -> tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Run walk-forward CV with given LightGBM params.
-    Returns mean WAPE across all folds and horizons.
+    The rows make_lgb_dataset uses at any horizon, as (X, targets): the
+    labelled rows with every feature present, and one target column per
+    horizon h holding target_h (NaN where the series ends first).
+    X[targets[h].notna()] and targets[h].dropna() equal make_lgb_dataset(df, h).
     """
-    fold_wapes = []
+    df = df[df["target"].notna()]
+    by_series = df.groupby(["store_id", "product_id"], observed=True)["target"]
+    targets = pd.DataFrame({h: by_series.shift(-(h - 1)) for h in range(1, N_HORIZONS + 1)})
+    keep = df[FEATURE_COLS].notna().all(axis=1)
+    return df.loc[keep, FEATURE_COLS + CATEGORICAL_COLS], targets[keep]
+
 
-    for fold in FOLDS:
+def horizon_datasets(X: pd.DataFrame, targets: pd.DataFrame,
+                     reference: lgb.Dataset | None = None) -> tuple[lgb.Dataset, dict]:
+    """
+    One binned lgb.Dataset over all rows of X, and per horizon a subset of
+    it with that horizon's rows and label. The bin mappers and categorical
+    maps are built once for the row set, not once per horizon. With a
+    `reference` (a training base), X is binned with the reference's mappers.
+    Returns (base, {h: Dataset}); horizons without rows are left out.
+
+    The bins come from every labelled row rather than from each horizon's
+    own rows, so the trained trees, and CV WAPE, differ slightly from
+    per-horizon Datasets (up to ~1.5e-3, see model_card.md).
+    """
+    base = lgb.Dataset(X, targets[1].fillna(0).to_numpy(), reference=reference,
+                       params=CV_DATASET_PARAMS).construct()
+    sets = {}
+    for h in range(1, N_HORIZONS + 1):
+        rows = np.flatnonzero(targets[h].notna().to_numpy())
+        if len(rows) == 0:
+            continue
+        subset = base.subset(rows).construct()
+        subset.set_label(targets[h].to_numpy()[rows])
+        sets[h] = subset
+    return base, sets
+
+
+def build_cv_datasets(df: pd.DataFrame, day0: pd.Timestamp) -> list[dict]:
+    """
+    Walk-forward CV design matrices for every fold × horizon, as lgb.Datasets
+    binned once and shared by all Optuna trials. Each entry holds the train
+    Dataset, the validation Dataset (binned against the train one) and the
+    raw validation frame and labels used for scoring.
+
+    Each fold's train and validation rows are binned once (horizon_datasets)
+    and every horizon is a labelled subset of them. The Datasets are built
+    with feature_pre_filter=False, so trials may vary min_child_samples on
+    the same bins; only the booster parameters change between trials.
+    """
+    cv_sets = []
+
+    for fold_idx, fold in enumerate(FOLDS, start=1):
         train_end = day0 + pd.Timedelta(days=fold["train_end"] - 1)
         val_start = day0 + pd.Timedelta(days=fold["val_start"] - 1)
         val_end   = day0 + pd.Timedelta(days=fold["val_end"]   - 1)
@@ -236,25 +316,55 @@ def cv_wape_for_params(params: dict, df: pd.DataFrame, day0: pd.Timestamp) -> fl
         train_df = df[df["date"] <= train_end]
         val_df   = df[(df["date"] >= val_start) & (df["date"] <= val_end)]
 
-        if len(val_df) == 0:
+        X_tr, targets_tr = horizon_targets(train_df)
+        X_val, targets_val = horizon_targets(val_df)
+        if len(X_tr) == 0 or len(X_val) == 0:
             continue
 
-        for h in range(1, N_HORIZONS + 1):
-            X_tr, y_tr = make_lgb_dataset(train_df, h)
-            X_val, y_val = make_lgb_dataset(val_df, h)
+        train_base, train_sets = horizon_datasets(X_tr, targets_tr)
+        _, val_sets = horizon_datasets(X_val, targets_val, reference=train_base)
 
-            if len(X_tr) == 0 or len(X_val) == 0:
+        for h in range(1, N_HORIZONS + 1):
+            if h not in train_sets or h not in val_sets:
                 continue
+            has_label = targets_val[h].notna()
+            cv_sets.append({"fold": fold_idx, "horizon": h, "train": train_sets[h],
+                            "val": val_sets[h], "X_val": X_val[has_label],
+                            "y_val": targets_val.loc[has_label, h].to_numpy()})
 
-            model = lgb.LGBMRegressor(**params, n_estimators=300, random_state=42, verbose=-1)
-            model.fit(
-                X_tr, y_tr,
-                eval_set=[(X_val, y_val)],
-                callbacks=[lgb.early_stopping(30, verbose=False),
-                           lgb.log_evaluation(-1)],
-            )
-            preds = np.clip(model.predict(X_val), 0, None)
-            fold_wapes.append(wape(y_val, preds))
+    return cv_sets
+
+
+def cv_wape_for_params(params: dict, cv_sets: list[dict], num_threads: int = 0,
+                       trial: optuna.Trial | None = None) -> float:
+    """
+    Run walk-forward CV with given LightGBM params on the prebuilt
+    build_cv_datasets() sets. Returns mean WAPE across all folds and horizons.
+    num_threads=0 leaves LightGBM's thread count at its default.
+
+    With a `trial`, the mean WAPE so far is reported after each fold (step =
+    fold number) and the trial is stopped with TrialPruned when the study's
+    pruner says so.
+    """
+    fold_wapes = []
+    train_params = {**params, "seed": 42, "verbose": -1, "num_threads": num_threads}
+
+    for i, cv_set in enumerate(cv_sets):
+        booster = lgb.train(
+            train_params, cv_set["train"], num_boost_round=CV_NUM_BOOST_ROUND,
+            valid_sets=[cv_set["val"]],
+            callbacks=[lgb.early_stopping(30, verbose=False),
+                       lgb.log_evaluation(-1)],
+        )
+        preds = np.clip(booster.predict(cv_set["X_val"], num_iteration=booster.best_iteration),
+                        0, None)
+        fold_wapes.append(wape(cv_set["y_val"], preds))
+
+        fold_done = i + 1 == len(cv_sets) or cv_sets[i + 1]["fold"] != cv_set["fold"]
+        if trial is not None and fold_done and i + 1 < len(cv_sets):
+            trial.report(float(np.mean(fold_wapes)), step=cv_set["fold"])
+            if trial.should_prune():
+                raise optuna.TrialPruned()
 
     return float(np.mean(fold_wapes)) if fold_wapes else 1.0
 
@@ -263,41 +373,161 @@ def cv_wape_for_params(params: dict, df: pd.DataFrame, day0: pd.Timestamp) -> fl
 # Optuna objective
 # ---------------------------------------------------------------------------
 
-def make_objective(df: pd.DataFrame, day0: pd.Timestamp):
+def make_objective(cv_sets: list[dict], num_threads: int = 0):
     def objective(trial: optuna.Trial) -> float:
-        params = {
-            "num_leaves":        trial.suggest_int("num_leaves", 20, 150),
-            "learning_rate":     trial.suggest_float("learning_rate", 0.01, 0.2, log=True),
-            "min_child_samples": trial.suggest_int("min_child_samples", 5, 50),
-            "feature_fraction":  trial.suggest_float("feature_fraction", 0.5, 1.0),
-            "bagging_fraction":  trial.suggest_float("bagging_fraction", 0.5, 1.0),
-            "bagging_freq":      1,
-            "reg_alpha":         trial.suggest_float("reg_alpha", 1e-4, 1.0, log=True),
-            "reg_lambda":        trial.suggest_float("reg_lambda", 1e-4, 1.0, log=True),
-            "objective":         "regression_l1",
-        }
-        return cv_wape_for_params(params, df, day0)
+        params = {}
+        for name, (kind, low, high, log) in SEARCH_SPACE.items():
+            suggest = trial.suggest_int if kind == "int" else trial.suggest_float
+            params[name] = suggest(name, low, high, log=log)
+        return cv_wape_for_params({**params, **FIXED_PARAMS}, cv_sets, num_threads, trial)
     return objective
 
 
+def _make_pruner() -> optuna.pruners.BasePruner:
+    """
+    Stops a trial whose mean WAPE after a fold is worse than the median of
+    earlier trials at the same fold. The pruner is not kept in the study
+    storage, so every process of a parallel search builds its own.
+    """
+    return optuna.pruners.MedianPruner(n_startup_trials=OPTUNA_PRUNER_STARTUP_TRIALS,
+                                       n_warmup_steps=0)
+
+
+def _search_summary(study: optuna.Study) -> dict:
+    """Trial counts and the pruned trials of a finished search, for the metadata."""
+    states = optuna.trial.TrialState
+    pruned = [t for t in study.trials if t.state == states.PRUNED]
+    return {
+        "n_trials":   len(study.trials),
+        "n_complete": sum(t.state == states.COMPLETE for t in study.trials),
+        "n_pruned":   len(pruned),
+        "pruned_trials": [
+            {"number": t.number, "pruned_after_fold": t.last_step,
+             "mean_wape": t.intermediate_values.get(t.last_step)}
+            for t in pruned
+        ],
+    }
+
+
+def _available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _search_fingerprint(df_train: pd.DataFrame) -> str:
+    """
+    Hash of everything a stored trial's WAPE depends on: the training rows
+    and their schema, the search space, the CV setup and this module's code.
+    """
+    setup = {
+        "schema":       {col: str(dtype) for col, dtype in df_train.dtypes.items()},
+        "search_space": SEARCH_SPACE,
+        "fixed_params": FIXED_PARAMS,
+        "folds":        FOLDS,
+        "n_horizons":   N_HORIZONS,
+        "cv_rounds":    CV_NUM_BOOST_ROUND,
+        "dataset":      CV_DATASET_PARAMS,
+    }
+    digest = hashlib.sha256(json.dumps(setup, sort_keys=True).encode())
+    digest.update(pd.util.hash_pandas_object(df_train, index=False).to_numpy().tobytes())
+    digest.update(Path(__file__).read_bytes())
+    return digest.hexdigest()[:16]
+
+
+def _study_name(df_train: pd.DataFrame) -> str:
+    """
+    Study name tied to the training data and search setup, so only a rerun
+    with the same data, features, search space and code resumes it.
+    """
+    return (f"demand_forecast_{MODEL_VERSION}_{df_train['date'].min():%Y%m%d}_"
+            f"{df_train['date'].max():%Y%m%d}_{_search_fingerprint(df_train)}")
+
+
+def _finished_trials(study: optuna.Study) -> int:
+    """Trials that count toward the budget; failed or abandoned ones do not."""
+    return len(study.get_trials(deepcopy=False, states=BUDGET_STATES))
+
+
+def _optuna_worker(study_name: str, storage: str, seed: int, num_threads: int,
+                   n_trials: int, train_path: str, day0: pd.Timestamp) -> None:
+    """
+    One search process: run trials of the shared study on the parent's
+    training frame (an Arrow IPC file at train_path) until n_trials have
+    finished or are running.
+    """
+    study = optuna.load_study(study_name=study_name, storage=storage,
+                              sampler=optuna.samplers.TPESampler(seed=seed),
+                              pruner=_make_pruner())
+    if _finished_trials(study) >= n_trials:
+        return
+    df_train = _read_ipc(train_path)
+    if _study_name(df_train) != study_name:
+        raise RuntimeError(f"Optuna worker: training frame at {train_path} does not match "
+                           f"study {study_name}")
+    objective = make_objective(build_cv_datasets(df_train, day0), num_threads)
+    running = (optuna.trial.TrialState.RUNNING,)
+    while len(study.get_trials(deepcopy=False, states=BUDGET_STATES + running)) < n_trials:
+        study.optimize(objective, n_trials=1, show_progress_bar=False)
+
+
+def run_optuna_search(df_train: pd.DataFrame, day0: pd.Timestamp,
+                      workers: int | None = None) -> optuna.Study:
+    """
+    N_OPTUNA_TRIALS trials of TPE search over the LightGBM parameters, in
+    this process or, with workers > 1, in that many processes sharing a
+    SQLite study under LOCAL_OPTUNA_DIR.
+    """
+    workers = ML_OPTUNA_WORKERS if workers is None else workers
+    if workers <= 1:
+        cv_sets = build_cv_datasets(df_train, day0)
+        print(f"  CV datasets    : {len(cv_sets)} fold × horizon sets, binned once")
+        study = optuna.create_study(direction="minimize",
+                                    sampler=optuna.samplers.TPESampler(seed=42),
+                                    pruner=_make_pruner())
+        study.optimize(make_objective(cv_sets), n_trials=N_OPTUNA_TRIALS, show_progress_bar=False)
+        return study
+
+    LOCAL_OPTUNA_DIR.mkdir(parents=True, exist_ok=True)
+    storage = f"sqlite:///{(LOCAL_OPTUNA_DIR / 'studies.db').resolve().as_posix()}"
+    study_name = _study_name(df_train)
+    study = optuna.create_study(study_name=study_name, storage=storage,
+                                direction="minimize", load_if_exists=True,
+                                pruner=_make_pruner())
+    num_threads = max(1, _available_cores() // workers)
+    print(f"  Optuna workers : {workers} × {num_threads} LightGBM threads, study {study_name} "
+          f"({_finished_trials(study)} trials finished) -> {LOCAL_OPTUNA_DIR}")
+
+    # spawn, not fork: the parent holds boto3 clients and LightGBM's OpenMP pool.
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory(prefix="ml_optuna_") as tmp:
+        train_path = Path(tmp) / "train.arrow"
+        _write_ipc(df_train, train_path)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(_optuna_worker, study_name, storage, 42 + i, num_threads,
+                                   N_OPTUNA_TRIALS, str(train_path), day0)
+                       for i in range(workers)]
+            for future in futures:
+                future.result()
+    return optuna.load_study(study_name=study_name, storage=storage)
+
+
 # ---------------------------------------------------------------------------
 # Main
 # ---------------------------------------------------------------------------
 
-def load_features() -> pd.DataFrame:
-    if LOCAL_FEATURES_PATH is not None and LOCAL_FEATURES_PATH.exists():
-        print(f"  Loading features from local file: {LOCAL_FEATURES_PATH}")
-        df = pd.read_parquet(LOCAL_FEATURES_PATH)
-    else:
-        print("  Loading features from S3 …")
-        s3 = get_s3_client()
-        obj = s3.get_object(Bucket=BUCKET, Key=FEATURES_S3_KEY)
-        df = pd.read_parquet(io.BytesIO(obj["Body"].read()))
-
-    df["date"] = pd.to_datetime(df["date"])
-    for col in FEATURE_COLS:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0)
+def load_features(start=None, end=None) -> pd.DataFrame:
+    """
+    Model columns of the feature matrix, optionally limited to
+    start <= date <= end. Only the partitions and row groups in range are read.
+    """
+    print("  Loading features from the feature store …")
+    df = read_features(columns=["target"] + FEATURE_COLS + CATEGORICAL_COLS, start=start, end=end)
+    if df is None:
+        raise FileNotFoundError("No feature matrix found; run ml/features.py first")
+    # Dtypes come from the feature store schema; only NULLs are left to fill.
+    df[FEATURE_COLS] = df[FEATURE_COLS].fillna(0)
     return df
 
 
@@ -314,7 +544,7 @@ def train():
     print(f"  Training data  : {day0.date()} -> {df_train['date'].max().date()}")
     print(f"  Inference date : {df[df['target'].isna()]['date'].max().date()} (features ready, no label yet)")
     print(f"  Labelled rows  : {len(df_train):,}")
-    print(f"  Pairs          : {df_train.groupby(['store_id','product_id']).ngroups:,}")
+    print(f"  Pairs          : {df_train.groupby(['store_id','product_id'], observed=True).ngroups:,}")
 
     # --- baseline evaluation on fold 4 (most recent, closest to prediction boundary) ---
     print("\n[1/3] Evaluating baselines ...")
@@ -327,12 +557,12 @@ def train():
 
     # --- Optuna hyperparameter search ---
     print(f"\n[2/3] Optuna search ({N_OPTUNA_TRIALS} trials) ...")
-    study = optuna.create_study(direction="minimize",
-                                sampler=optuna.samplers.TPESampler(seed=42))
-    study.optimize(make_objective(df_train, day0), n_trials=N_OPTUNA_TRIALS, show_progress_bar=False)
+    study = run_optuna_search(df_train, day0)
 
     best_params = study.best_params
-    best_params.update({"objective": "regression_l1", "bagging_freq": 1})
+    best_params.update(FIXED_PARAMS)
+    search = _search_summary(study)
+    print(f"  Trials     : {search['n_complete']} complete, {search['n_pruned']} pruned")
     print(f"  Best WAPE  : {study.best_value:.4f}")
     print(f"  Best params: {best_params}")
 
@@ -341,7 +571,19 @@ def train():
     models = {}
     cv_metrics = {}
 
+    # fold 4 reporting models: the same estimator and configuration as the
+    # saved models, so the metrics describe them
+    fold4_train_end = day0 + pd.Timedelta(days=fold4["train_end"] - 1)
+    fold4_val_start = day0 + pd.Timedelta(days=fold4["val_start"] - 1)
+    fold4_val_end   = day0 + pd.Timedelta(days=fold4["val_end"]   - 1)
+    X4_tr, targets4_tr = horizon_targets(df_train[df_train["date"] <= fold4_train_end])
+    X4_val, targets4_val = horizon_targets(
+        df_train[(df_train["date"] >= fold4_val_start) & (df_train["date"] <= fold4_val_end)]
+    )
+
     for h in range(1, N_HORIZONS + 1):
+        # The saved models stay LGBMRegressor: evaluate.py and
+        # reorder_recommendations.py use them through the sklearn API.
         X_all, y_all = make_lgb_dataset(df_train, h)
         model = lgb.LGBMRegressor(
             **best_params, n_estimators=500, random_state=42, verbose=-1
@@ -350,20 +592,14 @@ def train():
         models[h] = model
 
         # evaluate on fold 4 for reporting
-        fold4_train_end = day0 + pd.Timedelta(days=fold4["train_end"] - 1)
-        fold4_val_start = day0 + pd.Timedelta(days=fold4["val_start"] - 1)
-        fold4_val_end   = day0 + pd.Timedelta(days=fold4["val_end"]   - 1)
-
-        X_tr, y_tr   = make_lgb_dataset(df_train[df_train["date"] <= fold4_train_end], h)
-        X_val, y_val = make_lgb_dataset(
-            df_train[(df_train["date"] >= fold4_val_start) & (df_train["date"] <= fold4_val_end)], h
-        )
-
-        if len(X_val) > 0:
+        has_train = targets4_tr[h].notna()
+        has_label = targets4_val[h].notna()
+        if has_train.any() and has_label.any():
+            X_val, y_val = X4_val[has_label], targets4_val.loc[has_label, h].to_numpy()
             eval_model = lgb.LGBMRegressor(
                 **best_params, n_estimators=500, random_state=42, verbose=-1
             )
-            eval_model.fit(X_tr, y_tr)
+            eval_model.fit(X4_tr[has_train], targets4_tr.loc[has_train, h].to_numpy())
             preds = np.clip(eval_model.predict(X_val), 0, None)
             cv_metrics[f"h{h}"] = {
                 "wape": wape(y_val, preds),
@@ -384,6 +620,7 @@ def train():
         "categorical_cols": CATEGORICAL_COLS,
         "best_params":     best_params,
         "optuna_best_wape": study.best_value,
+        "optuna_search":   search,
         "cv_metrics":      cv_metrics,
         "baseline_metrics": baseline_metrics,
         "training_date_range": {
@@ -392,7 +629,7 @@ def train():
         },
         "inference_from": str(df[df["target"].isna()]["date"].max().date()),
         "n_rows":  len(df_train),
-        "n_pairs": df_train.groupby(["store_id", "product_id"]).ngroups,
+        "n_pairs": df_train.groupby(["store_id", "product_id"], observed=True).ngroups,
     }
 
     if LOCAL_MODEL_PATH is not None:
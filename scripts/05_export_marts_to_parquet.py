@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Copy the retailops_marts tables from S3 to local Parquet for offline runs.
+
+The dbt marts are Parquet tables, so each table's files are downloaded as-is
+from its Glue storage location into:
+  <out-dir>/<table>/<relative key under the table location>
+
+Hive-style partition directories (key=value/) are kept, so the result can be
+queried directly by the DuckDB backend in ml/athena_client.py:
+
+  python scripts/05_export_marts_to_parquet.py --out-dir data/marts
+  ATHENA_BACKEND=duckdb ML_DUCKDB_DATA_DIR=data/marts \\
+      python ml/run_pipeline.py --local-artifacts ./tmp
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+import boto3
+
+DEFAULT_DATABASE = "retailops_marts"
+
+
+def _load_dotenv_if_available() -> None:
+    try:
+        from dotenv import load_dotenv  # type: ignore
+
+        load_dotenv(Path(__file__).resolve().parents[1] / ".env")
+    except Exception:
+        pass
+
+
+def list_mart_tables(glue_client, database: str) -> List[dict]:
+    """Physical (non-view) tables in the Glue database with their S3 locations."""
+    tables = []
+    for page in glue_client.get_paginator("get_tables").paginate(DatabaseName=database):
+        for table in page.get("TableList", []):
+            if table.get("TableType") == "VIRTUAL_VIEW":
+                continue
+            location = table.get("StorageDescriptor", {}).get("Location")
+            if location:
+                tables.append({"name": table["Name"], "location": location})
+    return tables
+
+
+def export_table(s3_client, location: str, out_dir: Path, workers: int) -> int:
+    """Download every object under one table location. Returns the file count."""
+    bucket, _, prefix = location.removeprefix("s3://").partition("/")
+    prefix = prefix.rstrip("/") + "/"
+    keys = [
+        obj["Key"]
+        for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get("Contents", [])
+        if not obj["Key"].endswith("/") and obj["Size"] > 0
+    ]
+
+    def download(key: str) -> None:
+        target = out_dir / key[len(prefix):]
+        if target.suffix != ".parquet":
+            target = target.with_name(target.name + ".parquet")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        s3_client.download_file(bucket, key, str(target))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(download, keys))
+    return len(keys)
+
+
+def main() -> None:
+    _load_dotenv_if_available()
+
+    parser = argparse.ArgumentParser(description="Export retailops_marts tables to local Parquet.")
+    parser.add_argument(
+        "--region", default=os.getenv("AWS_DEFAULT_REGION", "eu-west-2"), help="AWS region"
+    )
+    parser.add_argument("--database", default=DEFAULT_DATABASE, help="Glue database (default: retailops_marts)")
+    parser.add_argument(
+        "--tables",
+        nargs="+",
+        default=None,
+        help="Tables to export (default: every table in the database)",
+    )
+    parser.add_argument("--out-dir", default="data/marts", help="Local output directory")
+    parser.add_argument("--workers", type=int, default=16, help="Parallel downloads per table")
+    args = parser.parse_args()
+
+    glue = boto3.client("glue", region_name=args.region)
+    s3 = boto3.client("s3", region_name=args.region)
+
+    tables = list_mart_tables(glue, args.database)
+    if args.tables:
+        tables = [t for t in tables if t["name"] in set(args.tables)]
+
+    out_root = Path(args.out_dir)
+    for table in tables:
+        n_files = export_table(s3, table["location"], out_root / table["name"], args.workers)
+        print(f"[{table['name']}] {n_files} files <- {table['location']}")
+
+    print(f"\nExported {len(tables)} tables to {out_root}")
+
+
+if __name__ == "__main__":
+    main()